@@ -1,11 +1,28 @@
-from PIL import Image, ImageDraw
-from colorspacious import deltaE
+from PIL import Image
+import numpy
+import palette_lut
+import argparse
+import build_profile
+import concurrent.futures
+import delta_patch
+import fetcher
+import hashlib
+import http_cache
+import io
 import os
+import priority_index
+import shutil
+import spatial_index
+import struct
 import sys
-import urllib.request
+import template_import
+import tempfile
+import time
 import urllib.parse
 import json
 import datetime
+import multiprocessing
+import multiprocessing.shared_memory
 import math
 import traceback
 
@@ -199,46 +216,203 @@ canvasSize = (1000 + leftExpansion + rightExpansion, 1000 + topExpansion + botto
 topLeftOffset = (leftExpansion, topExpansion)
 palette = palettes[4]
 
+# edge pixels get extra priority which steps down over this many rings towards the inside
+defaultEdgeRings = 6
+defaultEdgeRingStep = 5
+
+cacheRoot = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# shared by every stage so each remote document/image is downloaded once, concurrently
+# copies are kept between runs so unchanged files are only revalidated, and flaky hosts fall back to the last good copy
+# created on first use, so tools that only import this module for its constants don't start threads or a cache
+remoteFetcher = None
+
+def getRemoteFetcher():
+    global remoteFetcher
+    if remoteFetcher == None:
+        remoteFetcher = fetcher.Fetcher(cache = http_cache.HttpCache(os.path.join(cacheRoot, "http")))
+    return remoteFetcher
+
+# replaced by an enabled one for --profile
+buildProfile = build_profile.BuildProfile()
+
 def loadTemplate(subfolder):
     with open(os.path.join(subfolder, "template.json"), "r", encoding="utf-8", newline='\n') as f:
         template = json.loads(f.read())
     return template
 
 
-def createImage(size, isMask):
-    alphaValue = 0
+# Everything between decoding and writing is a uint8 plane of (height, width). Images and layers hold
+# indices into getPaletteArray(palette), with transparentIndex for transparent pixels; priority masks
+# and the mask layer hold the mask's gray level, and are opaque (black where there's no priority).
+transparentIndex = 255
+
+def createPlane(size, isMask):
+    fillValue = transparentIndex
     if isMask:
-        alphaValue = 255
-    return Image.new("RGBA", size, (0, 0, 0, alphaValue)) 
+        fillValue = 0
+    return numpy.full((size[1], size[0]), fillValue, dtype=numpy.uint8)
 
 def createCanvas(isMask = False):
-    return createImage(canvasSize, isMask)
+    return createPlane(canvasSize, isMask)
+
+def createOpaquePlane(size):
+    # black, so that it shows up the same as it did when it was an opaque black RGBA image
+    blackIndex = getPaletteIndices(packColors(numpy.array([[0, 0, 0, 255]], dtype=numpy.uint8)))[0]
+    return numpy.full((size[1], size[0]), blackIndex, dtype=numpy.uint8)
 
-def copyTemplateEntryIntoCanvas(templateEntry, image, canvas):
+def fixupTemplateEntryPosition(templateEntry):
     if (templateEntry["x"] < 0 or
         templateEntry["y"] < 0):
         templateEntry["x"] += 500
         templateEntry["y"] += 500
         print("{0} seems to respect center?? {1}".format(templateEntry["name"], templateEntry))
 
-    if (templateEntry["x"] + image.width > canvasSize[0] or
-        templateEntry["y"] + image.height > canvasSize[1] or
+def checkTemplateEntryBounds(templateEntry, width, height):
+    if (templateEntry["x"] + width > canvasSize[0] or
+        templateEntry["y"] + height > canvasSize[1] or
         templateEntry["x"] < 0 or
         templateEntry["y"] < 0):
         print("{0} is not entirely on canvas?? {1}".format(templateEntry["name"], templateEntry))
+
+def getPlaneSlices(templateEntry, shape, canvas):
+    """Returns (canvas slices, entry slices) for the part of a shape sized plane at the entry's x/y which is on canvas, or None"""
+    clip = intersectRects((templateEntry["x"], templateEntry["y"], templateEntry["x"] + shape[1], templateEntry["y"] + shape[0]), (0, 0, canvas.shape[1], canvas.shape[0]))
+    if clip == None:
+        return None
+    return (
+        (slice(clip[1], clip[3]), slice(clip[0], clip[2])),
+        (slice(clip[1] - templateEntry["y"], clip[3] - templateEntry["y"]), slice(clip[0] - templateEntry["x"], clip[2] - templateEntry["x"])),
+    )
+
+def copyTemplateEntryIntoCanvas(templateEntry, plane, opaque, canvas):
+    slices = getPlaneSlices(templateEntry, plane.shape, canvas)
+    if slices != None:
+        (target, source) = slices
+        canvas[target][opaque[source]] = plane[source][opaque[source]]
+
+def eraseFromCanvas(templateEntry, opaque, canvas, isMask = False):
+    slices = getPlaneSlices(templateEntry, opaque.shape, canvas)
+    if slices != None:
+        (target, source) = slices
+        canvas[target][opaque[source]] = 0 if isMask else transparentIndex
+
+def clearCanvasRegion(canvas, region, isMask = False):
+    canvas[region[1]:region[3], region[0]:region[2]] = 0 if isMask else transparentIndex
+
+def getPlanePixels(plane, isMask = False):
+    """Returns the (height, width, 4) RGBA pixels of a plane, which is only needed once it's written out"""
+    colorTable = numpy.zeros((256, 4), dtype=numpy.uint8)
+    if isMask:
+        colorTable[:, 0:3] = numpy.arange(0, 256, dtype=numpy.uint8)[:, numpy.newaxis]
+        colorTable[:, 3] = 255
+    else:
+        paletteArray = getPaletteArray(palette)
+        colorTable[0:len(paletteArray)] = paletteArray
+    # gathering whole pixels as uint32 is much quicker than gathering rows of 4 bytes
+    return packColors(colorTable)[plane].view(numpy.uint8).reshape(plane.shape + (4,))
+
+def getPixelPlane(pixels, isMask = False):
+    """The reverse of getPlanePixels, for outputs read back in; raises ValueError for pixels a plane can't hold"""
+    if isMask:
+        if not (numpy.all(pixels[:, :, 3] == 255) and numpy.all(pixels[:, :, 0:1] == pixels[:, :, 1:3])):
+            raise ValueError("mask has pixels which aren't opaque gray")
+        return numpy.ascontiguousarray(pixels[:, :, 0])
+    packedPixels = packColors(pixels)
+    plane = getPaletteIndices(packedPixels)
+    transparent = packedPixels == 0
+    if numpy.any((plane == transparentIndex) & ~transparent):
+        raise ValueError("image has pixels which aren't palette colors or fully transparent")
+    plane[transparent] = transparentIndex
+    return plane
+
+def getPlaneImage(plane, isMask = False):
+    return Image.fromarray(getPlanePixels(plane, isMask), "RGBA")
+
+def encodeIndexedImage(canvas):
+    """Returns a P mode copy of canvas using the palette's exact colors, or None if it has any other pixels
+
+    Index 0 is fully transparent; only colors which actually appear get an index so small images can use fewer bits.
+    """
+    pixels = numpy.asarray(canvas).reshape(-1, 4)
+    packedPixels = packColors(pixels)
+    packedPalette = numpy.sort(packColors(getPaletteArray(palette)))
+    
+    transparent = packedPixels == 0
+    paletteIndices = numpy.minimum(numpy.searchsorted(packedPalette, packedPixels), len(packedPalette) - 1)
+    if not numpy.all(transparent | (packedPalette[paletteIndices] == packedPixels)):
+        return None
+    
+    usedColors = numpy.unique(paletteIndices[~transparent])
+    remap = numpy.zeros(len(packedPalette), dtype=numpy.uint8)
+    remap[usedColors] = numpy.arange(1, len(usedColors) + 1)
+    indices = numpy.where(transparent, 0, remap[paletteIndices]).astype(numpy.uint8)
     
-    canvas.alpha_composite(image, (templateEntry["x"], templateEntry["y"]))
+    colors = packedPalette[usedColors].view(numpy.uint8).reshape(-1, 4)
+    indexedImage = Image.fromarray(indices.reshape(canvas.height, canvas.width), "P")
+    indexedImage.putpalette([0, 0, 0] + colors[:, 0:3].reshape(-1).tolist())
+    indexedImage.info["transparency"] = 0
+    return indexedImage
 
-def eraseFromCanvas(templateEntry, maskImage, canvas, isMask = False):
-    blankImage = createImage((maskImage.width, maskImage.height), isMask)
-    canvas.paste(blankImage, (templateEntry["x"], templateEntry["y"]), maskImage)
+def encodeGrayscaleImage(canvas):
+    """Returns an L mode copy of an opaque gray canvas such as the mask, or None if it isn't one"""
+    pixels = numpy.asarray(canvas)
+    if not (numpy.all(pixels[:, :, 3] == 255) and
+        numpy.all(pixels[:, :, 0] == pixels[:, :, 1]) and
+        numpy.all(pixels[:, :, 1] == pixels[:, :, 2])):
+        return None
+    return Image.fromarray(numpy.ascontiguousarray(pixels[:, :, 0]), "L")
 
-def writeCanvas(canvas, subfolder, name):
-    canvas.save(os.path.join(subfolder, name + ".png"))
-    if False:
-        canvas.save(os.path.join(subfolder, name + "_u.png"))
-        with canvas.quantize() as quantizedCanvas:
-            quantizedCanvas.save(os.path.join(subfolder, name + ".png"))
+def encodePng(image):
+    output = io.BytesIO()
+    image.save(output, format="PNG", transparency=image.info.get("transparency"))
+    return output.getvalue()
+
+def writeFileAtomically(path, data):
+    # whoever reads the folder (e.g. the uploader) only ever sees the old file or the new one, never half of one
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+def writeCanvas(canvas, subfolder, name, indexed = False, isMask = False, report = True, outputHashes = None):
+    """Writes canvas to name.png; with outputHashes (from createOutputHashes) a file which already has these pixels is left alone"""
+    if outputHashes == None:
+        writeCanvasFile(canvas, subfolder, name, indexed, isMask, report)
+        return
+    
+    fileName = name + ".png"
+    with canvas.convert("RGBA") as rgbaCanvas:
+        contentHash = hashParts("canvas", indexed, isMask, rgbaCanvas.size, rgbaCanvas.tobytes())
+    if not keepUnchangedOutput(outputHashes, subfolder, fileName, contentHash):
+        writeCanvasFile(canvas, subfolder, name, indexed, isMask, report)
+        recordOutput(outputHashes, subfolder, fileName, contentHash)
+
+def writeCanvasFile(canvas, subfolder, name, indexed, isMask, report):
+    path = os.path.join(subfolder, name + ".png")
+    if not indexed:
+        canvas.save(path + ".tmp", format="PNG")
+        os.replace(path + ".tmp", path)
+        return
+    
+    compactImage = encodeGrayscaleImage(canvas) if isMask else encodeIndexedImage(canvas)
+    compactBytes = None
+    if compactImage != None:
+        compactBytes = encodePng(compactImage)
+        compactImage.close()
+        # only ship the compact encoding if it decodes back to exactly the same pixels
+        with Image.open(io.BytesIO(compactBytes)) as decodedImage:
+            with decodedImage.convert("RGBA") as decodedCanvas:
+                if not numpy.array_equal(numpy.asarray(decodedCanvas), numpy.asarray(canvas)):
+                    compactBytes = None
+    
+    if compactBytes == None:
+        print("\t{0}.png has colors outside of the palette, writing it as RGBA".format(name))
+        compactBytes = encodePng(canvas)
+    elif report:
+        rgbaBytes = encodePng(canvas)
+        print("\t{0}.png: {1} bytes instead of {2}, saved {3}".format(name, len(compactBytes), len(rgbaBytes), len(rgbaBytes) - len(compactBytes)))
+    
+    writeFileAtomically(path, compactBytes)
 
 def colorDistanceRawEuclidean(color, pixel):
     elementDeltaSquares = [(colorElement - pixelElement) ** 2 for colorElement, pixelElement in zip(color[0:3], pixel[0:3])]
@@ -251,110 +425,331 @@ def colorDistancePerceptualEuclidean(color, pixel):
     weightedDeltaSquares = [deltaElement ** 2 for deltaElement in weightedDelta]
     return math.sqrt(sum(weightedDeltaSquares))
 
+def getPaletteArray(colors):
+    # keeps the set's iteration order so ties resolve to the same color as a loop over the set would
+    return numpy.array(list(colors), dtype=numpy.uint8).reshape(-1, 4)
+
+def packColors(pixels):
+    # (..., 4) uint8 -> (...) uint32 so whole pixels can be compared/uniqued as scalars
+    return numpy.ascontiguousarray(pixels, dtype=numpy.uint8).view(numpy.uint32)[..., 0]
+
+def getPaletteIndices(packedColors):
+    """Returns the index in getPaletteArray(palette) of each packed color, or transparentIndex if it isn't a palette color"""
+    packedPalette = packColors(getPaletteArray(palette))
+    order = numpy.argsort(packedPalette)
+    positions = numpy.minimum(numpy.searchsorted(packedPalette[order], packedColors), len(packedPalette) - 1)
+    indices = order[positions].astype(numpy.uint8)
+    indices[packedPalette[indices] != packedColors] = transparentIndex
+    return indices
+
+def findNearestPaletteIndices(colors):
+    # a gather from the precomputed rgb -> nearest palette color table
+    return palette_lut.lookupIndices(getPaletteArray(palette), colors, os.path.join(cacheRoot, "lut"))
+
 def normalizeImage(convertedImage):
-    fixedPixels = 0
-    alphaProblems = 0
-    wrongPixels = set()
-    colorCorrections = dict()
-    
-    for y in range(0, convertedImage.height):
-        for x in range(0, convertedImage.width):
-            xy = (x, y)
-            pixel = convertedImage.getpixel(xy)
-            
-            if isTransparent(pixel):
-                convertedImage.putpixel(xy, (0, 0, 0, 0))
-                continue
-            
-            if pixel in palette:
-                continue
+    """Snaps an RGBA image to the palette, returning (plane, isClean)
 
-            if pixel[0:3] in colorCorrections:
-                v = colorCorrections[pixel[0:3]]
-                newColor = (v[0], v[1], v[2], pixel[3])
-                newDelta = v[3]
-            else:
-                newDelta = 99999999
-                newColor = None
-                for color in palette:
-                    colorDelta = deltaE(color[0:3], pixel[0:3], input_space="sRGB255")
-                    if colorDelta < newDelta:
-                        newColor = color
-                        newDelta = colorDelta
-                colorCorrections[pixel[0:3]] = [*newColor[0:3], newDelta]
-            
-            if pixel[0:3] == newColor[0:3]:
-                alphaProblems += 1
-            else:
-                fixedPixels += 1
-                wrongPixels.add((pixel, newColor, newDelta))
-            convertedImage.putpixel(xy, newColor)
+    Pixels with alpha below 128 become transparent and all others the nearest palette color, fully
+    opaque. isClean is False if some colors were so far off that the entry shouldn't be autopicked.
+    """
+    pixels = numpy.array(convertedImage, dtype=numpy.uint8).reshape(-1, 4)
+    transparent = pixels[:, 3] < 128
+    
+    # every palette color is opaque, so look colors up as if they were too
+    opaqueAlpha = packColors(numpy.array([0, 0, 0, 255], dtype=numpy.uint8))
+    plane = getPaletteIndices(packColors(pixels) | opaqueAlpha)
+    
+    # palette colors which are only semi-transparent are made opaque without counting as a color fix
+    alphaProblems = int(numpy.count_nonzero(~transparent & (pixels[:, 3] != 255) & (plane != transparentIndex)))
+    offIndices = numpy.flatnonzero(~transparent & (plane == transparentIndex))
+    
+    fixedPixels = offIndices.size
+    maxOops = 0
+    if fixedPixels != 0:
+        offPixels = pixels[offIndices]
+        offColors = offPixels.copy()
+        offColors[:, 3] = 0
+        (uniqueColors, firstSeen, inverse) = numpy.unique(packColors(offColors), return_index=True, return_inverse=True)
+        (newUniqueIndices, newUniqueDeltas) = findNearestPaletteIndices(offPixels[firstSeen])
+        
+        newIndices = newUniqueIndices[inverse.reshape(-1)]
+        plane[offIndices] = newIndices
+        
+        fixedDeltas = newUniqueDeltas[inverse.reshape(-1)]
+        maxOops = float(fixedDeltas.max())
+        wrongPixels = numpy.concatenate((offPixels, getPaletteArray(palette)[newIndices]), axis=1)
+        (wrongPixels, wrongFirstSeen) = numpy.unique(wrongPixels, axis=0, return_index=True)
+        wrongDeltas = fixedDeltas[wrongFirstSeen]
+    
+    plane[transparent] = transparentIndex
+    plane = plane.reshape(convertedImage.height, convertedImage.width)
     
     if fixedPixels != 0 or alphaProblems != 0:
         print("\tfixed {0} incorrect pixels and {1} semi-transparent pixels".format(fixedPixels, alphaProblems))
-        maxOops = 0
-        for (original, new, difference) in wrongPixels:
-            maxOops = max(maxOops, difference)
-            print("\t\t{0} -> {1} (delta = {2})".format(original, new, difference))
+        if fixedPixels != 0:
+            for (wrongPixel, difference) in zip(wrongPixels.tolist(), wrongDeltas.tolist()):
+                print("\t\t{0} -> {1} (delta = {2})".format(tuple(wrongPixel[0:4]), tuple(wrongPixel[4:8]), difference))
         
         if (maxOops > 20000):
             print("\ttoo broken with max = {0}, excluding from autopick".format(maxOops))
-            return False
-    return True
+            return (plane, False)
+    return (plane, True)
+
+def hashParts(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = json.dumps(part).encode("utf-8")
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
 
-def loadTemplateEntryImage(templateEntry, subfolder):
+def getPaletteKey():
+    return hashParts("palette", getPaletteArray(palette).tobytes())
+
+def getOpaqueImageKey(size):
+    return hashParts("opaque", size)
+
+def loadTemplateEntrySource(imageSource, subfolder, sourceBodies = None):
+    if sourceBodies != None and imageSource in sourceBodies:
+        if isinstance(sourceBodies[imageSource], Exception):
+            raise sourceBodies[imageSource]
+        return sourceBodies[imageSource]
+    if imageSource.startswith("http"):
+        return getRemoteFetcher().fetch(imageSource)
+    with open(os.path.join(subfolder, imageSource), "rb") as f:
+        return f.read()
+
+def decodeTemplateEntryImage(templateEntry, rawBytes):
+    with buildProfile.stage(templateEntry["name"], "decode"):
+        rawImage = Image.open(io.BytesIO(rawBytes))
+        
+        convertedImage = Image.new("RGBA", (rawImage.width, rawImage.height))
+        convertedImage.paste(rawImage)
+        
+        rawImage.close()
+    buildProfile.count(templateEntry["name"], "pixels", convertedImage.width * convertedImage.height)
+    
+    with buildProfile.stage(templateEntry["name"], "normalize"):
+        (plane, isClean) = normalizeImage(convertedImage)
+    convertedImage.close()
+    if not isClean:
+        templateEntry["__noauto"] = True
+    
+    return plane
+
+# animated sprite sheets are decoded this many pixels at a time, so a long animation doesn't need the whole sheet as RGBA
+animationChunkPixels = 4 * 1024 * 1024
+
+def getAnimationFrameCount(frames, sheetSize):
+    """Returns (frames per row, frame count) for a sprite sheet of sheetSize, laid out left to right then top to bottom"""
+    framesPerRow = sheetSize[0] // frames["width"]
+    gridCount = framesPerRow * (sheetSize[1] // frames["height"])
+    frameCount = gridCount
+    if frames["count"] != None:
+        frameCount = min(frames["count"], gridCount)
+    if frameCount <= 0:
+        raise ValueError("a {0}x{1} sprite sheet has no {2}x{3} frames".format(sheetSize[0], sheetSize[1], frames["width"], frames["height"]))
+    return (framesPerRow, frameCount)
+
+def decodeAnimationParts(templateEntry, rawBytes):
+    """Returns {"still": plane, "moving": plane} for an animated sprite sheet, both the size of one frame
+
+    still has the pixels which are the same in every frame (opaque or not) and moving is opaque wherever
+    any frame differs from the first. The sheet is converted to RGBA a run of frames at a time and each run
+    is compared with the first frame as one array, with every frame a view into it.
+    """
+    frames = templateEntry["__frames"]
+    (frameWidth, frameHeight) = (frames["width"], frames["height"])
+    with buildProfile.stage(templateEntry["name"], "decode"):
+        rawImage = Image.open(io.BytesIO(rawBytes))
+        rawImage.load()
+    (framesPerRow, frameCount) = getAnimationFrameCount(frames, rawImage.size)
+    runLength = max(1, animationChunkPixels // (frameWidth * frameHeight))
+    buildProfile.count(templateEntry["name"], "pixels", frameCount * frameWidth * frameHeight)
+    
+    firstFrame = None
+    moving = numpy.zeros((frameHeight, frameWidth), dtype=bool)
+    firstInRun = 0
+    while firstInRun < frameCount:
+        # a run never wraps onto the next row of the sheet, so it's one rectangle
+        (row, column) = divmod(firstInRun, framesPerRow)
+        runFrames = min(runLength, frameCount - firstInRun, framesPerRow - column)
+        firstInRun += runFrames
+        with buildProfile.stage(templateEntry["name"], "decode"):
+            runImage = rawImage.crop((column * frameWidth, row * frameHeight, (column + runFrames) * frameWidth, (row + 1) * frameHeight))
+            convertedImage = Image.new("RGBA", runImage.size)
+            convertedImage.paste(runImage)
+            runImage.close()
+        with buildProfile.stage(templateEntry["name"], "normalize"):
+            (plane, isClean) = normalizeImage(convertedImage)
+        convertedImage.close()
+        if not isClean:
+            templateEntry["__noauto"] = True
+        
+        # (frames, height, width) without copying anything
+        runPlanes = plane.reshape(frameHeight, runFrames, frameWidth).transpose(1, 0, 2)
+        if firstFrame is None:
+            firstFrame = runPlanes[0].copy()
+        moving |= numpy.any(runPlanes != firstFrame, axis=0)
+        del runPlanes, plane
+    rawImage.close()
+    
+    still = firstFrame
+    still[moving] = transparentIndex
+    movingPlane = createOpaquePlane((frameWidth, frameHeight))
+    movingPlane[~moving] = transparentIndex
+    print("{0}: {1} frames, {2} still and {3} moving pixels".format(templateEntry["name"], frameCount,
+        int(numpy.count_nonzero(still != transparentIndex)), int(numpy.count_nonzero(moving))))
+    return {"still": still, "moving": movingPlane}
+
+def getAnimationPartKey(imageKey, frames, part):
+    return hashParts("frames", imageKey, frames["width"], frames["height"], frames["count"], part)
+
+def loadTemplateEntryImage(templateEntry, subfolder, entryStore = None, sourceBodies = None):
+    """Returns (plane, imageKey, size) where plane is None if getRenderEntryImages can produce it later"""
     # used to erase animations from all shipped images. render a fully opaque mask
     try:
         if "forcewidth" in templateEntry and templateEntry["forcewidth"] != None:
-            return createImage((templateEntry["forcewidth"], templateEntry["forceheight"]), isMask = True)
+            size = (templateEntry["forcewidth"], templateEntry["forceheight"])
+            return (None, getOpaqueImageKey(size), size)
     except Exception as e:
         print("Eat exception {0}".format(traceback.format_exc()))
 
     for imageSource in templateEntry["images"]:
         try:
-            if imageSource.startswith("http"):
-                headers = {
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
-                }
-                request = urllib.request.Request(imageSource, headers = headers, method = "GET")
-                responseObject = urllib.request.urlopen(request, timeout=5)
-                rawImage = Image.open(responseObject)
-            else:
-                rawImage = Image.open(os.path.join(subfolder, imageSource))
+            with buildProfile.stage(templateEntry["name"], "fetch"):
+                rawBytes = loadTemplateEntrySource(imageSource, subfolder, sourceBodies)
+            buildProfile.count(templateEntry["name"], "source_bytes", len(rawBytes))
+            imageKey = hashParts("image", entryStoreVersion, getPaletteKey(), rawBytes)
+            sheetKey = imageKey
+            if "__frames" in templateEntry:
+                imageKey = getAnimationPartKey(sheetKey, templateEntry["__frames"], templateEntry["__frames"]["part"])
             
-            convertedImage = Image.new("RGBA", (rawImage.width, rawImage.height))
-            convertedImage.paste(rawImage)
-
-            rawImage.close()
+            if entryStore != None:
+                info = entryStore.loadInfo(imageKey)
+                if info != None:
+                    if info["noauto"]:
+                        templateEntry["__noauto"] = True
+                    return (None, imageKey, tuple(info["size"]))
             
-            isClean = normalizeImage(convertedImage)
-            if not isClean:
-                templateEntry["__noauto"] = True
+            if "__frames" in templateEntry:
+                parts = decodeAnimationParts(templateEntry, rawBytes)
+                plane = parts[templateEntry["__frames"]["part"]]
+            else:
+                plane = decodeTemplateEntryImage(templateEntry, rawBytes)
+            size = (plane.shape[1], plane.shape[0])
+            
+            if entryStore != None:
+                if "__frames" in templateEntry:
+                    # the other part of the sheet came out of the same decode, keep it for the entry that draws it
+                    for (part, partPlane) in parts.items():
+                        partKey = getAnimationPartKey(sheetKey, templateEntry["__frames"], part)
+                        entryStore.savePlane(partKey, partPlane)
+                        entryStore.saveInfo(partKey, {"noauto": "__noauto" in templateEntry, "size": size})
+                else:
+                    entryStore.savePlane(imageKey, plane)
+                    entryStore.saveInfo(imageKey, {"noauto": "__noauto" in templateEntry, "size": size})
             
-            return convertedImage
+            return (plane, imageKey, size)
         except Exception as e:
             print("Eat exception {0}".format(traceback.format_exc()))
     
     raise RuntimeError("unable to load any images for {0}".format(templateEntry["name"]))
 
-def resolveTemplateFileEntry(templateFileEntry):
+pngSignature = b"\x89PNG\r\n\x1a\n"
+
+def getImageSize(imageFile):
+    """Returns (width, height) from the header of an image file object, without decoding any pixels"""
+    head = imageFile.read(24)
+    if head[0:8] == pngSignature and head[12:16] == b"IHDR":
+        return struct.unpack(">II", head[16:24])
+    # not a PNG, let PIL find the size; it only reads the header until the pixels are asked for
+    imageFile.seek(0)
+    with Image.open(imageFile) as image:
+        return image.size
+
+# enough for the size in the header of a PNG; for other formats the whole image is fetched if it isn't in there
+imageHeaderBytes = 1024
+
+def isRemoteEntry(templateEntry):
+    return not "forcewidth" in templateEntry and all(imageSource.startswith("http") for imageSource in templateEntry["images"])
+
+def getTemplateEntrySize(templateEntry, subfolder):
+    """Returns (size, imageKey) for --plan, from the first image source whose header can be read"""
+    if "forcewidth" in templateEntry and templateEntry["forcewidth"] != None:
+        size = (templateEntry["forcewidth"], templateEntry["forceheight"])
+        return (size, getOpaqueImageKey(size))
+    
+    for imageSource in templateEntry["images"]:
+        try:
+            if imageSource.startswith("http"):
+                head = getRemoteFetcher().fetchPrefix(imageSource, imageHeaderBytes)
+                try:
+                    size = getImageSize(io.BytesIO(head))
+                except Exception:
+                    size = getImageSize(io.BytesIO(getRemoteFetcher().fetch(imageSource)))
+            else:
+                with open(os.path.join(subfolder, imageSource), "rb") as f:
+                    size = getImageSize(f)
+            if "__frames" in templateEntry:
+                frames = templateEntry["__frames"]
+                getAnimationFrameCount(frames, size)
+                return ((frames["width"], frames["height"]), hashParts("header", imageSource, size, frames))
+            return (size, hashParts("header", imageSource, size))
+        except Exception as e:
+            print("can't read the size of {0} for {1}: {2}".format(imageSource, templateEntry["name"], e))
+    
+    raise RuntimeError("unable to read the size of any image for {0}".format(templateEntry["name"]))
+
+def loadEnduDocument(target, enduDocuments):
+    # entries sharing an Endu link (e.g. with different export groups) only parse it once
+    if not target in enduDocuments:
+        enduDocuments[target] = json.loads(getRemoteFetcher().fetch(target).decode("utf-8"))
+    return enduDocuments[target]
+
+def getAnimationPartEntries(converted, enduTemplateEntry):
+    """Returns the entries for animation_import "split": one drawing the pixels which never change and one erasing the rest"""
+    frames = {
+        "width": int(enduTemplateEntry["frameWidth"]),
+        "height": int(enduTemplateEntry["frameHeight"]),
+        "count": None,
+    }
+    if frames["width"] <= 0 or frames["height"] <= 0:
+        raise ValueError("{0} has no frame size".format(converted["name"]))
+    if "frameCount" in enduTemplateEntry and enduTemplateEntry["frameCount"] != None:
+        frames["count"] = int(enduTemplateEntry["frameCount"])
+    
+    still = dict(converted)
+    still["name"] = converted["name"] + " (still)"
+    still["__frames"] = dict(frames, part="still")
+    
+    # like a whole excluded animation, but only where it moves; it isn't ours to export either
+    moving = dict(converted)
+    moving["name"] = converted["name"] + " (moving)"
+    moving["__frames"] = dict(frames, part="moving")
+    moving["autopick"] = False
+    moving["__exclude"] = True
+    moving.pop("export_group", None)
+    return [still, moving]
+
+def resolveTemplateFileEntry(templateFileEntry, enduDocuments = None, animationImport = "exclude"):
+    """Turns one entry of template.json into template entries; enduDocuments caches the Endu documents by link
+
+    animationImport is used for animated Endu templates when the entry doesn't set its own animation_import.
+    """
     requiredProperties = ["name", "x", "y"]
+    if enduDocuments == None:
+        enduDocuments = dict()
     if "endu" in templateFileEntry:
         try:
-            target = templateFileEntry["endu"]
+            target = template_import.normalizeEnduUrl(templateFileEntry["endu"])
             
             if "rentry.co" in target:
                 print("Rejecting rentry.co template from {0}".format(templateFileEntry["name"]))
                 return []
             
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
-            }
-            request = urllib.request.Request(target, headers = headers, method = "GET")
-            responseObject = urllib.request.urlopen(request, timeout=5)
-            enduTemplate = json.loads(responseObject.read().decode("utf-8"))
+            enduTemplate = loadEnduDocument(target, enduDocuments)
             
             output = []
             for enduTemplateEntry in enduTemplate["templates"]:
@@ -375,7 +770,7 @@ def resolveTemplateFileEntry(templateFileEntry):
                     "y": enduTemplateEntry["y"],
                 }
                 
-                for copyProperty in ["export_group", "autopick", "priority"]:
+                for copyProperty in ["export_group", "autopick", "priority", "edge_rings", "edge_ring_step"]:
                     if copyProperty in templateFileEntry:
                         converted[copyProperty] = templateFileEntry[copyProperty]
                 
@@ -385,6 +780,10 @@ def resolveTemplateFileEntry(templateFileEntry):
                     converted["y"] = abs(converted["y"])
                 
                 if "frameRate" in enduTemplateEntry and enduTemplateEntry["frameRate"] != None:
+                    if templateFileEntry.get("animation_import", animationImport) == "split":
+                        print("Splitting animated template {0} into its still and moving pixels".format(localName))
+                        output.extend(getAnimationPartEntries(converted, enduTemplateEntry))
+                        continue
                     print("Forcing exclusion of animated template {0}".format(localName))
                     converted["autopick"] = False
                     converted["__exclude"] = True
@@ -416,323 +815,1789 @@ def resolveTemplateFileEntry(templateFileEntry):
         raise KeyError("template entry for {0} needs either images or endu keys".format(templateFileEntry["name"]))
 
 
-def getSurroundingPixels(xy):
-    (x, y) = xy
-    return [
-        (x-1, y-1),
-        (x, y-1),
-        (x+1, y-1),
-        (x-1, y),
-        (x+1, y),
-        (x-1, y+1),
-        (x, y+1),
-        (x+1, y+1)
-    ]
-
-def isFilledPixelOnEdge(image, knownTransparent, xy):
-    (x, y) = xy
-    if x == 0 or y == 0 or x == image.width - 1 or y == image.height - 1:
-        return True
-    
-    try:
-        if y == 1:
-            pixelsToSample = [
-                (x+1, y),
-                (x-1, y+1),
-                (x, y+1),
-                (x+1, y+1)
-            ]
-        elif x == 1:
-            pixelsToSample = [
-                (x-1, y+1),
-                (x, y+1),
-                (x+1, y+1)
-            ]
-        else:
-            pixelsToSample = [
-                (x+1, y+1)
-            ]
-        
-        justExit = False
-        for pixel in pixelsToSample:
-            if isTransparent(image.getpixel(pixel)):
-                knownTransparent.add(pixel)
-                justExit = True
-        
-        if justExit:
-            return True
+def getEntryInteger(templateEntry, propertyName, defaultValue, minValue, maxValue):
+    value = defaultValue
+    if propertyName in templateEntry:
+        value = int(templateEntry[propertyName])
+        if value < minValue or value > maxValue:
+            raise ValueError("{0} {1} out of acceptable range".format(templateEntry["name"], propertyName))
+    return value
 
-        for neighbor in getSurroundingPixels(xy):
-            if neighbor in knownTransparent:
-                return True
-        return False
-    except:
-        print(xy, image.width, image.height)
-        raise
-
-def isTransparent(pixelTuple):
-    return pixelTuple[3] < 128
-
-def generatePriorityMask(templateEntry, image):
-    priority = 1
-    if "priority" in templateEntry:
-        priority = int(templateEntry["priority"])
-        if priority < 1 or priority > 10:
-            raise ValueError("{0} priority out of acceptable range".format(templateEntry["name"]))
-        
+def getEdgeRings(opaque, ringCount):
+    """Labels each opaque pixel with how many rings in from the edge it is, capped at ringCount
+
+    Ring 0 is the edge: opaque pixels on the image boundary or touching a transparent pixel in
+    the surrounding 8. Each further ring is peeled off by eroding the remaining area by one pixel.
+    """
+    rings = numpy.full(opaque.shape, ringCount, dtype=numpy.int32)
+    remaining = opaque
+    for ring in range(0, ringCount):
+        # a pixel survives the erosion only if all 8 neighbors are still inside; outside the image counts as transparent
+        padded = numpy.pad(remaining, 1, mode="constant", constant_values=False)
+        eroded = remaining.copy()
+        for (dy, dx) in [(0, 0), (0, 1), (0, 2), (1, 0), (1, 2), (2, 0), (2, 1), (2, 2)]:
+            eroded &= padded[dy:dy + opaque.shape[0], dx:dx + opaque.shape[1]]
+        rings[remaining & ~eroded] = ring
+        remaining = eroded
+    return rings
+
+def getEdgeRingCount(templateEntry):
+    return getEntryInteger(templateEntry, "edge_rings", defaultEdgeRings, 0, 255)
+
+def generatePriorityMask(templateEntry, plane, rings = None):
+    """rings are the getEdgeRings of plane, if they're already known, e.g. from an entry with the same image"""
+    priority = getEntryInteger(templateEntry, "priority", 1, 1, 10)
+    ringCount = getEdgeRingCount(templateEntry)
+    ringStep = getEntryInteger(templateEntry, "edge_ring_step", defaultEdgeRingStep, 0, 255)
+    
     priority *= 23
-    mask = Image.new("RGBA", (image.width, image.height), (0, 0, 0, 0))
-    maskDraw = ImageDraw.Draw(mask)
+    opaque = plane != transparentIndex
+    if rings is None:
+        rings = getEdgeRings(opaque, ringCount)
+    # shared rings are kept as uint8, which the arithmetic below would overflow
+    rings = rings.astype(numpy.int32, copy=False)
     
-    knownTransparent = set()
-    edgePixels = set()
-    innerPixels = set()
+    # edge rings count down from priority + 25 in steps, everything further in gets the plain priority
+    values = numpy.where(rings < ringCount, priority + 25 - rings * ringStep, priority)
+    values = numpy.clip(values, 0, 255).astype(numpy.uint8)
     
-    for y in range(0, image.height):
-        for x in range(0, image.width):
-            xy = (x, y)
-            
-            if (xy in knownTransparent):
-                continue
-            
-            if isTransparent(image.getpixel(xy)):
-                knownTransparent.add(xy)
-                maskDraw.point(xy, (0, 0, 0, 0))
-                continue
-            
-            if isFilledPixelOnEdge(image, knownTransparent, xy):
-                edgePixels.add(xy)
-            else:
-                innerPixels.add(xy)
-    
-    for iteration in range(0,6):
-        currentPriority = priority + 25 - iteration * 5
-        pixelTuple = (currentPriority, currentPriority, currentPriority, 255)
-        
-        newEdgePixels = set()
-        for edgePixel in edgePixels:
-            maskDraw.point(edgePixel, pixelTuple)
-            for neighbor in getSurroundingPixels(edgePixel):
-                if neighbor in innerPixels:
-                    newEdgePixels.add(neighbor)
-                    innerPixels.remove(neighbor)
-        edgePixels = newEdgePixels
+    # only the opaque pixels are ever copied into the mask layer
+    values[~opaque] = 0
+    return values
 
-    innerPixels.update(edgePixels)
-    pixelTuple = (priority, priority, priority, 255)
-    for pixel in innerPixels:
-        maskDraw.point(pixel, pixelTuple)
+def generateTransparencyMask(plane):
+    return plane != transparentIndex
 
-    return mask
 
-def generateTransparencyMask(image):
-    return image.getchannel("A").point(lambda a: 0 if a == 0 else 255)
+class SparseLayer:
+    """A transparent canvas-sized layer which only allocates the rect that has been drawn into
 
+    The backing plane grows to cover whatever is composited into it, clipped to the canvas.
+    Erasing or clearing outside of it is skipped since everything there is transparent anyway.
+    """
+    
+    def __init__(self):
+        self.plane = None
+        self.rect = None
+    
+    def ensureRect(self, rect):
+        rect = intersectRects(rect, (0, 0, canvasSize[0], canvasSize[1]))
+        if rect == None:
+            return False
+        if self.plane is None:
+            self.plane = createPlane((rect[2] - rect[0], rect[3] - rect[1]), isMask = False)
+            self.rect = rect
+            return True
+        
+        grownRect = (min(self.rect[0], rect[0]), min(self.rect[1], rect[1]), max(self.rect[2], rect[2]), max(self.rect[3], rect[3]))
+        if grownRect != self.rect:
+            grownPlane = createPlane((grownRect[2] - grownRect[0], grownRect[3] - grownRect[1]), isMask = False)
+            grownPlane[self.rect[1] - grownRect[1]:self.rect[3] - grownRect[1], self.rect[0] - grownRect[0]:self.rect[2] - grownRect[0]] = self.plane
+            self.plane = grownPlane
+            self.rect = grownRect
+        return True
+    
+    def intersects(self, rect):
+        return self.rect != None and intersectRects(self.rect, rect) != None
+    
+    def getLocalPosition(self, position):
+        return {"x": position["x"] - self.rect[0], "y": position["y"] - self.rect[1]}
+    
+    def alphaComposite(self, plane, opaque, position):
+        if self.ensureRect((position["x"], position["y"], position["x"] + plane.shape[1], position["y"] + plane.shape[0])):
+            copyTemplateEntryIntoCanvas(self.getLocalPosition(position), plane, opaque, self.plane)
+    
+    def paste(self, plane, position):
+        if self.ensureRect((position["x"], position["y"], position["x"] + plane.shape[1], position["y"] + plane.shape[0])):
+            slices = getPlaneSlices(self.getLocalPosition(position), plane.shape, self.plane)
+            if slices != None:
+                (target, source) = slices
+                self.plane[target] = plane[source]
+    
+    def erase(self, opaque, position):
+        if self.intersects((position["x"], position["y"], position["x"] + opaque.shape[1], position["y"] + opaque.shape[0])):
+            eraseFromCanvas(self.getLocalPosition(position), opaque, self.plane)
+    
+    def clearRegion(self, region):
+        if self.intersects(region):
+            localRegion = intersectRects(self.rect, region)
+            clearCanvasRegion(self.plane, (localRegion[0] - self.rect[0], localRegion[1] - self.rect[1], localRegion[2] - self.rect[0], localRegion[3] - self.rect[1]))
+    
+    def getPlane(self, rect):
+        """Returns the layer's pixels inside rect, which is the backing plane itself when it matches exactly"""
+        if self.rect == tuple(rect):
+            return self.plane
+        plane = createPlane((rect[2] - rect[0], rect[3] - rect[1]), isMask = False)
+        if self.intersects(rect):
+            sourceRect = intersectRects(self.rect, rect)
+            plane[sourceRect[1] - rect[1]:sourceRect[3] - rect[1], sourceRect[0] - rect[0]:sourceRect[2] - rect[0]] = self.plane[sourceRect[1] - self.rect[1]:sourceRect[3] - self.rect[1], sourceRect[0] - self.rect[0]:sourceRect[2] - self.rect[0]]
+        return plane
+    
+    def close(self):
+        self.plane = None
+        self.rect = None
 
 def getEnduGroup(enduGroups, enduTag):
     if not enduTag in enduGroups:
-        enduImage = createCanvas()
-        enduExtents = dict()
-        enduGroups[enduTag] = (enduImage, enduExtents)
+        enduGroups[enduTag] = (SparseLayer(), dict())
     return enduGroups[enduTag]
 
-def generateEnduImage(enduImage, enduExtents):
+def checkEnduExtents(enduExtents):
     if (enduExtents["x2"] > canvasSize[0] or
         enduExtents["y2"] > canvasSize[1] or
         enduExtents["x1"] < 0 or
         enduExtents["y1"] < 0):
         raise ValueError("endu extents appear to be bigger than canvas??")
-    
-    return enduImage.crop((enduExtents["x1"], enduExtents["y1"], enduExtents["x2"], enduExtents["y2"]))
 
-def updateExtents(templateEntry, image, enduExtents):
+def updateExtents(renderEntry, enduExtents):
     if not "x1" in enduExtents:
-        enduExtents["x1"] = templateEntry["x"]
-        enduExtents["y1"] = templateEntry["y"]
+        enduExtents["x1"] = renderEntry["x"]
+        enduExtents["y1"] = renderEntry["y"]
         
-        enduExtents["x2"] = templateEntry["x"] + image.width
-        enduExtents["y2"] = templateEntry["y"] + image.height
+        enduExtents["x2"] = renderEntry["x"] + renderEntry["width"]
+        enduExtents["y2"] = renderEntry["y"] + renderEntry["height"]
     else:
-        enduExtents["x1"] = min(enduExtents["x1"], templateEntry["x"])
-        enduExtents["y1"] = min(enduExtents["y1"], templateEntry["y"])
+        enduExtents["x1"] = min(enduExtents["x1"], renderEntry["x"])
+        enduExtents["y1"] = min(enduExtents["y1"], renderEntry["y"])
         
-        enduExtents["x2"] = max(enduExtents["x2"], templateEntry["x"] + image.width)
-        enduExtents["y2"] = max(enduExtents["y2"], templateEntry["y"] + image.height)
+        enduExtents["x2"] = max(enduExtents["x2"], renderEntry["x"] + renderEntry["width"])
+        enduExtents["y2"] = max(enduExtents["y2"], renderEntry["y"] + renderEntry["height"])
 
-def writeEnduInfos(enduGroups, enduInfo, subfolder):
+def getEnduGroupInfo(groupName, enduExtents, enduInfo):
+    return {
+        "name": enduInfo["name"] + " - " + groupName,
+        "sources": [
+            enduInfo["source_root"] + getEnduImageName(groupName) + ".png"
+        ],
+        "x": enduExtents["x1"],
+        "y": enduExtents["y1"],
+    }
+
+def writeEnduTemplate(groupInfos, enduInfo, subfolder, outputHashes = None):
     outputObject = {
         "faction": enduInfo["name"],
         "contact": enduInfo["contact"],
-        "templates": []
+        "templates": groupInfos
     }
+    outputBytes = json.dumps(outputObject, indent=4).encode("utf-8")
+    contentHash = hashParts("json", outputBytes)
+    if outputHashes != None and keepUnchangedOutput(outputHashes, subfolder, "endu_template.json", contentHash):
+        return
+    writeFileAtomically(os.path.join(subfolder, "endu_template.json"), outputBytes)
+    if outputHashes != None:
+        recordOutput(outputHashes, subfolder, "endu_template.json", contentHash)
+
+def writeEnduInfos(enduGroups, enduInfo, subfolder, indexed = False, outputHashes = None):
+    groupInfos = []
     
     # groups are in reverse order due to how we render
-    for (groupName, (enduImage, enduExtents)) in reversed(enduGroups.items()):
-        escapedName = urllib.parse.quote_plus(groupName)
-        imageName = "endu_" + escapedName
+    for (groupName, (enduLayer, enduExtents)) in reversed(enduGroups.items()):
+        checkEnduExtents(enduExtents)
+        with getPlaneImage(enduLayer.getPlane((enduExtents["x1"], enduExtents["y1"], enduExtents["x2"], enduExtents["y2"]))) as enduImage:
+            writeCanvas(enduImage, subfolder, getEnduImageName(groupName), indexed, outputHashes = outputHashes)
         
-        with generateEnduImage(enduImage, enduExtents) as enduCrop:
-            writeCanvas(enduCrop, subfolder, imageName)
-        enduImage.close()
-        
-        groupInfo = {
-            "name": enduInfo["name"] + " - " + groupName,
-            "sources": [
-                enduInfo["source_root"] + imageName + ".png"
-            ],
-            "x": enduExtents["x1"],
-            "y": enduExtents["y1"],
-        }
-        
-        outputObject["templates"].append(groupInfo)
+        groupInfos.append(getEnduGroupInfo(groupName, enduExtents, enduInfo))
     
-    with open(os.path.join(subfolder, "endu_template.json"), "w", encoding="utf-8", newline='\n') as f:
-        f.write(json.dumps(outputObject, indent=4))
+    writeEnduTemplate(groupInfos, enduInfo, subfolder, outputHashes)
 
 
-def updateVersion(subfolder):
+def getTileHash(tilePixels):
+    return hashParts("tile", tilePixels.shape, numpy.ascontiguousarray(tilePixels).tobytes())[0:16]
+
+def writeTiles(layerPixels, subfolder, templateVersion, tileSize, indexed = False, outputHashes = None):
+    """Splits the RGBA pixels of canvas/autopick/mask into tiles named by content hash and lists them in tiles.json
+
+    Tiles which are entirely blank are left out, so consumers should treat missing tiles as blank.
+    Tiles no longer referenced by the manifest are deleted. With outputHashes, tiles.json is left alone
+    if it already lists the same tiles for the same version.
+    """
+    tilesFolder = os.path.join(subfolder, "tiles")
+    os.makedirs(tilesFolder, exist_ok=True)
+    
+    manifest = {
+        "version": templateVersion,
+        "tile_size": tileSize,
+        "width": canvasSize[0],
+        "height": canvasSize[1],
+        "layers": dict(),
+    }
+    usedTiles = set()
+    for (layerName, isMask) in [("canvas", False), ("autopick", False), ("mask", True)]:
+        pixels = layerPixels[layerName]
+        blankPixel = numpy.array([0, 0, 0, 255 if isMask else 0], dtype=numpy.uint8)
+        tiles = []
+        for y in range(0, canvasSize[1], tileSize):
+            for x in range(0, canvasSize[0], tileSize):
+                tilePixels = pixels[y:y + tileSize, x:x + tileSize]
+                if numpy.all(tilePixels == blankPixel):
+                    continue
+                
+                tileHash = getTileHash(tilePixels)
+                tiles.append({"x": x, "y": y, "hash": tileHash})
+                if not tileHash in usedTiles and not os.path.isfile(os.path.join(tilesFolder, tileHash + ".png")):
+                    with Image.fromarray(numpy.ascontiguousarray(tilePixels), "RGBA") as tileImage:
+                        writeCanvas(tileImage, tilesFolder, tileHash, indexed, isMask, report = False)
+                usedTiles.add(tileHash)
+        manifest["layers"][layerName] = tiles
+    
+    for fileName in os.listdir(tilesFolder):
+        if fileName.endswith(".png") and not fileName[:-len(".png")] in usedTiles:
+            os.remove(os.path.join(tilesFolder, fileName))
+    
+    manifestBytes = json.dumps(manifest, indent=4).encode("utf-8")
+    if writeVersionedOutput(outputHashes, subfolder, "tiles.json", hashParts("json", manifestBytes), lambda: manifestBytes):
+        print("wrote {0} tiles".format(len(usedTiles)))
+
+def readVersion(subfolder):
     filePath = os.path.join(subfolder, "version.txt")
     templateVersion = 0
     
     if os.path.isfile(filePath):
         with open(filePath, "r", encoding="utf-8", newline='\n') as versionFile:
             templateVersion = int(versionFile.read())
+    return templateVersion
+
+def updateVersion(subfolder):
+    filePath = os.path.join(subfolder, "version.txt")
+    templateVersion = readVersion(subfolder) + 1
     
-    templateVersion += 1
-    
-    with open(filePath, "w", encoding="utf-8", newline='\n') as versionFile:
-        versionFile.write(str(templateVersion))
+    writeFileAtomically(filePath, str(templateVersion).encode("utf-8"))
+    return templateVersion
+
+outputHashesFormatVersion = 1
+
+def getOutputHashesPath(subfolder):
+    return os.path.join(subfolder, "output_hashes.json")
+
+def createOutputHashes(subfolder):
+    """Tracks which outputs a build wrote, against the hashes output_hashes.json has from the last build"""
+    previous = dict()
+    try:
+        with open(getOutputHashesPath(subfolder), "r", encoding="utf-8") as f:
+            recorded = json.loads(f.read())
+        if recorded.get("format") == outputHashesFormatVersion:
+            previous = recorded["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return {"previous": previous, "files": dict(), "written": []}
 
+def keepUnchangedOutput(outputHashes, subfolder, fileName, contentHash):
+    """Returns True if fileName already has contentHash and is still the file the last build recorded"""
+    previous = outputHashes["previous"].get(fileName)
+    if previous == None or previous["content"] != contentHash:
+        return False
+    try:
+        if hashFile(os.path.join(subfolder, fileName)) != previous["sha256"]:
+            return False
+    except OSError:
+        return False
+    outputHashes["files"][fileName] = previous
+    return True
+
+def recordOutput(outputHashes, subfolder, fileName, contentHash, versioned = False):
+    outputHashes["files"][fileName] = {"content": contentHash, "sha256": hashFile(os.path.join(subfolder, fileName))}
+    if versioned:
+        outputHashes["files"][fileName]["versioned"] = True
+    outputHashes["written"].append(fileName)
+
+def writeVersionedOutput(outputHashes, subfolder, fileName, contentHash, encode):
+    """Writes the bytes from encode() to fileName unless outputHashes has it unchanged; returns True if it was written
+
+    Versioned outputs carry the template version, so they're written after getOutputVersion and don't
+    count as a change to the template themselves. contentHash has to cover the version.
+    """
+    if outputHashes != None and keepUnchangedOutput(outputHashes, subfolder, fileName, contentHash):
+        return False
+    writeFileAtomically(os.path.join(subfolder, fileName), encode())
+    if outputHashes != None:
+        recordOutput(outputHashes, subfolder, fileName, contentHash, versioned = True)
+    return True
+
+def getChangedOutputs(outputHashes):
+    return [fileName for fileName in outputHashes["written"] if not "versioned" in outputHashes["files"][fileName]]
+
+def getOutputVersion(outputHashes, subfolder):
+    """Bumps version.txt if any output written so far changed and returns the version"""
+    changedOutputs = getChangedOutputs(outputHashes)
+    currentNames = set(outputHashes["files"].keys())
+    previousNames = set(fileName for (fileName, recorded) in outputHashes["previous"].items() if not "versioned" in recorded)
+    if len(changedOutputs) == 0 and currentNames == previousNames and readVersion(subfolder) != 0:
+        print("no output changed, staying on version {0}".format(readVersion(subfolder)))
+        return readVersion(subfolder)
+    
+    templateVersion = updateVersion(subfolder)
+    print("{0} of {1} outputs changed, now version {2}".format(len(changedOutputs), len(currentNames), templateVersion))
+    return templateVersion
 
-def loadAllianceTemplatesFromCsv(csvLink, selfSourceRoot, honorAlliance):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+def saveOutputHashes(outputHashes, subfolder, templateVersion):
+    """Records the hashes in output_hashes.json, once the versioned outputs are written as well"""
+    if len(outputHashes["written"]) == 0 and outputHashes["files"] == outputHashes["previous"] and os.path.isfile(getOutputHashesPath(subfolder)):
+        return
+    recorded = {
+        "format": outputHashesFormatVersion,
+        "version": templateVersion,
+        "files": dict(sorted(outputHashes["files"].items())),
     }
-    request = urllib.request.Request(csvLink, headers = headers, method = "GET")
-    responseObject = urllib.request.urlopen(request, timeout=5)
-    csvText = responseObject.read().decode("utf-8")
-    
-    outputTemplates = []
-    for line in csvText.split("\n"):
-        chunks = line.strip().split(",")
-        if len(chunks) < 4:
-            print("malformed row")
-            continue
+    writeFileAtomically(getOutputHashesPath(subfolder), json.dumps(recorded, indent=4).encode("utf-8"))
+
+
+deltaLayerNames = ["canvas", "autopick", "mask"]
+
+def getHistoryFolder(subfolder):
+    return os.path.join(cacheRoot, "history", getFolderKey(subfolder))
+
+def snapshotOutputs(subfolder):
+    """Keeps a copy of the current canvas/autopick/mask under the version in version.txt, before they're rebuilt"""
+    templateVersion = readVersion(subfolder)
+    if templateVersion == 0:
+        return
+    sourcePaths = [os.path.join(subfolder, layerName + ".png") for layerName in deltaLayerNames]
+    if not all(os.path.isfile(sourcePath) for sourcePath in sourcePaths):
+        return
+    
+    # the folder is what clients on this version have, so it always wins over an older snapshot
+    versionFolder = os.path.join(getHistoryFolder(subfolder), str(templateVersion))
+    os.makedirs(versionFolder, exist_ok=True)
+    for sourcePath in sourcePaths:
+        targetPath = os.path.join(versionFolder, os.path.basename(sourcePath))
+        shutil.copyfile(sourcePath, targetPath + ".tmp")
+        os.replace(targetPath + ".tmp", targetPath)
+
+def writeDeltas(layerPixels, subfolder, templateVersion, historyCount, outputHashes = None):
+    """Writes deltas/<old version>-<templateVersion>.bin to the RGBA pixels of canvas/autopick/mask for each of the last historyCount versions in the history
 
-        chunks = [v.strip('"') for v in chunks]
-        (name, enduLink, blacklisted, allianceMember) = chunks[0:4]
-        if blacklisted != "":
-            print("skipping blacklisted template {0}".format(name))
+    With outputHashes, a delta between the same images as last time isn't encoded or written again.
+    """
+    historyFolder = getHistoryFolder(subfolder)
+    deltasFolder = os.path.join(subfolder, "deltas")
+    os.makedirs(deltasFolder, exist_ok=True)
+    
+    oldestVersion = templateVersion - historyCount
+    previousVersions = []
+    if os.path.isdir(historyFolder):
+        previousVersions = sorted(int(folderName) for folderName in os.listdir(historyFolder) if folderName.isdigit())
+    
+    newLayers = dict((layerName, layerPixels[layerName]) for layerName in deltaLayerNames)
+    newLayersHash = hashParts("layers", *[numpy.ascontiguousarray(newLayers[layerName]).tobytes() for layerName in deltaLayerNames])
+    fullBytes = sum(os.path.getsize(os.path.join(subfolder, layerName + ".png")) for layerName in deltaLayerNames)
+    deltaFileNames = set()
+    for previousVersion in previousVersions:
+        versionFolder = os.path.join(historyFolder, str(previousVersion))
+        if previousVersion < oldestVersion:
+            shutil.rmtree(versionFolder, ignore_errors=True)
             continue
-        
-        if allianceMember.lower() != "true" and honorAlliance:
-            print("skipping non-alliance template {0}".format(name))
+        if previousVersion >= templateVersion:
             continue
         
-        if selfSourceRoot in enduLink:
-            print("skipping self {0}".format(name))
+        deltaFileName = "{0}-{1}.bin".format(previousVersion, templateVersion)
+        try:
+            baseHashes = [hashFile(os.path.join(versionFolder, layerName + ".png")) for layerName in deltaLayerNames]
+            contentHash = hashParts("delta", delta_patch.deltaFormatVersion, previousVersion, templateVersion, baseHashes, newLayersHash)
+            if outputHashes != None and keepUnchangedOutput(outputHashes, subfolder, "deltas/" + deltaFileName, contentHash):
+                deltaFileNames.add(deltaFileName)
+                continue
+            baseLayers = delta_patch.loadLayers(versionFolder, deltaLayerNames)
+        except OSError:
+            print("history for version {0} is unreadable, skipping its delta".format(previousVersion))
+            continue
+        if any(baseLayers[layerName].shape != newLayers[layerName].shape for layerName in deltaLayerNames):
             continue
         
-        print("import template {0}".format(name))
-        outputTemplate = {
-            "name": name,
-            "endu": enduLink,
-            "priority": 1,
-            "autopick": True
-        }
-        
-        outputTemplates.append(outputTemplate)
+        deltaBytes = delta_patch.encodeDelta(previousVersion, templateVersion, baseLayers, newLayers)
+        writeVersionedOutput(outputHashes, subfolder, "deltas/" + deltaFileName, contentHash, lambda: deltaBytes)
+        deltaFileNames.add(deltaFileName)
+        print("\tdelta from version {0}: {1} bytes instead of {2}".format(previousVersion, len(deltaBytes), fullBytes))
+    
+    # deltas to older versions are no use to anyone
+    for fileName in os.listdir(deltasFolder):
+        if fileName.endswith(".bin") and not fileName in deltaFileNames:
+            os.remove(os.path.join(deltasFolder, fileName))
+
+
+def writePriorityIndex(layerPixels, subfolder, templateVersion, outputHashes = None):
+    """Writes priority_index.bin, the pickable pixels of mask.png grouped by priority with their autopick colors"""
+    contentHash = hashParts("priority index", priority_index.indexFormatVersion, templateVersion,
+        numpy.ascontiguousarray(layerPixels["mask"]).tobytes(), numpy.ascontiguousarray(layerPixels["autopick"]).tobytes())
+    if outputHashes != None and keepUnchangedOutput(outputHashes, subfolder, "priority_index.bin", contentHash):
+        return
+    
+    maskLevels = layerPixels["mask"][:, :, 1].copy()
+    colorIndices = getPaletteIndices(packColors(layerPixels["autopick"]))
+    # the mask is only set where autopick is, but a pixel can't be picked without a color to place
+    maskLevels[colorIndices == transparentIndex] = 0
+    indexBytes = priority_index.encodePriorityIndex(templateVersion, maskLevels, colorIndices, getPaletteArray(palette))
+    writeVersionedOutput(outputHashes, subfolder, "priority_index.bin", contentHash, lambda: indexBytes)
+    print("wrote priority index for {0} pixels: {1} bytes".format(int(numpy.count_nonzero(maskLevels)), len(indexBytes)))
+
+
+def loadAllianceTemplatesFromCsv(csvLink, selfSourceRoot, honorAlliance, seenUrls, animationImport):
+    summary = template_import.createImportSummary(csvLink)
+    outputTemplates = list(template_import.importCsvTemplates(getRemoteFetcher().fetch(csvLink), selfSourceRoot, honorAlliance, seenUrls, summary, animationImport))
+    template_import.printImportSummary(summary)
     return outputTemplates
 
-def getTemplates(templateFile):
+def getTemplates(templateFile, csvFailures = None):
+    """Returns the template entries in draw order; with a csvFailures list, CSV imports that can't be fetched are added to it and skipped instead of raised"""
     selfSourceRoot = templateFile["endu_info"]["source_root"]
+    animationImport = templateFile.get("animation_import", "exclude")
     
     # these are in layer order, so higher entries overwrite/take precedence over lower entries
-    inputTemplates = templateFile["templates"]
-    if "alliance_csv_import" in templateFile:
-        inputTemplates.extend(loadAllianceTemplatesFromCsv(templateFile["alliance_csv_import"], selfSourceRoot, honorAlliance=True))
+    inputTemplates = list(templateFile["templates"])
+    # an Endu link listed again further down is only imported the first time, where it's drawn on top
+    seenUrls = set(template_import.normalizeEnduUrl(entry["endu"]) for entry in inputTemplates if "endu" in entry)
+    getRemoteFetcher().prefetch([templateFile[csvImport] for csvImport in ["alliance_csv_import", "world_csv_import"] if csvImport in templateFile])
+    # the world sheet is imported after the alliance sheet, so rows already imported from it are left out
+    for (csvImport, honorAlliance) in [("alliance_csv_import", True), ("world_csv_import", False)]:
+        if not csvImport in templateFile:
+            continue
+        try:
+            inputTemplates.extend(loadAllianceTemplatesFromCsv(templateFile[csvImport], selfSourceRoot, honorAlliance, seenUrls, animationImport))
+        except Exception as e:
+            if csvFailures == None:
+                raise
+            csvFailures.append("{0} {1}: {2}".format(csvImport, templateFile[csvImport], e))
     
-    if "world_csv_import" in templateFile:
-        inputTemplates.extend(loadAllianceTemplatesFromCsv(templateFile["world_csv_import"], selfSourceRoot, honorAlliance=False))
+    # download every Endu document up front, they're still resolved one by one below to keep the draw order
+    getRemoteFetcher().prefetch([template_import.normalizeEnduUrl(entry["endu"]) for entry in inputTemplates if "endu" in entry and not "rentry.co" in entry["endu"]])
     
     # these will be in draw order, so later entries will overwrite earlier entries
     templates = []
+    enduDocuments = dict()
     for templateFileEntry in reversed(inputTemplates):
         # endu templates can have multiple entries in them, and they are listed in draw order
-        templates.extend(resolveTemplateFileEntry(templateFileEntry))
+        templates.extend(resolveTemplateFileEntry(templateFileEntry, enduDocuments, animationImport))
     return templates
 
-def main(subfolder):
+def isEnabled(templateEntry, utcNow):
+    return not ("enabled_utc" in templateEntry and int(templateEntry["enabled_utc"]) > utcNow)
+
+def prefetchTemplateImages(templates, utcNow, allSources = False):
+    # start downloading the first remote source of every entry that will be rendered; fallbacks are fetched on demand
+    imageUrls = []
+    for templateEntry in templates:
+        if not isEnabled(templateEntry, utcNow) or "forcewidth" in templateEntry or len(templateEntry["images"]) == 0:
+            continue
+        imageSources = templateEntry["images"][0:1]
+        if allSources:
+            imageSources = templateEntry["images"]
+        imageUrls.extend([imageSource for imageSource in imageSources if imageSource.startswith("http")])
+    getRemoteFetcher().prefetch(imageUrls)
+
+
+# bump whenever normalization, mask generation or the manifest layout change so stale caches are ignored
+entryStoreVersion = 2
+
+class EntryStore:
+    """Normalized image planes and priority masks from earlier builds, keyed by a hash of everything that produced them"""
+    
+    def __init__(self, folder):
+        self.folder = folder
+    
+    def getPath(self, key, extension):
+        return os.path.join(self.folder, key[0:2], key + extension)
+    
+    def loadInfo(self, key):
+        try:
+            with open(self.getPath(key, ".json"), "r", encoding="utf-8") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+    
+    def saveInfo(self, key, info):
+        self.saveFile(self.getPath(key, ".json"), lambda f: f.write(json.dumps(info).encode("utf-8")))
+    
+    def loadPlane(self, key):
+        try:
+            return numpy.load(self.getPath(key, ".npy"))
+        except (OSError, ValueError):
+            return None
+    
+    def savePlane(self, key, plane):
+        self.saveFile(self.getPath(key, ".npy"), lambda f: numpy.save(f, plane))
+    
+    def saveFile(self, path, write):
+        """Writes path through a temporary file of its own and moves it into place
+
+        Entries sharing an image are preprocessed by several --jobs workers at once, and they all save
+        under the same key. The contents only depend on the key, so whichever finishes first wins.
+        """
+        if os.path.isfile(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        (fileDescriptor, tempPath) = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fileDescriptor, "wb") as f:
+                write(f)
+            os.replace(tempPath, path)
+        except OSError:
+            # windows won't replace a file another process has open
+            if not os.path.isfile(path):
+                raise
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+
+class MemoryEntryStore:
+    """Same interface as EntryStore but kept in memory, for --watch and batch builds; prune() drops whatever the last build didn't use
+
+    With a backingStore, misses are looked up there and everything saved is written there as well.
+    Keys remember the build (see startBuild) they were stored in, so reuse across builds can be counted.
+    """
+    
+    def __init__(self, backingStore = None):
+        self.backingStore = backingStore
+        self.infos = dict()
+        self.planes = dict()
+        self.used = set()
+        self.build = None
+        self.owners = dict()
+        self.reused = set()
+    
+    def startBuild(self, build):
+        self.build = build
+    
+    def countReuse(self, key):
+        if self.owners.get(key) != self.build:
+            self.reused.add((self.build, key))
+    
+    def getReuseCount(self):
+        """Returns how many entries and masks builds have found in memory from another build, each counted once per build"""
+        return len(self.reused)
+    
+    def loadInfo(self, key):
+        self.used.add(key)
+        if key in self.infos:
+            self.countReuse(key)
+        elif self.backingStore != None:
+            info = self.backingStore.loadInfo(key)
+            if info != None:
+                self.infos[key] = info
+                self.owners[key] = self.build
+        return self.infos.get(key)
+    
+    def saveInfo(self, key, info):
+        self.used.add(key)
+        self.owners[key] = self.build
+        self.infos[key] = json.loads(json.dumps(info))
+        if self.backingStore != None:
+            self.backingStore.saveInfo(key, info)
+    
+    def keepPlane(self, key, plane):
+        plane = numpy.array(plane)
+        # the planes handed out are this memory, so nobody may write to it
+        plane.flags.writeable = False
+        self.planes[key] = plane
+        self.owners[key] = self.build
+    
+    def loadPlane(self, key):
+        self.used.add(key)
+        if key in self.planes:
+            self.countReuse(key)
+        elif self.backingStore != None:
+            plane = self.backingStore.loadPlane(key)
+            if plane is None:
+                return None
+            self.keepPlane(key, plane)
+        return self.planes.get(key)
+    
+    def savePlane(self, key, plane):
+        self.used.add(key)
+        self.keepPlane(key, plane)
+        if self.backingStore != None:
+            self.backingStore.savePlane(key, plane)
+    
+    def loadMemoryPlane(self, key):
+        """Like loadPlane, for planes which are only worth keeping in memory and never go to the backing store"""
+        self.used.add(key)
+        return self.planes.get(key)
+    
+    def saveMemoryPlane(self, key, plane):
+        self.used.add(key)
+        self.keepPlane(key, plane)
+    
+    def prune(self):
+        for key in [key for key in self.infos.keys() if not key in self.used]:
+            del self.infos[key]
+        for key in [key for key in self.planes.keys() if not key in self.used]:
+            del self.planes[key]
+        for key in [key for key in self.owners.keys() if not key in self.infos and not key in self.planes]:
+            del self.owners[key]
+        self.used = set()
+
+def createMemoryEntryStore(incremental, jobs):
+    # worker processes can only hand entries back through the cache on disk
+    backingStore = None
+    if incremental or jobs > 1:
+        backingStore = EntryStore(os.path.join(cacheRoot, "entries"))
+    return MemoryEntryStore(backingStore)
+
+def prepareTemplateEntry(templateEntry, subfolder, entryStore = None, sourceBodies = None):
+    """Loads an entry and works out everything that decides how it renders
+
+    Without an entryStore the image is decoded right away. With one, cached images stay on disk
+    until getRenderEntryImages needs them, so unchanged entries cost only a hash of their source.
+    """
+    fixupTemplateEntryPosition(templateEntry)
+    
+    (image, imageKey, size) = loadTemplateEntryImage(templateEntry, subfolder, entryStore, sourceBodies)
+    return createRenderEntry(templateEntry, image, imageKey, size)
+
+def createRenderEntry(templateEntry, image, imageKey, size):
+    checkTemplateEntryBounds(templateEntry, size[0], size[1])
+    
+    isExcluded = "__exclude" in templateEntry
+    if not isExcluded and (templateEntry["x"] < 0 or templateEntry["y"] < 0):
+        raise ValueError("{0} can't be drawn at negative coordinates".format(templateEntry["name"]))
+    
+    isAutopick = "autopick" in templateEntry and bool(templateEntry["autopick"]) and not "__noauto" in templateEntry
+    maskKey = None
+    if isAutopick:
+        maskKey = hashParts("mask", imageKey,
+            getEntryInteger(templateEntry, "priority", 1, 1, 10),
+            getEdgeRingCount(templateEntry),
+            getEntryInteger(templateEntry, "edge_ring_step", defaultEdgeRingStep, 0, 255))
+    
+    exportGroup = ""
+    if "export_group" in templateEntry:
+        exportGroup = str(templateEntry["export_group"])
+    
+    renderEntry = {
+        "name": templateEntry["name"],
+        "x": templateEntry["x"],
+        "y": templateEntry["y"],
+        "width": size[0],
+        "height": size[1],
+        "exclude": isExcluded,
+        "autopick": isAutopick,
+        "export_group": exportGroup,
+        "imageKey": imageKey,
+        "maskKey": maskKey,
+        "templateEntry": templateEntry,
+        "image": image,
+    }
+    renderEntry["key"] = hashParts("entry", imageKey, maskKey, renderEntry["x"], renderEntry["y"], isExcluded, isAutopick, exportGroup)
+    return renderEntry
+
+def getEdgeRingsKey(renderEntry):
+    return hashParts("rings", renderEntry["imageKey"], getEdgeRingCount(renderEntry["templateEntry"]))
+
+def getSharedEdgeRings(renderEntry, plane, entryStore):
+    """Returns the edge rings of an entry's image, worked out once per image and ring count while entries are kept in memory
+
+    Entries sharing an image at different priorities (e.g. an ally's copy of our art) then only differ by
+    the cheap step from rings to mask values. Returns None when there's nowhere to keep them.
+    """
+    if not isinstance(entryStore, MemoryEntryStore):
+        return None
+    ringsKey = getEdgeRingsKey(renderEntry)
+    rings = entryStore.loadMemoryPlane(ringsKey)
+    if rings is None:
+        rings = getEdgeRings(plane != transparentIndex, getEdgeRingCount(renderEntry["templateEntry"])).astype(numpy.uint8)
+        entryStore.saveMemoryPlane(ringsKey, rings)
+    return rings
+
+def getRenderEntryImages(renderEntry, entryStore = None):
+    """Returns (plane, opacity, priority mask or None), which may be read-only
+
+    A plane decoded by prepareTemplateEntry is handed over, so this is only called once per entry.
+    """
+    plane = renderEntry["image"]
+    renderEntry["image"] = None
+    if plane is None and renderEntry["imageKey"] == getOpaqueImageKey((renderEntry["width"], renderEntry["height"])):
+        plane = createOpaquePlane((renderEntry["width"], renderEntry["height"]))
+    elif plane is None:
+        with buildProfile.stage(renderEntry["name"], "load_cached"):
+            plane = entryStore.loadPlane(renderEntry["imageKey"])
+        if plane is None:
+            raise RuntimeError("cached image for {0} went missing".format(renderEntry["name"]))
+    
+    priorityMask = None
+    if renderEntry["autopick"]:
+        if entryStore != None:
+            with buildProfile.stage(renderEntry["name"], "load_cached"):
+                priorityMask = entryStore.loadPlane(renderEntry["maskKey"])
+        if priorityMask is None:
+            with buildProfile.stage(renderEntry["name"], "mask"):
+                priorityMask = generatePriorityMask(renderEntry["templateEntry"], plane, getSharedEdgeRings(renderEntry, plane, entryStore))
+            if entryStore != None:
+                entryStore.savePlane(renderEntry["maskKey"], priorityMask)
+    
+    return (plane, generateTransparencyMask(plane), priorityMask)
+
+def getRenderEntryRect(renderEntry):
+    return (renderEntry["x"], renderEntry["y"], renderEntry["x"] + renderEntry["width"], renderEntry["y"] + renderEntry["height"])
+
+def intersectRects(first, second):
+    rect = (max(first[0], second[0]), max(first[1], second[1]), min(first[2], second[2]), min(first[3], second[3]))
+    if rect[0] >= rect[2] or rect[1] >= rect[3]:
+        return None
+    return rect
+
+def mergeRects(rects):
+    # merge overlapping rects until none overlap, so every pixel is recomposited exactly once
+    merged = spatial_index.GridIndex()
+    for (key, rect) in enumerate(rects):
+        rect = tuple(rect)
+        while True:
+            overlapping = merged.query(rect)
+            if len(overlapping) == 0:
+                break
+            for otherKey in overlapping:
+                other = merged.rects[otherKey]
+                merged.remove(otherKey)
+                rect = (min(rect[0], other[0]), min(rect[1], other[1]), max(rect[2], other[2]), max(rect[3], other[3]))
+        merged.insert(key, rect)
+    return [rect for (key, rect) in merged.getRects()]
+
+def getEntryIndex(renderEntries):
+    """Returns a spatial_index.GridIndex of renderEntries keyed by their position in the list, i.e. draw order"""
+    entryIndex = spatial_index.GridIndex()
+    for (index, renderEntry) in enumerate(renderEntries):
+        entryIndex.insert(index, getRenderEntryRect(renderEntry))
+    return entryIndex
+
+def renderTemplateEntry(renderEntry, images, layers, region = None):
+    """Applies one entry to every output layer, optionally only inside region (x1, y1, x2, y2)
+
+    Without a region the entry also grows the extents of its endu group.
+    """
+    (plane, opaque, priorityMask) = images
+    position = {"x": renderEntry["x"], "y": renderEntry["y"]}
+    if region != None:
+        clip = intersectRects(getRenderEntryRect(renderEntry), region)
+        if clip == None:
+            return
+        cropSlices = (slice(clip[1] - renderEntry["y"], clip[3] - renderEntry["y"]), slice(clip[0] - renderEntry["x"], clip[2] - renderEntry["x"]))
+        plane = plane[cropSlices]
+        opaque = opaque[cropSlices]
+        if priorityMask is not None:
+            priorityMask = priorityMask[cropSlices]
+        position = {"x": clip[0], "y": clip[1]}
+    
+    entryName = renderEntry["name"]
+    buildProfile.count(entryName, "composited_pixels", plane.size)
+    if renderEntry["exclude"]:
+        with buildProfile.stage(entryName, "erase_canvas"):
+            eraseFromCanvas(position, opaque, layers["canvas"])
+    else:
+        with buildProfile.stage(entryName, "composite_canvas"):
+            copyTemplateEntryIntoCanvas(position, plane, opaque, layers["canvas"])
+    
+    if renderEntry["autopick"]:
+        with buildProfile.stage(entryName, "composite_autopick"):
+            copyTemplateEntryIntoCanvas(position, plane, opaque, layers["autopick"])
+        with buildProfile.stage(entryName, "composite_mask"):
+            copyTemplateEntryIntoCanvas(position, priorityMask, opaque, layers["mask"])
+    else:
+        with buildProfile.stage(entryName, "erase_autopick"):
+            eraseFromCanvas(position, opaque, layers["autopick"])
+        with buildProfile.stage(entryName, "erase_mask"):
+            eraseFromCanvas(position, opaque, layers["mask"], isMask=True)
+    
+    if renderEntry["export_group"] != "":
+        with buildProfile.stage(entryName, "composite_endu"):
+            (enduLayer, enduExtents) = getEnduGroup(layers["endu"], renderEntry["export_group"])
+            enduLayer.alphaComposite(plane, opaque, position)
+        if region == None:
+            updateExtents(renderEntry, enduExtents)
+    else:
+        with buildProfile.stage(entryName, "erase_endu"):
+            for (groupName, (enduLayer, enduExtents)) in layers["endu"].items():
+                enduLayer.erase(opaque, position)
+
+def createLayers():
+    return {
+        "canvas": createCanvas(),
+        "autopick": createCanvas(),
+        "mask": createCanvas(isMask=True),
+        "endu": dict(),
+    }
+
+def closeLayers(layers):
+    # the canvas sized planes are plain arrays, only the endu layers hold on to anything
+    for (groupName, (enduLayer, enduExtents)) in layers["endu"].items():
+        enduLayer.close()
+
+def getLayerPixels(layers):
+    """Returns the RGBA pixels of canvas/autopick/mask, which is what gets written out"""
+    return {
+        "canvas": getPlanePixels(layers["canvas"]),
+        "autopick": getPlanePixels(layers["autopick"]),
+        "mask": getPlanePixels(layers["mask"], isMask=True),
+    }
+
+def writeLayerPixels(layerPixels, subfolder, indexed = False, outputHashes = None):
+    for (layerName, isMask) in [("canvas", False), ("autopick", False), ("mask", True)]:
+        with Image.fromarray(layerPixels[layerName], "RGBA") as layerImage:
+            writeCanvas(layerImage, subfolder, layerName, indexed, isMask=isMask, outputHashes=outputHashes)
+
+def getEnduImageName(groupName):
+    return "endu_" + urllib.parse.quote_plus(groupName)
+
+def getOutputFileNames(enduGroupNames):
+    return ["canvas.png", "autopick.png", "mask.png"] + [getEnduImageName(groupName) + ".png" for groupName in enduGroupNames]
+
+def hashFile(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def getFolderKey(subfolder):
+    return hashlib.sha256(os.path.realpath(subfolder).encode("utf-8")).hexdigest()[0:24]
+
+def getManifestPath(subfolder):
+    return os.path.join(cacheRoot, "builds", getFolderKey(subfolder) + ".json")
+
+def loadManifest(subfolder):
+    try:
+        with open(getManifestPath(subfolder), "r", encoding="utf-8") as f:
+            manifest = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    
+    if (manifest.get("version") != entryStoreVersion or
+        manifest.get("canvas_size") != list(canvasSize) or
+        manifest.get("palette") != getPaletteKey()):
+        return None
+    
+    # the outputs in the folder have to be exactly what the manifest describes, otherwise they can't be patched
+    try:
+        for (fileName, fileHash) in manifest["outputs"].items():
+            if hashFile(os.path.join(subfolder, fileName)) != fileHash:
+                print("{0} changed since the last incremental build".format(fileName))
+                return None
+    except OSError:
+        return None
+    return manifest
+
+def getManifest(renderEntries, enduGroups):
+    return {
+        "version": entryStoreVersion,
+        "canvas_size": list(canvasSize),
+        "palette": getPaletteKey(),
+        "entries": [{"name": renderEntry["name"], "key": renderEntry["key"], "rect": list(getRenderEntryRect(renderEntry))} for renderEntry in renderEntries],
+        "endu_groups": dict((groupName, dict(enduExtents)) for (groupName, (enduLayer, enduExtents)) in enduGroups.items()),
+    }
+
+def saveManifest(subfolder, renderEntries, enduGroups):
+    manifest = getManifest(renderEntries, enduGroups)
+    manifest["outputs"] = dict((fileName, hashFile(os.path.join(subfolder, fileName))) for fileName in getOutputFileNames(enduGroups.keys()))
+    
+    manifestPath = getManifestPath(subfolder)
+    os.makedirs(os.path.dirname(manifestPath), exist_ok=True)
+    with open(manifestPath + ".tmp", "w", encoding="utf-8", newline='\n') as f:
+        f.write(json.dumps(manifest))
+    os.replace(manifestPath + ".tmp", manifestPath)
+
+def getDirtyRegions(manifest, renderEntries):
+    """Returns the canvas regions which differ from the previous build, or None if everything must be recomposited"""
+    previousKeys = [previousEntry["key"] for previousEntry in manifest["entries"]]
+    currentKeys = [renderEntry["key"] for renderEntry in renderEntries]
+    
+    dirtyRects = []
+    unchangedCurrent = []
+    remainingPrevious = list(previousKeys)
+    for renderEntry in renderEntries:
+        if renderEntry["key"] in remainingPrevious:
+            remainingPrevious.remove(renderEntry["key"])
+            unchangedCurrent.append(renderEntry["key"])
+        else:
+            dirtyRects.append(getRenderEntryRect(renderEntry))
+    
+    unchangedPrevious = []
+    remainingCurrent = list(currentKeys)
+    for previousEntry in manifest["entries"]:
+        if previousEntry["key"] in remainingCurrent:
+            remainingCurrent.remove(previousEntry["key"])
+            unchangedPrevious.append(previousEntry["key"])
+        else:
+            dirtyRects.append(tuple(previousEntry["rect"]))
+    
+    # unchanged entries which swapped layers could reveal each other anywhere
+    if unchangedCurrent != unchangedPrevious:
+        return None
+    
+    canvasRect = (0, 0, canvasSize[0], canvasSize[1])
+    return [region for region in [intersectRects(rect, canvasRect) for rect in mergeRects(dirtyRects)] if region != None]
+
+def computeEnduGroups(renderEntries):
+    enduGroups = dict()
+    for renderEntry in renderEntries:
+        if renderEntry["export_group"] != "":
+            (enduLayer, enduExtents) = getEnduGroup(enduGroups, renderEntry["export_group"])
+            updateExtents(renderEntry, enduExtents)
+    return enduGroups
+
+def readPlane(path, isMask = False):
+    with Image.open(path) as image:
+        with image.convert("RGBA") as convertedImage:
+            return getPixelPlane(numpy.array(convertedImage), isMask)
+
+def loadPreviousLayers(subfolder, manifest, renderEntries):
+    layers = dict()
+    for (layerName, isMask) in [("canvas", False), ("autopick", False), ("mask", True)]:
+        layers[layerName] = readPlane(os.path.join(subfolder, layerName + ".png"), isMask)
+    
+    # endu images are crops of their group's layer, which is blank outside of the crop
+    layers["endu"] = dict()
+    for (groupName, (enduLayer, enduExtents)) in computeEnduGroups(renderEntries).items():
+        if groupName in manifest["endu_groups"]:
+            previousExtents = manifest["endu_groups"][groupName]
+            enduLayer.paste(readPlane(os.path.join(subfolder, getEnduImageName(groupName) + ".png")), {"x": previousExtents["x1"], "y": previousExtents["y1"]})
+        layers["endu"][groupName] = (enduLayer, enduExtents)
+    return layers
+
+def reusePreviousLayers(previousLayers, renderEntries):
+    """The in-memory version of loadPreviousLayers: takes over the last build's layers, regrouping endu layers for renderEntries"""
+    layers = {
+        "canvas": previousLayers["canvas"],
+        "autopick": previousLayers["autopick"],
+        "mask": previousLayers["mask"],
+        "endu": dict(),
+    }
+    for (groupName, (enduLayer, enduExtents)) in computeEnduGroups(renderEntries).items():
+        if groupName in previousLayers["endu"]:
+            enduLayer.close()
+            enduLayer = previousLayers["endu"][groupName][0]
+        layers["endu"][groupName] = (enduLayer, enduExtents)
+    for (groupName, (enduLayer, enduExtents)) in previousLayers["endu"].items():
+        if not groupName in layers["endu"]:
+            enduLayer.close()
+    return layers
+
+def getEntrySourceBodies(templateEntry):
+    # workers don't share the parent's fetcher, so every remote source is handed to them up front
+    sourceBodies = dict()
+    if "forcewidth" in templateEntry:
+        return sourceBodies
+    for imageSource in templateEntry["images"]:
+        if imageSource.startswith("http"):
+            try:
+                with buildProfile.stage(templateEntry["name"], "fetch"):
+                    sourceBodies[imageSource] = getRemoteFetcher().fetch(imageSource)
+            except Exception:
+                sourceBodies[imageSource] = RuntimeError(traceback.format_exc())
+    return sourceBodies
+
+def packSharedPlane(plane):
+    sharedBuffer = multiprocessing.shared_memory.SharedMemory(create=True, size=max(1, plane.nbytes))
+    sharedPlane = numpy.ndarray(plane.shape, dtype=plane.dtype, buffer=sharedBuffer.buf)
+    sharedPlane[...] = plane
+    del sharedPlane
+    sharedBuffer.close()
+    return (sharedBuffer.name, plane.shape, plane.dtype.str)
+
+def unpackSharedPlane(descriptor):
+    """Returns (plane, sharedBuffer); the plane reads straight out of the buffer, drop it before releaseSharedImage"""
+    (name, shape, dtype) = descriptor
+    sharedBuffer = multiprocessing.shared_memory.SharedMemory(name=name)
+    return (numpy.ndarray(shape, dtype=dtype, buffer=sharedBuffer.buf), sharedBuffer)
+
+def releaseSharedImage(sharedBuffer):
+    sharedBuffer.close()
+    sharedBuffer.unlink()
+
+def preprocessTemplateEntry(templateEntry, subfolder, sourceBodies, useEntryStore, profileEnabled, parentCacheRoot):
+    """Runs in a worker process: load, normalize and generate masks for one entry
+
+    With the entry store the results are left in it for the parent to load. Otherwise the plane,
+    its opacity and the priority mask come back in shared memory blocks which the parent has to release.
+    Profile records for the entry come back as well, for the parent to merge.
+    """
+    global buildProfile, cacheRoot
+    buildProfile = build_profile.BuildProfile(enabled = profileEnabled)
+    # spawned workers import this module afresh, so they'd miss a cacheRoot the parent moved
+    cacheRoot = parentCacheRoot
+    
+    if useEntryStore:
+        entryStore = EntryStore(os.path.join(cacheRoot, "entries"))
+        renderEntry = prepareTemplateEntry(templateEntry, subfolder, entryStore, sourceBodies)
+        if renderEntry["image"] is not None:
+            # freshly decoded, so the priority mask isn't cached yet either
+            getRenderEntryImages(renderEntry, entryStore)
+        return (renderEntry, None, buildProfile.getRecords())
+    
+    renderEntry = prepareTemplateEntry(templateEntry, subfolder, None, sourceBodies)
+    descriptors = [None if plane is None else packSharedPlane(plane) for plane in getRenderEntryImages(renderEntry)]
+    return (renderEntry, descriptors, buildProfile.getRecords())
+
+def prepareTemplateEntriesParallel(templates, subfolder, utcNow, jobs, useEntryStore, renderCallback):
+    """Preprocesses entries on a process pool, handing results to renderCallback strictly in draw order
+
+    renderCallback gets (renderEntry, images) where images is None when useEntryStore is set.
+    """
+    prefetchTemplateImages(templates, utcNow, allSources = True)
+    # on a cold cache every worker would otherwise build the same lookup table at once
+    palette_lut.loadLut(getPaletteArray(palette), os.path.join(cacheRoot, "lut"))
+    
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        pending = []
+        enabledTemplates = [templateEntry for templateEntry in templates if isEnabled(templateEntry, utcNow)]
+        nextToSubmit = 0
+        for templateEntry in enabledTemplates:
+            # keep a bounded number of entries in flight so finished buffers don't pile up behind a slow one
+            while nextToSubmit < len(enabledTemplates) and len(pending) < jobs * 2:
+                submitEntry = enabledTemplates[nextToSubmit]
+                pending.append(executor.submit(preprocessTemplateEntry, submitEntry, subfolder, getEntrySourceBodies(submitEntry), useEntryStore, buildProfile.enabled, cacheRoot))
+                nextToSubmit += 1
+            
+            print("render {0}".format(templateEntry["name"]))
+            future = pending.pop(0)
+            try:
+                (renderEntry, descriptors, profileRecords) = future.result()
+            except:
+                print("Failed to load {0}\n{1}".format(templateEntry["name"], traceback.format_exc()))
+                continue
+            buildProfile.merge(profileRecords)
+            
+            # the worker changed its own copy of the entry, e.g. __noauto and coordinate fixups
+            templateEntry.clear()
+            templateEntry.update(renderEntry["templateEntry"])
+            renderEntry["templateEntry"] = templateEntry
+            
+            if descriptors == None:
+                renderCallback(renderEntry, None)
+                continue
+            
+            unpacked = [None if descriptor == None else unpackSharedPlane(descriptor) for descriptor in descriptors]
+            sharedBuffers = [item[1] for item in unpacked if item != None]
+            try:
+                renderCallback(renderEntry, tuple(None if item == None else item[0] for item in unpacked))
+            except:
+                print("Failed to render {0}".format(templateEntry["name"]))
+            finally:
+                # a buffer can't be closed while a plane still points into it
+                unpacked = None
+                for sharedBuffer in sharedBuffers:
+                    releaseSharedImage(sharedBuffer)
+
+def printImageStoreReport(renderEntries):
+    imageCount = len(set(renderEntry["imageKey"] for renderEntry in renderEntries))
+    maskEntries = [renderEntry for renderEntry in renderEntries if renderEntry["maskKey"] != None]
+    maskCount = len(set(renderEntry["maskKey"] for renderEntry in maskEntries))
+    ringCount = len(set(getEdgeRingsKey(renderEntry) for renderEntry in maskEntries))
+    hitRate = 0.0
+    if len(renderEntries) > 0:
+        hitRate = 1.0 - imageCount / len(renderEntries)
+    print("image store: {0} entries share {1} unique images ({2:.0%} hit rate), {3} unique masks share {4} sets of edge rings".format(
+        len(renderEntries), imageCount, hitRate, maskCount, ringCount))
+
+def renderFull(renderEntries, entryStore):
+    layers = createLayers()
+    for renderEntry in renderEntries:
+        renderTemplateEntry(renderEntry, getRenderEntryImages(renderEntry, entryStore), layers)
+    return layers
+
+def renderIncremental(subfolder, renderEntries, entryStore, previousBuild = None):
+    """Recomposites only what changed since the last build, which is either on disk or previousBuild (manifest and layers)"""
+    if previousBuild != None:
+        manifest = previousBuild["manifest"]
+    else:
+        manifest = loadManifest(subfolder)
+    dirtyRegions = None
+    if manifest != None:
+        dirtyRegions = getDirtyRegions(manifest, renderEntries)
+    
+    if dirtyRegions == None:
+        print("recompositing everything from cached entries")
+        if previousBuild != None:
+            closeLayers(previousBuild["layers"])
+        return renderFull(renderEntries, entryStore)
+    
+    print("recompositing {0} dirty regions".format(len(dirtyRegions)))
+    if previousBuild != None:
+        layers = reusePreviousLayers(previousBuild["layers"], renderEntries)
+    else:
+        layers = loadPreviousLayers(subfolder, manifest, renderEntries)
+    for region in dirtyRegions:
+        clearCanvasRegion(layers["canvas"], region)
+        clearCanvasRegion(layers["autopick"], region)
+        clearCanvasRegion(layers["mask"], region, isMask=True)
+        for (groupName, (enduLayer, enduExtents)) in layers["endu"].items():
+            enduLayer.clearRegion(region)
+    
+    entryIndex = getEntryIndex(renderEntries)
+    dirtyEntries = dict()
+    for region in dirtyRegions:
+        for index in entryIndex.query(region):
+            if not index in dirtyEntries:
+                dirtyEntries[index] = []
+            dirtyEntries[index].append(region)
+    
+    for index in sorted(dirtyEntries.keys()):
+        renderEntry = renderEntries[index]
+        entryRegions = dirtyEntries[index]
+        images = getRenderEntryImages(renderEntry, entryStore)
+        for region in entryRegions:
+            renderTemplateEntry(renderEntry, images, layers, region)
+    return layers
+
+def getRenderEntryOpacity(renderEntry, entryStore):
+    if renderEntry["imageKey"] == getOpaqueImageKey((renderEntry["width"], renderEntry["height"])):
+        return numpy.ones((renderEntry["height"], renderEntry["width"]), dtype=bool)
+    plane = entryStore.loadPlane(renderEntry["imageKey"])
+    if plane is None:
+        raise RuntimeError("cached image for {0} went missing".format(renderEntry["name"]))
+    return generateTransparencyMask(plane)
+
+def getOverlapPixels(below, belowOpacity, above, aboveOpacity):
+    """Returns how many opaque pixels of the entry below are covered by opaque pixels of the entry above"""
+    overlap = intersectRects(getRenderEntryRect(below), getRenderEntryRect(above))
+    if overlap == None:
+        return 0
+    belowPixels = belowOpacity[overlap[1] - below["y"]:overlap[3] - below["y"], overlap[0] - below["x"]:overlap[2] - below["x"]]
+    abovePixels = aboveOpacity[overlap[1] - above["y"]:overlap[3] - above["y"], overlap[0] - above["x"]:overlap[2] - above["x"]]
+    return int(numpy.count_nonzero(belowPixels & abovePixels))
+
+def getOverlapReport(renderEntries, entryStore):
+    """Works out which entries are painted over by which, and how much of each is left visible on the canvas"""
+    entryIndex = getEntryIndex(renderEntries)
+    canvasRect = (0, 0, canvasSize[0], canvasSize[1])
+    opacities = dict()
+    def getOpacity(index):
+        if not index in opacities:
+            opacities[index] = getRenderEntryOpacity(renderEntries[index], entryStore)
+        return opacities[index]
+    
+    overlaps = []
+    for (belowIndex, aboveIndex) in entryIndex.getOverlappingPairs():
+        (below, above) = (renderEntries[belowIndex], renderEntries[aboveIndex])
+        if below["exclude"] or above["exclude"]:
+            continue
+        pixels = getOverlapPixels(below, getOpacity(belowIndex), above, getOpacity(aboveIndex))
+        if pixels != 0:
+            overlaps.append({"below": below["name"], "above": above["name"], "pixels": pixels})
+    overlaps.sort(key=lambda overlap: overlap["pixels"], reverse=True)
+    
+    # later entries are drawn on top, and excluded ones erase whatever is below them
+    owners = numpy.full((canvasSize[1], canvasSize[0]), -1, dtype=numpy.int32)
+    for (index, renderEntry) in enumerate(renderEntries):
+        clip = intersectRects(getRenderEntryRect(renderEntry), canvasRect)
+        if clip == None:
+            continue
+        opacity = getOpacity(index)[clip[1] - renderEntry["y"]:clip[3] - renderEntry["y"], clip[0] - renderEntry["x"]:clip[2] - renderEntry["x"]]
+        owners[clip[1]:clip[3], clip[0]:clip[2]][opacity] = -1 if renderEntry["exclude"] else index
+    visiblePixels = numpy.bincount(owners[owners >= 0], minlength=len(renderEntries))
+    
+    report = {"entries": [], "hidden": [], "overlaps": overlaps}
+    for (index, renderEntry) in enumerate(renderEntries):
+        if renderEntry["exclude"]:
+            continue
+        opaquePixels = int(numpy.count_nonzero(getOpacity(index)))
+        report["entries"].append({"name": renderEntry["name"], "opaque_pixels": opaquePixels, "visible_pixels": int(visiblePixels[index])})
+        if opaquePixels != 0 and visiblePixels[index] == 0:
+            report["hidden"].append(renderEntry["name"])
+    return report
+
+def writeOverlapReport(subfolder, renderEntries, entryStore, topCount = 10):
+    report = getOverlapReport(renderEntries, entryStore)
+    writeFileAtomically(os.path.join(subfolder, "overlap_report.json"), json.dumps(report, indent=4).encode("utf-8"))
+    for name in report["hidden"]:
+        print("{0} is completely painted over".format(name))
+    for overlap in report["overlaps"][0:topCount]:
+        print("{0} paints over {1} pixels of {2}".format(overlap["above"], overlap["pixels"], overlap["below"]))
+
+timelineFormatVersion = 1
+
+def getTimelineFolder(subfolder):
+    return os.path.join(cacheRoot, "timelines", getFolderKey(subfolder))
+
+def getEnabledTime(templateEntry):
+    if "enabled_utc" in templateEntry:
+        return int(templateEntry["enabled_utc"])
+    return None
+
+def prepareAllTemplateEntries(templates, subfolder, entryStore):
+    """Prepares every entry including future animation frames, returning [(renderEntry, enabled time or None)] in draw order"""
+    prefetchTemplateImages(templates, math.inf)
+    preparedEntries = []
+    for templateEntry in templates:
+        try:
+            renderEntry = prepareTemplateEntry(templateEntry, subfolder, entryStore)
+        except:
+            print(f"Failed to load {templateEntry['name']}")
+            continue
+        # it's in the entry store now, so don't keep every frame decoded at once
+        renderEntry["image"] = None
+        preparedEntries.append((renderEntry, getEnabledTime(templateEntry)))
+    return preparedEntries
+
+def getTimelineKey(preparedEntries):
+    return hashParts("timeline", timelineFormatVersion, getPaletteKey(), canvasSize,
+        [[renderEntry["key"], enabledTime] for (renderEntry, enabledTime) in preparedEntries])
+
+def getActiveEntries(preparedEntries, startTime):
+    """Entries which are enabled from startTime on; None is before the first frame"""
+    return [renderEntry for (renderEntry, enabledTime) in preparedEntries if enabledTime == None or (startTime != None and enabledTime <= startTime)]
+
+def getTimelineReport(preparedEntries, startTimes, entryStore):
+    """Works out how much of each animation frame is visible on the canvas over time, and which frames overlap"""
+    frames = [(index, renderEntry, enabledTime) for (index, (renderEntry, enabledTime)) in enumerate(preparedEntries) if enabledTime != None and not renderEntry["exclude"]]
+    if len(frames) == 0:
+        return {"frames": [], "hidden": [], "overlaps": []}
+    
+    rects = [getRenderEntryRect(renderEntry) for (index, renderEntry, enabledTime) in frames]
+    area = intersectRects((min(rect[0] for rect in rects), min(rect[1] for rect in rects), max(rect[2] for rect in rects), max(rect[3] for rect in rects)), (0, 0, canvasSize[0], canvasSize[1]))
+    if area == None:
+        return {"frames": [], "hidden": [], "overlaps": []}
+    
+    # anything drawn inside the frames' area can cover them, animated or not
+    opacities = dict()
+    for (index, (renderEntry, enabledTime)) in enumerate(preparedEntries):
+        if intersectRects(getRenderEntryRect(renderEntry), area) != None:
+            opacities[index] = getRenderEntryOpacity(renderEntry, entryStore)
+    
+    def getClip(index):
+        renderEntry = preparedEntries[index][0]
+        clip = intersectRects(getRenderEntryRect(renderEntry), area)
+        if clip == None:
+            return None
+        target = (slice(clip[1] - area[1], clip[3] - area[1]), slice(clip[0] - area[0], clip[2] - area[0]))
+        source = (slice(clip[1] - renderEntry["y"], clip[3] - renderEntry["y"]), slice(clip[0] - renderEntry["x"], clip[2] - renderEntry["x"]))
+        return (target, source)
+    
+    visiblePixels = dict((index, []) for (index, renderEntry, enabledTime) in frames)
+    for startTime in startTimes:
+        owners = numpy.full((area[3] - area[1], area[2] - area[0]), -1, dtype=numpy.int32)
+        for (index, opacity) in opacities.items():
+            (renderEntry, enabledTime) = preparedEntries[index]
+            if enabledTime != None and (startTime == None or enabledTime > startTime):
+                continue
+            (target, source) = getClip(index)
+            owners[target][opacity[source]] = -1 if renderEntry["exclude"] else index
+        counts = numpy.bincount(owners[owners >= 0], minlength=len(preparedEntries))
+        for (index, renderEntry, enabledTime) in frames:
+            if startTime != None and enabledTime <= startTime:
+                visiblePixels[index].append(int(counts[index]))
+    
+    report = {"frames": [], "hidden": [], "overlaps": []}
+    for (index, renderEntry, enabledTime) in frames:
+        pixels = visiblePixels[index]
+        report["frames"].append({
+            "name": renderEntry["name"],
+            "enabled_utc": enabledTime,
+            "opaque_pixels": int(numpy.count_nonzero(opacities[index])) if index in opacities else 0,
+            "visible_pixels_when_enabled": pixels[0] if len(pixels) != 0 else 0,
+            "visible_pixels_at_end": pixels[-1] if len(pixels) != 0 else 0,
+        })
+        if max(pixels, default=0) == 0:
+            report["hidden"].append(renderEntry["name"])
+    
+    frameIndex = getEntryIndex([renderEntry for (index, renderEntry, enabledTime) in frames])
+    for (first, second) in frameIndex.getOverlappingPairs():
+        (firstIndex, firstEntry, firstTime) = frames[first]
+        (secondIndex, secondEntry, secondTime) = frames[second]
+        if not firstIndex in opacities or not secondIndex in opacities:
+            continue
+        pixels = getOverlapPixels(firstEntry, opacities[firstIndex], secondEntry, opacities[secondIndex])
+        if pixels != 0:
+            # later entries are drawn on top
+            report["overlaps"].append({"below": firstEntry["name"], "above": secondEntry["name"], "pixels": pixels, "from_utc": max(firstTime, secondTime)})
+    return report
+
+def compileTimeline(subfolder):
+    """Renders the outputs at every animation frame boundary, kept as a base plus one delta per boundary
+
+    emitTimeline can then write the outputs for any time without loading or compositing anything.
+    """
     templateFile = loadTemplate(subfolder)
     templates = getTemplates(templateFile)
+    entryStore = EntryStore(os.path.join(cacheRoot, "entries"))
+    preparedEntries = prepareAllTemplateEntries(templates, subfolder, entryStore)
+    boundaries = sorted(set(enabledTime for (renderEntry, enabledTime) in preparedEntries if enabledTime != None))
+    startTimes = [None] + boundaries
     
-    canvasImage = createCanvas()
-    autoPickImage = createCanvas()
-    maskImage = createCanvas(isMask=True)
+    timelineFolder = getTimelineFolder(subfolder)
+    shutil.rmtree(timelineFolder, ignore_errors=True)
+    os.makedirs(os.path.join(timelineFolder, "frames"))
+    os.makedirs(os.path.join(timelineFolder, "endu"))
     
-    enduGroups = dict()
+    states = []
+    layers = None
+    previousEntries = None
+    previousPixels = None
+    for (stateNumber, startTime) in enumerate(startTimes):
+        activeEntries = getActiveEntries(preparedEntries, startTime)
+        print("timeline state {0}: {1} entries from {2}".format(stateNumber, len(activeEntries), startTime))
+        if layers == None:
+            layers = renderFull(activeEntries, entryStore)
+        else:
+            previousBuild = {"manifest": getManifest(previousEntries, layers["endu"]), "layers": layers}
+            layers = renderIncremental(subfolder, activeEntries, entryStore, previousBuild)
+        previousEntries = activeEntries
+        
+        pixels = getLayerPixels(layers)
+        state = {"start_utc": startTime, "delta": None, "endu": []}
+        if previousPixels == None:
+            for layerName in deltaLayerNames:
+                with Image.fromarray(pixels[layerName], "RGBA") as layerImage:
+                    layerImage.save(os.path.join(timelineFolder, layerName + ".png"))
+        else:
+            state["delta"] = "frames/{0}.bin".format(stateNumber)
+            writeFileAtomically(os.path.join(timelineFolder, state["delta"]), delta_patch.encodeDelta(stateNumber - 1, stateNumber, previousPixels, pixels))
+        previousPixels = pixels
+        
+        for (groupName, (enduLayer, enduExtents)) in reversed(layers["endu"].items()):
+            checkEnduExtents(enduExtents)
+            enduPixels = getPlanePixels(enduLayer.getPlane((enduExtents["x1"], enduExtents["y1"], enduExtents["x2"], enduExtents["y2"])))
+            imageHash = hashParts("endu", (enduPixels.shape[1], enduPixels.shape[0]), enduPixels.tobytes())[0:24]
+            imagePath = os.path.join(timelineFolder, "endu", imageHash + ".png")
+            if not os.path.isfile(imagePath):
+                with Image.fromarray(enduPixels, "RGBA") as enduImage:
+                    enduImage.save(imagePath)
+            state["endu"].append({"group": groupName, "extents": dict(enduExtents), "image": imageHash})
+        states.append(state)
+    closeLayers(layers)
+    
+    report = getTimelineReport(preparedEntries, startTimes, entryStore)
+    timeline = {
+        "version": timelineFormatVersion,
+        "key": getTimelineKey(preparedEntries),
+        "endu_info": templateFile["endu_info"],
+        "states": states,
+        "report": report,
+    }
+    writeFileAtomically(os.path.join(timelineFolder, "timeline.json"), json.dumps(timeline, indent=4).encode("utf-8"))
+    
+    print("compiled {0} timeline states".format(len(states)))
+    for frameName in report["hidden"]:
+        print("\t{0} is never visible".format(frameName))
+    for overlap in report["overlaps"]:
+        print("\t{0} covers {1} pixels of {2}".format(overlap["above"], overlap["pixels"], overlap["below"]))
+    return timeline
+
+def emitTimeline(subfolder, atTime, indexedOutput = False, tileSize = None, deltaHistory = None, priorityIndex = False):
+    """Writes the outputs for atTime from the compiled timeline; returns False if it's missing or out of date"""
+    timelineFolder = getTimelineFolder(subfolder)
+    try:
+        with open(os.path.join(timelineFolder, "timeline.json"), "r", encoding="utf-8") as f:
+            timeline = json.loads(f.read())
+    except (OSError, ValueError):
+        print("no compiled timeline for {0}".format(subfolder))
+        return False
+    if timeline.get("version") != timelineFormatVersion:
+        return False
+    
+    templateFile = loadTemplate(subfolder)
+    templates = getTemplates(templateFile)
+    preparedEntries = prepareAllTemplateEntries(templates, subfolder, EntryStore(os.path.join(cacheRoot, "entries")))
+    if getTimelineKey(preparedEntries) != timeline["key"] or templateFile["endu_info"] != timeline["endu_info"]:
+        print("the compiled timeline is out of date")
+        return False
+    
+    if deltaHistory != None:
+        snapshotOutputs(subfolder)
+    
+    states = timeline["states"]
+    stateNumber = 0
+    while stateNumber + 1 < len(states) and states[stateNumber + 1]["start_utc"] <= atTime:
+        stateNumber += 1
+    print("emitting timeline state {0} for {1}".format(stateNumber, atTime))
+    
+    pixels = delta_patch.loadLayers(timelineFolder, deltaLayerNames)
+    for state in states[1:stateNumber + 1]:
+        with open(os.path.join(timelineFolder, state["delta"]), "rb") as f:
+            pixels = delta_patch.applyDelta(f.read(), pixels)
+    
+    outputHashes = createOutputHashes(subfolder)
+    writeLayerPixels(pixels, subfolder, indexedOutput, outputHashes)
+    
+    groupInfos = []
+    for enduGroup in states[stateNumber]["endu"]:
+        with Image.open(os.path.join(timelineFolder, "endu", enduGroup["image"] + ".png")) as enduImage:
+            writeCanvas(enduImage, subfolder, getEnduImageName(enduGroup["group"]), indexedOutput, outputHashes = outputHashes)
+        groupInfos.append(getEnduGroupInfo(enduGroup["group"], enduGroup["extents"], templateFile["endu_info"]))
+    writeEnduTemplate(groupInfos, templateFile["endu_info"], subfolder, outputHashes)
+    
+    templateVersion = getOutputVersion(outputHashes, subfolder)
+    if tileSize != None:
+        writeTiles(pixels, subfolder, templateVersion, tileSize, indexedOutput, outputHashes)
+    if deltaHistory != None:
+        writeDeltas(pixels, subfolder, templateVersion, deltaHistory, outputHashes)
+    if priorityIndex:
+        writePriorityIndex(pixels, subfolder, templateVersion, outputHashes)
+    saveOutputHashes(outputHashes, subfolder, templateVersion)
+    return True
+
+def main(subfolder, incremental = False, jobs = 1, indexedOutput = False, tileSize = None, deltaHistory = None, profile = False, watchState = None, atTime = None, sharedEntryStore = None, overlapReport = False, priorityIndex = False):
+    """Builds the outputs for one template folder, as of atTime (a UTC timestamp) or now
+
+    watchState is a dict kept between calls by watch(); the entries and layers of the last build stay in
+    it so the next call only has to redo what changed. Builds with one are always serial.
+    sharedEntryStore is the entry store buildBatch() hands to every folder it builds.
+    Serial builds keep entries in an entry store keyed by their image bytes, so entries sharing an image
+    share its plane, mask and edge rings. overlapReport writes overlap_report.json, which needs every
+    entry's image after compositing, so it makes parallel builds use an entry store as well.
+    """
+    global buildProfile
+    buildProfile = build_profile.BuildProfile(enabled = profile)
+    bytesDownloadedBefore = getRemoteFetcher().bytesDownloaded
+    
+    with buildProfile.stage(None, "load_templates"):
+        templateFile = loadTemplate(subfolder)
+        templates = getTemplates(templateFile)
+    
+    if deltaHistory != None:
+        snapshotOutputs(subfolder)
+    
+    entryStore = None
+    if watchState != None:
+        if not "entryStore" in watchState:
+            watchState["entryStore"] = MemoryEntryStore()
+        entryStore = watchState["entryStore"]
+    elif sharedEntryStore != None:
+        entryStore = sharedEntryStore
+    elif incremental or overlapReport or jobs == 1:
+        # images are keyed by their bytes and the palette, so entries sharing one only decode and mask it once
+        entryStore = createMemoryEntryStore(incremental, jobs)
+    
+    layers = createLayers()
+    renderEntries = []
     
     utcNow = int(datetime.datetime.utcnow().timestamp())
+    if atTime != None:
+        utcNow = atTime
     print(f"now is {utcNow}")
     for templateEntry in templates:
-        if ("enabled_utc" in templateEntry and int(templateEntry["enabled_utc"]) > utcNow):
+        if not isEnabled(templateEntry, utcNow):
             print("skip {0} due to future animation frame ({1:.02f}h)".format(templateEntry["name"], (int(templateEntry["enabled_utc"])-utcNow)/3600.0))
+    
+    if jobs > 1 and watchState == None:
+        def renderPrepared(renderEntry, images):
+            if images != None:
+                renderTemplateEntry(renderEntry, images, layers)
+            renderEntries.append(renderEntry)
+        # worker processes can only share entries through the cache on disk
+        prepareTemplateEntriesParallel(templates, subfolder, utcNow, jobs, entryStore != None, renderPrepared)
+    else:
+        prefetchTemplateImages(templates, utcNow)
+        for templateEntry in templates:
+            if not isEnabled(templateEntry, utcNow):
+                continue
+            
+            print("render {0}".format(templateEntry["name"]))
+            try:
+                renderEntry = prepareTemplateEntry(templateEntry, subfolder, entryStore)
+                if entryStore == None:
+                    renderTemplateEntry(renderEntry, getRenderEntryImages(renderEntry), layers)
+                renderEntries.append(renderEntry)
+            except:
+                print(f"Failed to load {templateEntry['name']}")
+    
+    if entryStore != None and (incremental or watchState != None):
+        closeLayers(layers)
+        previousBuild = None
+        if watchState != None:
+            previousBuild = watchState.pop("build", None)
+        with buildProfile.stage(None, "render_incremental"):
+            layers = renderIncremental(subfolder, renderEntries, entryStore, previousBuild)
+    elif entryStore != None:
+        closeLayers(layers)
+        with buildProfile.stage(None, "render_full"):
+            layers = renderFull(renderEntries, entryStore)
+    
+    # worker processes each decode their own entries, so there's only something to report in this process
+    if entryStore != None and (jobs == 1 or watchState != None):
+        printImageStoreReport(renderEntries)
+    
+    outputHashes = createOutputHashes(subfolder)
+    with buildProfile.stage(None, "write_layers"):
+        layerPixels = getLayerPixels(layers)
+        writeLayerPixels(layerPixels, subfolder, indexedOutput, outputHashes)
+    
+    with buildProfile.stage(None, "write_endu"):
+        writeEnduInfos(layers["endu"], templateFile["endu_info"], subfolder, indexedOutput, outputHashes)
+    
+    if incremental:
+        with buildProfile.stage(None, "save_manifest"):
+            saveManifest(subfolder, renderEntries, layers["endu"])
+    
+    templateVersion = getOutputVersion(outputHashes, subfolder)
+    
+    if tileSize != None:
+        with buildProfile.stage(None, "write_tiles"):
+            writeTiles(layerPixels, subfolder, templateVersion, tileSize, indexedOutput, outputHashes)
+    
+    if deltaHistory != None:
+        with buildProfile.stage(None, "write_deltas"):
+            writeDeltas(layerPixels, subfolder, templateVersion, deltaHistory, outputHashes)
+    
+    if priorityIndex:
+        with buildProfile.stage(None, "write_priority_index"):
+            writePriorityIndex(layerPixels, subfolder, templateVersion, outputHashes)
+    
+    saveOutputHashes(outputHashes, subfolder, templateVersion)
+    
+    if overlapReport:
+        with buildProfile.stage(None, "overlap_report"):
+            writeOverlapReport(subfolder, renderEntries, entryStore)
+    
+    if watchState != None:
+        watchState["build"] = {"manifest": getManifest(renderEntries, layers["endu"]), "layers": layers}
+        entryStore.prune()
+    else:
+        closeLayers(layers)
+    
+    if profile:
+        buildProfile.count(None, "bytes_downloaded", getRemoteFetcher().bytesDownloaded - bytesDownloadedBefore)
+        report = buildProfile.write(os.path.join(subfolder, "build_profile.json"))
+        print("build took {0:.02f}s, slowest entries:".format(report["wall_seconds"]))
+        for entry in report["top_entries"]:
+            print("\t{0:.03f}s {1}".format(entry["seconds"], entry["name"]))
+
+def isOnCanvas(renderEntry):
+    rect = getRenderEntryRect(renderEntry)
+    return rect[0] >= 0 and rect[1] >= 0 and rect[2] <= canvasSize[0] and rect[3] <= canvasSize[1]
+
+def plan(subfolder, atTime = None, topCount = 10):
+    """Checks a template folder without rendering it, using only image headers; returns the number of problems found
+
+    Prints the layer stack, entries that aren't on the canvas, the endu group extents and the largest
+    overlaps between entry rects. Overlaps are of whole rects, not opaque pixels; --overlaps has those.
+    Remote images and CSV imports that can't be fetched are warnings, not problems.
+    """
+    started = time.perf_counter()
+    templateFile = loadTemplate(subfolder)
+    csvFailures = []
+    templates = getTemplates(templateFile, csvFailures)
+    
+    utcNow = int(datetime.datetime.utcnow().timestamp())
+    if atTime != None:
+        utcNow = atTime
+    
+    # allies' hosts being down isn't something a change to the template can fix, so those are only warnings
+    warnings = 0
+    for csvFailure in csvFailures:
+        print("warning: can't import {0}".format(csvFailure))
+        warnings += 1
+    problems = 0
+    renderEntries = []
+    for templateEntry in templates:
+        if not isEnabled(templateEntry, utcNow):
             continue
-        
-        print("render {0}".format(templateEntry["name"]))
         try:
-            with (
-            loadTemplateEntryImage(templateEntry, subfolder) as image,
-            generateTransparencyMask(image) as transparencyMaskImage):
-                if ("__exclude" in templateEntry):
-                    eraseFromCanvas(templateEntry, transparencyMaskImage, canvasImage)
-                else:
-                    copyTemplateEntryIntoCanvas(templateEntry, image, canvasImage)
-                
-                if ("autopick" in templateEntry and bool(templateEntry["autopick"]) and not "__noauto" in templateEntry):
-                    copyTemplateEntryIntoCanvas(templateEntry, image, autoPickImage)
-                    with generatePriorityMask(templateEntry, image) as priorityMask:
-                        copyTemplateEntryIntoCanvas(templateEntry, priorityMask, maskImage)
-                else:
-                    eraseFromCanvas(templateEntry, transparencyMaskImage, autoPickImage)
-                    eraseFromCanvas(templateEntry, transparencyMaskImage, maskImage, isMask=True)
-                
-                if ("export_group" in templateEntry and str(templateEntry["export_group"]) != ""):
-                    (enduImage, enduExtents) = getEnduGroup(enduGroups, str(templateEntry["export_group"]))
-                    copyTemplateEntryIntoCanvas(templateEntry, image, enduImage)
-                    updateExtents(templateEntry, image, enduExtents)
-                else:
-                    for (groupName, (enduImage, enduExtents)) in enduGroups.items():
-                        eraseFromCanvas(templateEntry, transparencyMaskImage, enduImage)
-        except:
-            print(f"Failed to load {templateEntry['name']}")
+            fixupTemplateEntryPosition(templateEntry)
+            (size, imageKey) = getTemplateEntrySize(templateEntry, subfolder)
+        except Exception as e:
+            if isRemoteEntry(templateEntry):
+                print("warning: {0}: {1}".format(templateEntry["name"], e))
+                warnings += 1
+            else:
+                print("problem: {0}: {1}".format(templateEntry["name"], e))
+                problems += 1
+            continue
+        try:
+            renderEntry = createRenderEntry(templateEntry, None, imageKey, size)
+        except Exception as e:
+            print("problem: {0}: {1}".format(templateEntry["name"], e))
+            problems += 1
+            continue
+        if not isOnCanvas(renderEntry) and not renderEntry["exclude"]:
+            print("problem: {0} at {1} isn't entirely on the {2}x{3} canvas".format(renderEntry["name"], getRenderEntryRect(renderEntry), canvasSize[0], canvasSize[1]))
+            problems += 1
+        renderEntries.append(renderEntry)
+    
+    # top layer first, like template.json
+    print("layer stack ({0} entries, top first):".format(len(renderEntries)))
+    for renderEntry in reversed(renderEntries):
+        flags = []
+        if renderEntry["exclude"]:
+            flags.append("erases")
+        if renderEntry["autopick"]:
+            flags.append("autopick priority {0}".format(getEntryInteger(renderEntry["templateEntry"], "priority", 1, 1, 10)))
+        if renderEntry["export_group"] != "":
+            flags.append("group " + renderEntry["export_group"])
+        print("\t{0} {1}x{2} at ({3}, {4}){5}".format(renderEntry["name"], renderEntry["width"], renderEntry["height"], renderEntry["x"], renderEntry["y"],
+            "".join(", " + flag for flag in flags)))
     
-    writeCanvas(canvasImage, subfolder, "canvas")
-    writeCanvas(autoPickImage, subfolder, "autopick")
-    writeCanvas(maskImage, subfolder, "mask")
+    enduGroups = computeEnduGroups(renderEntries)
+    for (groupName, (enduLayer, enduExtents)) in reversed(enduGroups.items()):
+        try:
+            checkEnduExtents(enduExtents)
+        except ValueError as e:
+            print("problem: endu group {0}: {1}".format(groupName, e))
+            problems += 1
+        print("endu group {0}: ({1}, {2}) to ({3}, {4})".format(groupName, enduExtents["x1"], enduExtents["y1"], enduExtents["x2"], enduExtents["y2"]))
     
-    writeEnduInfos(enduGroups, templateFile["endu_info"], subfolder)
+    entryIndex = getEntryIndex(renderEntries)
+    overlaps = []
+    for (below, above) in entryIndex.getOverlappingPairs():
+        rect = intersectRects(getRenderEntryRect(renderEntries[below]), getRenderEntryRect(renderEntries[above]))
+        overlaps.append(((rect[2] - rect[0]) * (rect[3] - rect[1]), renderEntries[below]["name"], renderEntries[above]["name"]))
+    overlaps.sort(key=lambda overlap: overlap[0], reverse=True)
+    print("{0} pairs of entries overlap".format(len(overlaps)))
+    for (pixels, belowName, aboveName) in overlaps[0:topCount]:
+        print("\t{0} is drawn over {1} pixels of {2}".format(aboveName, pixels, belowName))
     
-    canvasImage.close()
-    autoPickImage.close()
-    maskImage.close()
+    print("planned {0} in {1:.02f}s, {2} problems, {3} warnings".format(subfolder, time.perf_counter() - started, problems, warnings))
+    return problems
+
+watchPollSeconds = 0.5
+watchDebounceSeconds = 1.0
+
+def getWatchSnapshot(subfolder):
+    """Returns the mtime and size of template.json and every local image it refers to"""
+    templatePath = os.path.join(subfolder, "template.json")
+    paths = [templatePath]
+    try:
+        with open(templatePath, "r", encoding="utf-8") as f:
+            templateFile = json.loads(f.read())
+        for templateEntry in templateFile["templates"]:
+            for imageSource in templateEntry.get("images", []):
+                if not imageSource.startswith("http"):
+                    paths.append(os.path.join(subfolder, imageSource))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        # half-saved template.json, it'll be picked up again once it's complete
+        pass
+    
+    snapshot = dict()
+    for path in paths:
+        try:
+            fileStat = os.stat(path)
+            snapshot[path] = (fileStat.st_mtime_ns, fileStat.st_size)
+        except OSError:
+            snapshot[path] = None
+    return snapshot
+
+def watch(subfolder, **buildOptions):
+    """Rebuilds whenever template.json or one of its local images changes, keeping entries and layers in memory
+
+    Changes are picked up by polling and only acted on once nothing has changed for watchDebounceSeconds.
+    Remote images and Endu templates are fetched once per watch session.
+    """
+    watchState = dict()
+    snapshot = getWatchSnapshot(subfolder)
+    main(subfolder, watchState = watchState, **buildOptions)
+    print("watching {0} for changes".format(subfolder))
+    try:
+        while True:
+            time.sleep(watchPollSeconds)
+            current = getWatchSnapshot(subfolder)
+            if current == snapshot:
+                continue
+            
+            # editors often write a file in several steps, so wait for things to settle
+            while True:
+                time.sleep(watchDebounceSeconds)
+                settled = getWatchSnapshot(subfolder)
+                if settled == current:
+                    break
+                current = settled
+            snapshot = current
+            
+            print("change detected, rebuilding {0}".format(subfolder))
+            try:
+                main(subfolder, watchState = watchState, **buildOptions)
+            except Exception:
+                # whatever the failed build left behind can't be trusted, so the next one starts over
+                print("build failed, waiting for the next change\n{0}".format(traceback.format_exc()))
+                watchState.pop("build", None)
+            print("watching {0} for changes".format(subfolder))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if "build" in watchState:
+            closeLayers(watchState["build"]["layers"])
+
+def buildBatch(subfolders, **buildOptions):
+    """Builds several template folders in this process, returning the ones which failed
+
+    Entries are keyed by their source bytes, the palette and their mask settings, so an image used by
+    more than one folder is only decoded, normalized and masked once, and remote sources and Endu
+    templates are only fetched once. The outputs are the same as building each folder on its own.
+    """
+    sharedEntryStore = createMemoryEntryStore(buildOptions.get("incremental", False), buildOptions.get("jobs", 1))
     
-    updateVersion(subfolder)
+    failedFolders = []
+    for subfolder in subfolders:
+        print("building {0}".format(subfolder))
+        sharedEntryStore.startBuild(subfolder)
+        try:
+            main(subfolder, sharedEntryStore = sharedEntryStore, **buildOptions)
+        except Exception:
+            print("build of {0} failed\n{1}".format(subfolder, traceback.format_exc()))
+            failedFolders.append(subfolder)
+    print("built {0} folders, {1} entries and masks reused from memory".format(len(subfolders) - len(failedFolders), sharedEntryStore.getReuseCount()))
+    return failedFolders
 
 def palettize(path):
-  img = Image.open(path)
-  normalizeImage(img)
-  img.save(path + "palettized.png")
+  img = Image.open(path).convert("RGBA")
+  (plane, isClean) = normalizeImage(img)
+  getPlaneImage(plane).save(path + "palettized.png")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Must provide a folder containing template.json as first arg")
-        sys.exit(1)
-    if sys.argv[1].endswith(".png"):
-      palettize(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Assembles the template.json in a folder into canvas, autopick, mask and endu images")
+    parser.add_argument("folders", nargs="+", metavar="folder",
+        help="folder containing template.json, or a .png to snap to the palette; several folders are built in one go with shared caches")
+    parser.add_argument("--incremental", action="store_true",
+        help="reuse cached entries and only recomposite the regions which changed since the last incremental build")
+    parser.add_argument("--jobs", type=int, default=1,
+        help="worker processes for loading, normalizing and masking entries; 1 does everything in this process")
+    parser.add_argument("--indexed-png", action="store_true",
+        help="write palette-indexed canvas/autopick/endu images and a grayscale mask instead of RGBA")
+    parser.add_argument("--tiles", type=int, nargs="?", const=256, default=None, metavar="SIZE",
+        help="also write canvas/autopick/mask as SIZE x SIZE tiles (default 256) named by content hash, listed in tiles.json")
+    parser.add_argument("--profile", action="store_true",
+        help="write build_profile.json with the time spent in each stage for every entry")
+    parser.add_argument("--overlaps", action="store_true",
+        help="write overlap_report.json with which entries are painted over by which")
+    parser.add_argument("--watch", action="store_true",
+        help="keep running and rebuild whenever template.json or one of its local images changes")
+    parser.add_argument("--compile-timeline", action="store_true",
+        help="render the outputs at every enabled_utc boundary ahead of time and report overlapping and hidden frames")
+    parser.add_argument("--at", type=int, default=None, metavar="UTC",
+        help="build as of this UTC timestamp, straight from the compiled timeline when it's up to date")
+    parser.add_argument("--deltas", type=int, nargs="?", const=5, default=None, metavar="COUNT",
+        help="also write binary deltas to canvas/autopick/mask from each of the last COUNT versions (default 5)")
+    parser.add_argument("--plan", action="store_true",
+        help="only read image headers to check bounds, work out endu group extents and print the layer stack; exits with an error if there are problems")
+    parser.add_argument("--priority-index", action="store_true",
+        help="also write priority_index.bin, the pixels of mask.png grouped by priority with the color each should be")
+    args = parser.parse_args()
+    if args.tiles != None and args.tiles <= 0:
+        parser.error("--tiles needs a positive tile size")
+    if args.deltas != None and args.deltas <= 0:
+        parser.error("--deltas needs a positive version count")
+    
+    if args.watch and len(args.folders) > 1:
+        parser.error("--watch takes a single folder")
+    
+    if all(folder.endswith(".png") for folder in args.folders):
+      for path in args.folders:
+        palettize(path)
       sys.exit(0)
     if not os.path.isfile(".build/template_assembler/assemble_template.py"):
         print("Must be invoked from repo root")
         sys.exit(1)
-    main(sys.argv[1])
+    buildOptions = {
+        "incremental": args.incremental,
+        "jobs": args.jobs,
+        "indexedOutput": args.indexed_png,
+        "tileSize": args.tiles,
+        "deltaHistory": args.deltas,
+        "profile": args.profile,
+        "overlapReport": args.overlaps,
+        "priorityIndex": args.priority_index,
+    }
+    if args.plan:
+        problems = 0
+        for folder in args.folders:
+            problems += plan(folder, args.at)
+        sys.exit(1 if problems > 0 else 0)
+    elif args.compile_timeline:
+        for folder in args.folders:
+            compileTimeline(folder)
+    elif args.at != None:
+        staleFolders = [folder for folder in args.folders if not emitTimeline(folder, args.at, indexedOutput = args.indexed_png, tileSize = args.tiles, deltaHistory = args.deltas, priorityIndex = args.priority_index)]
+        if len(staleFolders) == 1:
+            main(staleFolders[0], atTime = args.at, **buildOptions)
+        elif len(staleFolders) > 1 and len(buildBatch(staleFolders, atTime = args.at, **buildOptions)) != 0:
+            sys.exit(1)
+    elif args.watch:
+        if args.jobs > 1:
+            print("--watch keeps entries in this process, ignoring --jobs")
+        watch(args.folders[0], **buildOptions)
+    elif len(args.folders) == 1:
+        main(args.folders[0], **buildOptions)
+    elif len(buildBatch(args.folders, **buildOptions)) != 0:
+        sys.exit(1)
@@ -0,0 +1,283 @@
+from PIL import Image
+import numpy
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import assemble_template
+import priority_index
+
+# Synthetic template folders are generated from a seed, so the same arguments give the same workload
+# on every commit. Everything is local, nothing touches the network.
+
+# animation frames are scheduled around this time instead of now, and main() is run as of it, so the
+# generated template.json is the same on every run
+workloadUtc = 1690000000
+
+def getPeakRssBytes():
+    """Returns the peak RSS of this process or its largest child, or None where that isn't available (windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peakRss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on linux, bytes on macOS
+    if sys.platform == "darwin":
+        return peakRss
+    return peakRss * 1024
+
+def getGitCommit():
+    repoRoot = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repoRoot, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--", ".build/template_assembler"], cwd=repoRoot, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": status.strip() != ""}
+
+def generateImage(rng, paletteArray, width, height, settings):
+    # art is blocky, so colors and shape come from coarse grids scaled up rather than per-pixel noise
+    colorGrid = rng.integers(0, len(paletteArray), ((height + 3) // 4, (width + 3) // 4))
+    pixels = paletteArray[numpy.repeat(numpy.repeat(colorGrid, 4, axis=0), 4, axis=1)[0:height, 0:width]].copy()
+
+    shapeGrid = rng.random(((height + 7) // 8, (width + 7) // 8))
+    shape = numpy.repeat(numpy.repeat(shapeGrid, 8, axis=0), 8, axis=1)[0:height, 0:width]
+    pixels[shape >= settings["opacity"], 3] = 0
+    opaque = pixels[:, :, 3] == 255
+
+    offPalette = opaque & (rng.random((height, width)) < settings["off_palette"])
+    pixels[offPalette, 0:3] = rng.integers(0, 256, (int(numpy.count_nonzero(offPalette)), 3))
+    semiTransparent = opaque & (rng.random((height, width)) < settings["semi_transparent"])
+    pixels[semiTransparent, 3] = rng.integers(1, 255, int(numpy.count_nonzero(semiTransparent)))
+    return Image.fromarray(pixels, "RGBA")
+
+def generateTemplateFolder(folder, settings):
+    """Writes template.json and source images for a synthetic workload into folder"""
+    rng = numpy.random.default_rng(settings["seed"])
+    paletteArray = assemble_template.getPaletteArray(assemble_template.palette)
+    os.makedirs(os.path.join(folder, "source"), exist_ok=True)
+
+    templates = []
+    for entryNumber in range(0, settings["entries"]):
+        (width, height) = rng.integers(settings["min_size"], settings["max_size"] + 1, 2)
+        x = int(rng.integers(0, max(1, assemble_template.canvasSize[0] - width)))
+        y = int(rng.integers(0, max(1, assemble_template.canvasSize[1] - height)))
+        priority = int(rng.integers(1, 11))
+        autopick = bool(rng.random() < 0.7)
+        exportGroup = None
+        if settings["export_groups"] > 0 and rng.random() < 0.5:
+            exportGroup = "group{0}".format(int(rng.integers(0, settings["export_groups"])))
+
+        # animated entries get frames at the same spot, half of them already enabled and half in the future
+        frameCount = 1
+        if entryNumber < settings["animated"]:
+            frameCount = settings["frames"]
+        for frameNumber in range(0, frameCount):
+            imageName = "entry{0}_frame{1}.png".format(entryNumber, frameNumber)
+            generateImage(rng, paletteArray, int(width), int(height), settings).save(os.path.join(folder, "source", imageName))
+            templateEntry = {
+                "name": "entry {0} frame {1}".format(entryNumber, frameNumber),
+                "images": ["source/" + imageName],
+                "x": x - assemble_template.topLeftOffset[0],
+                "y": y - assemble_template.topLeftOffset[1],
+                "priority": priority,
+                "autopick": autopick,
+            }
+            if exportGroup != None:
+                templateEntry["export_group"] = exportGroup
+            if frameCount > 1:
+                templateEntry["enabled_utc"] = workloadUtc + (frameNumber - frameCount // 2) * 600
+            templates.append(templateEntry)
+
+    # the template file lists the top layer first
+    templates.reverse()
+    templateFile = {
+        "endu_info": {"contact": "benchmark", "source_root": "https://example.invalid/", "name": "benchmark"},
+        "templates": templates,
+    }
+    with open(os.path.join(folder, "template.json"), "w", encoding="utf-8", newline='\n') as f:
+        f.write(json.dumps(templateFile, indent=4))
+
+def measure(stage, pixelCount, function, repeat):
+    """Runs function repeat times and returns wall time, peak allocation and pixels per second for it"""
+    times = []
+    for iteration in range(0, repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - started)
+    bestTime = min(times)
+
+    # RSS only ever goes up over the process, so the stage's own peak comes from one more, untimed run under
+    # tracemalloc. It covers numpy buffers too, but not the worker processes of main() with --jobs.
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        try:
+            function()
+            peakAllocated = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {
+        "stage": stage,
+        "runs": repeat,
+        "wall_seconds_min": bestTime,
+        "wall_seconds_median": statistics.median(times),
+        "pixels": pixelCount,
+        "pixels_per_second": pixelCount / bestTime if bestTime > 0 else None,
+        "peak_allocated_bytes": peakAllocated,
+    }
+
+def loadSourceImages(folder, templates):
+    images = []
+    for templateEntry in templates:
+        with Image.open(os.path.join(folder, templateEntry["images"][0])) as image:
+            images.append(image.convert("RGBA"))
+    return images
+
+def runBenchmark(settings, repeat, jobs, incremental):
+    workFolder = tempfile.mkdtemp(prefix="template_benchmark_")
+    # main() keeps entries and build manifests under cacheRoot, and the seeded workload hashes the same on
+    # every run, so a shared cache would let earlier runs serve this one. Only the lookup table is reused.
+    repoCacheRoot = assemble_template.cacheRoot
+    assemble_template.cacheRoot = os.path.join(workFolder, "cache")
+    os.makedirs(os.path.join(repoCacheRoot, "lut"), exist_ok=True)
+    os.makedirs(assemble_template.cacheRoot)
+    try:
+        os.symlink(os.path.join(repoCacheRoot, "lut"), os.path.join(assemble_template.cacheRoot, "lut"), target_is_directory=True)
+    except OSError:
+        # windows needs extra privileges for symlinks
+        shutil.copytree(os.path.join(repoCacheRoot, "lut"), os.path.join(assemble_template.cacheRoot, "lut"))
+    try:
+        templateFolder = os.path.join(workFolder, "template")
+        generateTemplateFolder(templateFolder, settings)
+        with contextlib.redirect_stdout(io.StringIO()):
+            templates = assemble_template.getTemplates(assemble_template.loadTemplate(templateFolder))
+
+        # the palette lookup table is built once per machine, that shouldn't count against any stage
+        assemble_template.findNearestPaletteIndices(numpy.zeros((1, 4), dtype=numpy.uint8))
+
+        sourceImages = loadSourceImages(templateFolder, templates)
+        sourcePixels = sum(image.width * image.height for image in sourceImages)
+        canvasPixels = assemble_template.canvasSize[0] * assemble_template.canvasSize[1]
+        results = []
+
+        def normalizeAll():
+            for image in sourceImages:
+                assemble_template.normalizeImage(image)
+        results.append(measure("normalizeImage", sourcePixels, normalizeAll, repeat))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            planes = [assemble_template.normalizeImage(image)[0] for image in sourceImages]
+
+        def maskAll():
+            for (templateEntry, plane) in zip(templates, planes):
+                assemble_template.generatePriorityMask(templateEntry, plane)
+        results.append(measure("generatePriorityMask", sourcePixels, maskAll, repeat))
+
+        for image in sourceImages:
+            image.close()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            renderEntries = [assemble_template.prepareTemplateEntry(dict(templateEntry), templateFolder) for templateEntry in templates]
+        entryImages = [assemble_template.getRenderEntryImages(renderEntry) for renderEntry in renderEntries]
+
+        layers = assemble_template.createLayers()
+        def compositeAll():
+            assemble_template.closeLayers(layers)
+            layers.update(assemble_template.createLayers())
+            for (renderEntry, images) in zip(renderEntries, entryImages):
+                assemble_template.renderTemplateEntry(renderEntry, images, layers)
+        results.append(measure("compositing", sourcePixels, compositeAll, repeat))
+
+        outputFolder = os.path.join(workFolder, "output")
+        os.makedirs(outputFolder)
+        for indexed in [False, True]:
+            def writeAll():
+                assemble_template.writeLayerPixels(assemble_template.getLayerPixels(layers), outputFolder, indexed)
+            results.append(measure("writeCanvas indexed" if indexed else "writeCanvas", canvasPixels * 3, writeAll, repeat))
+        assemble_template.closeLayers(layers)
+
+        # the first main() fills the entry cache for incremental runs, so only the later ones are timed
+        if incremental:
+            with contextlib.redirect_stdout(io.StringIO()):
+                assemble_template.main(templateFolder, incremental=True, jobs=jobs, atTime=workloadUtc)
+        def runMain():
+            assemble_template.main(templateFolder, incremental=incremental, jobs=jobs, atTime=workloadUtc)
+        results.append(measure("main", sourcePixels, runMain, repeat))
+        
+        # priority_index.bin is meant to stand in for bucketing mask.png, so it should be about as small
+        with contextlib.redirect_stdout(io.StringIO()):
+            assemble_template.main(templateFolder, jobs=jobs, atTime=workloadUtc, priorityIndex=True)
+        outputBytes = dict((fileName, os.path.getsize(os.path.join(templateFolder, fileName))) for fileName in ["mask.png", "autopick.png", "priority_index.bin"])
+        pickablePixels = len(priority_index.loadPriorityIndex(templateFolder)["pixel_indices"])
+        results.append(measure("readPriorityIndex", pickablePixels, lambda: priority_index.loadPriorityIndex(templateFolder), repeat))
+    finally:
+        assemble_template.cacheRoot = repoCacheRoot
+        shutil.rmtree(workFolder, ignore_errors=True)
+
+    return {
+        "git": getGitCommit(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "settings": settings,
+        "jobs": jobs,
+        "incremental": incremental,
+        "source_pixels": sourcePixels,
+        "output_bytes": outputBytes,
+        "stages": results,
+        "peak_rss_bytes": getPeakRssBytes(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the template assembler on a generated workload and print the results as JSON")
+    parser.add_argument("--entries", type=int, default=40, help="number of template entries")
+    parser.add_argument("--min-size", type=int, default=32, help="smallest entry width/height")
+    parser.add_argument("--max-size", type=int, default=256, help="largest entry width/height")
+    parser.add_argument("--opacity", type=float, default=0.7, help="share of each image which is opaque")
+    parser.add_argument("--off-palette", type=float, default=0.02, help="share of opaque pixels with a random color")
+    parser.add_argument("--semi-transparent", type=float, default=0.01, help="share of opaque pixels with a random alpha")
+    parser.add_argument("--export-groups", type=int, default=3, help="number of endu export groups, half the entries are put in one")
+    parser.add_argument("--animated", type=int, default=2, help="number of entries which are animated")
+    parser.add_argument("--frames", type=int, default=6, help="frames per animated entry")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the generated workload")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage; the fastest and median times are reported")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes for main()")
+    parser.add_argument("--incremental", action="store_true", help="time main() as an incremental rebuild with nothing changed")
+    parser.add_argument("--output", default=None, help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    if args.min_size <= 0 or args.max_size < args.min_size:
+        parser.error("sizes must be positive with --min-size <= --max-size")
+    if args.repeat <= 0:
+        parser.error("--repeat must be positive")
+
+    settings = {
+        "entries": args.entries,
+        "min_size": args.min_size,
+        "max_size": args.max_size,
+        "opacity": args.opacity,
+        "off_palette": args.off_palette,
+        "semi_transparent": args.semi_transparent,
+        "export_groups": args.export_groups,
+        "animated": args.animated,
+        "frames": args.frames,
+        "seed": args.seed,
+    }
+    report = json.dumps(runBenchmark(settings, args.repeat, args.jobs, args.incremental), indent=4)
+    if args.output != None:
+        with open(args.output, "w", encoding="utf-8", newline='\n') as f:
+            f.write(report)
+    else:
+        print(report)
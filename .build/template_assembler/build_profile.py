@@ -0,0 +1,112 @@
+import contextlib
+import json
+import threading
+import time
+
+profileFormatVersion = 1
+
+# handed out for every stage while profiling is off, so instrumented code only pays for a method call
+disabledStage = contextlib.nullcontext()
+
+class StageTimer:
+    def __init__(self, profile, entryName, stageName):
+        self.profile = profile
+        self.entryName = entryName
+        self.stageName = stageName
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.profile.addTime(self.entryName, self.stageName, time.perf_counter() - self.started)
+        return False
+
+class BuildProfile:
+    """Wall time per stage and counters (bytes, pixels) for each template entry and for the build as a whole
+
+    Entries are keyed by name, so entries sharing a name are added together. Pass None as the entry
+    name for work that isn't tied to one entry.
+    """
+
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.entries = dict()
+
+    def getRecord(self, entryName):
+        if not entryName in self.entries:
+            self.entries[entryName] = {"stages": dict(), "counters": dict()}
+        return self.entries[entryName]
+
+    def stage(self, entryName, stageName):
+        if not self.enabled:
+            return disabledStage
+        return StageTimer(self, entryName, stageName)
+
+    def addTime(self, entryName, stageName, seconds):
+        with self.lock:
+            stages = self.getRecord(entryName)["stages"]
+            stages[stageName] = stages.get(stageName, 0.0) + seconds
+
+    def count(self, entryName, counterName, amount):
+        if not self.enabled:
+            return
+        with self.lock:
+            counters = self.getRecord(entryName)["counters"]
+            counters[counterName] = counters.get(counterName, 0) + amount
+
+    def getRecords(self):
+        """Returns everything recorded so far as plain data, e.g. to send back from a worker process"""
+        with self.lock:
+            return json.loads(json.dumps([[entryName, record] for (entryName, record) in self.entries.items()]))
+
+    def merge(self, records):
+        for (entryName, record) in records:
+            for (stageName, seconds) in record["stages"].items():
+                self.addTime(entryName, stageName, seconds)
+            for (counterName, amount) in record["counters"].items():
+                self.count(entryName, counterName, amount)
+
+    def getReport(self, topCount = 10):
+        entries = []
+        stageTotals = dict()
+        counterTotals = dict()
+        entryStages = []
+        for (entryName, record) in self.entries.items():
+            for (counterName, amount) in record["counters"].items():
+                counterTotals[counterName] = counterTotals.get(counterName, 0) + amount
+            # build stages can contain entry stages, e.g. compositing during an incremental render
+            if entryName == None:
+                continue
+            for (stageName, seconds) in record["stages"].items():
+                stageTotals[stageName] = stageTotals.get(stageName, 0.0) + seconds
+            entries.append({
+                "name": entryName,
+                "seconds": sum(record["stages"].values()),
+                "stages": record["stages"],
+                "counters": record["counters"],
+            })
+            for (stageName, seconds) in record["stages"].items():
+                entryStages.append({"name": entryName, "stage": stageName, "seconds": seconds})
+
+        entries.sort(key=lambda entry: entry["seconds"], reverse=True)
+        entryStages.sort(key=lambda entryStage: entryStage["seconds"], reverse=True)
+        build = self.entries.get(None, {"stages": dict(), "counters": dict()})
+        return {
+            "version": profileFormatVersion,
+            "wall_seconds": time.perf_counter() - self.started,
+            "stages": dict(sorted(stageTotals.items(), key=lambda item: item[1], reverse=True)),
+            "counters": counterTotals,
+            "build": build,
+            "top_entries": [{"name": entry["name"], "seconds": entry["seconds"]} for entry in entries[0:topCount]],
+            "top_entry_stages": entryStages[0:topCount],
+            "entries": entries,
+        }
+
+    def write(self, path, topCount = 10):
+        report = self.getReport(topCount)
+        with open(path, "w", encoding="utf-8", newline='\n') as f:
+            f.write(json.dumps(report, indent=4))
+        return report
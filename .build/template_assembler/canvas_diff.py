@@ -0,0 +1,172 @@
+from PIL import Image
+import numpy
+import argparse
+import json
+import os
+import time
+
+import assemble_template
+
+# The same diff and priority pick as CanvasComparer in src/canvasComparer.ts, over whole arrays instead of
+# pixel by pixel, so bots and analytics can run it outside of the browser.
+#
+# Pixels are numbered row by row over the snapshot. Coordinates are image pixels, subtract topLeftOffset
+# to get r/place coordinates.
+
+# keep in sync with FOCUS_AREA_SIZE in src/canvasComparer.ts
+focusAreaSize = 75
+
+def loadPixels(path):
+    with Image.open(path) as image:
+        return numpy.array(image.convert("RGBA"))
+
+def fitPixels(pixels, width, height):
+    """Crops or pads (with transparent pixels) pixels to width x height, like drawing it at 0, 0 on a canvas that size"""
+    if pixels.shape[0:2] == (height, width):
+        return pixels
+    fitted = numpy.zeros((height, width, pixels.shape[2]), dtype=pixels.dtype)
+    copyHeight = min(height, pixels.shape[0])
+    copyWidth = min(width, pixels.shape[1])
+    fitted[0:copyHeight, 0:copyWidth] = pixels[0:copyHeight, 0:copyWidth]
+    return fitted
+
+def computeDiff(templatePixels, snapshotPixels):
+    """Returns (indices of the wrong pixels, count of all pixels) for template and snapshot RGBA arrays of the same size
+
+    A pixel counts when it's visible in both the template and the snapshot, and it's wrong when its color differs.
+    """
+    templateFlat = templatePixels.reshape(-1, 4)
+    snapshotFlat = snapshotPixels.reshape(-1, 4)
+    counted = (templateFlat[:, 3] != 0) & (snapshotFlat[:, 3] != 0)
+    wrong = counted & numpy.any(templateFlat[:, 0:3] != snapshotFlat[:, 0:3], axis=1)
+    return (numpy.flatnonzero(wrong), int(numpy.count_nonzero(counted)))
+
+class PixelPicker:
+    """Picks wrong pixels the way CanvasComparer.selectRandomPixelFromDiff does, with the buckets built once
+
+    Wrong pixels are grouped by their mask priority (the green channel, 0 is never picked), highest first.
+    A pick takes a position in the first focusAreaSize pixels of those buckets and returns any pixel of the
+    bucket that position falls in. If the mask is completely empty, every wrong pixel is equally likely.
+    """
+
+    def __init__(self, wrongIndices, maskPixels, width, seed = None):
+        self.width = width
+        self.rng = numpy.random.default_rng(seed)
+        wrongIndices = numpy.asarray(wrongIndices, dtype=numpy.int64)
+
+        if maskPixels is None or not numpy.any(maskPixels):
+            self.weighted = False
+            self.pool = wrongIndices
+            self.priorities = numpy.zeros(0, dtype=numpy.uint8)
+            self.bucketStarts = numpy.zeros(0, dtype=numpy.int64)
+            self.bucketSizes = numpy.zeros(0, dtype=numpy.int64)
+            self.focusSize = len(wrongIndices)
+            return
+
+        self.weighted = True
+        priorities = maskPixels.reshape(-1, maskPixels.shape[-1])[:, 1][wrongIndices]
+        available = priorities != 0
+        priorities = priorities[available]
+        # stable, so each bucket keeps its pixels in diff order
+        order = numpy.argsort(-priorities.astype(numpy.int16), kind="stable")
+        self.pool = wrongIndices[available][order]
+        sortedPriorities = priorities[order]
+        self.bucketStarts = numpy.flatnonzero(numpy.concatenate(([True], sortedPriorities[1:] != sortedPriorities[:-1]))).astype(numpy.int64)
+        if len(self.pool) == 0:
+            self.bucketStarts = numpy.zeros(0, dtype=numpy.int64)
+        self.bucketSizes = numpy.diff(numpy.concatenate((self.bucketStarts, [len(self.pool)])))
+        self.priorities = sortedPriorities[self.bucketStarts]
+        self.focusSize = min(focusAreaSize, len(self.pool))
+
+    def getBuckets(self):
+        """Returns (priority, pixel count) for every bucket, highest priority first"""
+        return [(int(priority), int(size)) for (priority, size) in zip(self.priorities, self.bucketSizes)]
+
+    def pickIndices(self, count = 1):
+        """Returns count picked pixel indices, or an empty array if there's nothing to pick"""
+        if self.focusSize == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        if not self.weighted:
+            return self.pool[self.rng.integers(0, len(self.pool), count)]
+
+        positions = self.rng.integers(0, self.focusSize, count)
+        buckets = numpy.searchsorted(self.bucketStarts, positions, side="right") - 1
+        offsets = (self.rng.random(count) * self.bucketSizes[buckets]).astype(numpy.int64)
+        return self.pool[self.bucketStarts[buckets] + offsets]
+
+    def pick(self, count = 1):
+        """Returns count picked (x, y) pixels"""
+        indices = self.pickIndices(count)
+        return [(int(x), int(y)) for (y, x) in zip(*numpy.divmod(indices, self.width))]
+
+def loadDiff(subfolder, snapshotPath, templateName = "canvas", seed = None):
+    """Diffs the assembled template in subfolder against a snapshot PNG and returns the counts and a picker"""
+    snapshotPixels = loadPixels(snapshotPath)
+    (height, width) = snapshotPixels.shape[0:2]
+    templatePixels = fitPixels(loadPixels(os.path.join(subfolder, templateName + ".png")), width, height)
+    maskPath = os.path.join(subfolder, "mask.png")
+    maskPixels = None
+    if os.path.exists(maskPath):
+        maskPixels = fitPixels(loadPixels(maskPath), width, height)
+
+    (wrongIndices, countOfAllPixels) = computeDiff(templatePixels, snapshotPixels)
+    return {
+        "width": width,
+        "height": height,
+        "count_of_all_pixels": countOfAllPixels,
+        "count_of_wrong_pixels": len(wrongIndices),
+        "count_of_right_pixels": countOfAllPixels - len(wrongIndices),
+        "wrong_indices": wrongIndices,
+        "picker": PixelPicker(wrongIndices, maskPixels, width, seed),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare an assembled template against a canvas snapshot and pick pixels to fix")
+    parser.add_argument("folder", help="template folder with canvas.png and mask.png, e.g. templates/mlp")
+    parser.add_argument("snapshot", help="PNG of the canvas, the size of the expanded canvas")
+    parser.add_argument("--autopick", action="store_true", help="compare against autopick.png instead of canvas.png")
+    parser.add_argument("--picks", type=int, default=10, help="number of pixels to pick")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the picks")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    if args.picks < 0:
+        parser.error("--picks can't be negative")
+
+    started = time.perf_counter()
+    diff = loadDiff(args.folder, args.snapshot, "autopick" if args.autopick else "canvas", args.seed)
+    diffSeconds = time.perf_counter() - started
+    picker = diff["picker"]
+    started = time.perf_counter()
+    picks = picker.pick(args.picks)
+    pickSeconds = time.perf_counter() - started
+
+    completion = None
+    if diff["count_of_all_pixels"] > 0:
+        completion = diff["count_of_right_pixels"] / diff["count_of_all_pixels"]
+    placePicks = [(x - assemble_template.topLeftOffset[0], y - assemble_template.topLeftOffset[1]) for (x, y) in picks]
+
+    if args.json:
+        print(json.dumps({
+            "count_of_all_pixels": diff["count_of_all_pixels"],
+            "count_of_wrong_pixels": diff["count_of_wrong_pixels"],
+            "count_of_right_pixels": diff["count_of_right_pixels"],
+            "completion": completion,
+            "weighted": picker.weighted,
+            "buckets": picker.getBuckets(),
+            "picks": [{"x": x, "y": y, "place_x": placeX, "place_y": placeY} for ((x, y), (placeX, placeY)) in zip(picks, placePicks)],
+            "diff_seconds": diffSeconds,
+            "pick_seconds": pickSeconds,
+        }, indent=4))
+    else:
+        if completion == None:
+            print("Nothing to compare, the template and the snapshot don't overlap")
+        else:
+            print("{0:.3%} done ({1}/{2}), {3} wrong pixels, diffed in {4:.3f}s".format(completion, diff["count_of_right_pixels"], diff["count_of_all_pixels"], diff["count_of_wrong_pixels"], diffSeconds))
+        if picker.weighted:
+            print("Priority buckets: {0}".format(", ".join("{0}: {1}".format(priority, size) for (priority, size) in picker.getBuckets())))
+        if args.picks > 0 and len(picks) == 0:
+            print("No pixel to pick")
+        for ((x, y), (placeX, placeY)) in zip(picks, placePicks):
+            print("Pick image ({0}, {1}), r/place ({2}, {3})".format(x, y, placeX, placeY))
@@ -0,0 +1,225 @@
+from PIL import Image
+import numpy
+import hashlib
+import os
+import struct
+import sys
+import zlib
+
+# Delta files patch the canvas/autopick/mask images of one template version into the next.
+#
+# header (little endian, uncompressed):
+#   magic "TDLT", format version u16, from version u32, to version u32, width u32, height u32, layer count u16
+# followed by one zlib stream holding, for each layer:
+#   name length u8, name (utf-8), kind u8 (0 = color table, 1 = gray)
+#   sha256 of the base RGBA pixels (first 16 bytes), sha256 of the patched RGBA pixels (first 16 bytes)
+#   kind 0 only: color count u32, colors as RGBA bytes; values are u8 indices, or u16 with more than 256 colors
+#   kind 1 only: values are u8 gray levels, written as (v, v, v, 255)
+#   span count u32, gaps u32[span count], lengths u32[span count], values for every pixel in the spans
+# Pixels are numbered row by row. Each span starts gap pixels after the end of the previous one (or 0).
+#
+# Every layer is palette colors plus transparent, so a color table never has more than 256 colors. It's
+# still carried in each delta instead of indexing the assembler's palette: clients don't have that palette,
+# and r/place changed it during the event (see palettes in assemble_template.py), so a delta from a version
+# built with an older palette has to name colors the current one doesn't have. The table is at most a few
+# hundred bytes per layer. The u16 indices are only there for images that aren't from the assembler.
+
+deltaMagic = b"TDLT"
+deltaFormatVersion = 1
+headerFormat = "<4sHIIIIH"
+
+# unchanged runs this short are cheaper to resend than to start a new span for
+defaultMergeGap = 4
+
+class DeltaError(ValueError):
+    pass
+
+def getPixelHash(pixels):
+    return hashlib.sha256(numpy.ascontiguousarray(pixels, dtype=numpy.uint8).tobytes()).digest()[0:16]
+
+def findSpans(changed, mergeGap):
+    """Returns (starts, ends) of the runs of True in a flat bool array, joining runs mergeGap or less apart"""
+    padded = numpy.concatenate(([False], changed, [False]))
+    edges = numpy.flatnonzero(padded[1:] != padded[:-1])
+    starts = edges[0::2]
+    ends = edges[1::2]
+    if len(starts) > 1 and mergeGap > 0:
+        keep = (starts[1:] - ends[:-1]) > mergeGap
+        starts = numpy.concatenate((starts[0:1], starts[1:][keep]))
+        ends = numpy.concatenate((ends[:-1][keep], ends[-1:]))
+    return (starts, ends)
+
+def getSpanPixels(starts, ends, pixelCount):
+    marks = numpy.zeros(pixelCount + 1, dtype=numpy.int32)
+    numpy.add.at(marks, starts, 1)
+    numpy.add.at(marks, ends, -1)
+    return numpy.cumsum(marks[:-1]) > 0
+
+def encodeLayer(name, basePixels, newPixels, mergeGap):
+    baseFlat = numpy.ascontiguousarray(basePixels).reshape(-1, 4)
+    newFlat = numpy.ascontiguousarray(newPixels).reshape(-1, 4)
+    (starts, ends) = findSpans(numpy.any(baseFlat != newFlat, axis=1), mergeGap)
+    values = newFlat[getSpanPixels(starts, ends, len(newFlat))]
+
+    nameBytes = name.encode("utf-8")
+    isGray = bool(numpy.all((values[:, 0] == values[:, 1]) & (values[:, 0] == values[:, 2]) & (values[:, 3] == 255)))
+    parts = [
+        struct.pack("<B", len(nameBytes)),
+        nameBytes,
+        struct.pack("<B", 1 if isGray else 0),
+        getPixelHash(basePixels),
+        getPixelHash(newPixels),
+    ]
+    if isGray:
+        encodedValues = values[:, 0].tobytes()
+    else:
+        (colors, indices) = numpy.unique(values.view(numpy.uint32).reshape(-1), return_inverse=True)
+        parts.append(struct.pack("<I", len(colors)))
+        parts.append(colors.view(numpy.uint8).tobytes())
+        indexType = "<u1" if len(colors) <= 256 else "<u2"
+        encodedValues = indices.reshape(-1).astype(indexType).tobytes()
+
+    previousEnds = numpy.concatenate(([0], ends[:-1]))
+    parts.append(struct.pack("<I", len(starts)))
+    parts.append((starts - previousEnds).astype("<u4").tobytes())
+    parts.append((ends - starts).astype("<u4").tobytes())
+    parts.append(encodedValues)
+    return b"".join(parts)
+
+def encodeDelta(fromVersion, toVersion, baseLayers, newLayers, mergeGap = defaultMergeGap):
+    """Encodes the changes from baseLayers to newLayers, dicts of name -> (height, width, 4) uint8 RGBA arrays"""
+    names = sorted(newLayers.keys())
+    (height, width) = newLayers[names[0]].shape[0:2]
+    body = b"".join(encodeLayer(name, baseLayers[name], newLayers[name], mergeGap) for name in names)
+    header = struct.pack(headerFormat, deltaMagic, deltaFormatVersion, fromVersion, toVersion, width, height, len(names))
+    return header + zlib.compress(body, 9)
+
+class DeltaReader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset + size > len(self.data):
+            raise DeltaError("delta is truncated")
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+    def unpack(self, format):
+        return struct.unpack(format, self.read(struct.calcsize(format)))
+
+    def readArray(self, dtype, count):
+        dtype = numpy.dtype(dtype)
+        return numpy.frombuffer(self.read(dtype.itemsize * count), dtype=dtype)
+
+def readDeltaHeader(deltaBytes):
+    headerSize = struct.calcsize(headerFormat)
+    if len(deltaBytes) < headerSize:
+        raise DeltaError("delta is truncated")
+    (magic, formatVersion, fromVersion, toVersion, width, height, layerCount) = struct.unpack(headerFormat, deltaBytes[0:headerSize])
+    if magic != deltaMagic or formatVersion != deltaFormatVersion:
+        raise DeltaError("not a version {0} delta".format(deltaFormatVersion))
+    return {
+        "from_version": fromVersion,
+        "to_version": toVersion,
+        "width": width,
+        "height": height,
+        "layer_count": layerCount,
+        "header_size": headerSize,
+    }
+
+def applyDelta(deltaBytes, baseLayers):
+    """Reference decoder: patches baseLayers (name -> (height, width, 4) uint8 RGBA arrays) into new arrays
+
+    Raises DeltaError if the base images aren't the ones the delta was made from, or the result doesn't
+    match the hashes recorded in the delta.
+    """
+    header = readDeltaHeader(deltaBytes)
+    try:
+        reader = DeltaReader(zlib.decompress(deltaBytes[header["header_size"]:]))
+    except zlib.error as e:
+        raise DeltaError("delta body is corrupt: {0}".format(e))
+
+    newLayers = dict()
+    for layerNumber in range(0, header["layer_count"]):
+        (nameLength,) = reader.unpack("<B")
+        name = reader.read(nameLength).decode("utf-8")
+        (kind,) = reader.unpack("<B")
+        baseHash = reader.read(16)
+        newHash = reader.read(16)
+
+        if not name in baseLayers:
+            raise DeltaError("no base image for {0}".format(name))
+        basePixels = baseLayers[name]
+        if basePixels.shape != (header["height"], header["width"], 4) or getPixelHash(basePixels) != baseHash:
+            raise DeltaError("{0} is not the image this delta was made from".format(name))
+
+        if kind == 0:
+            (colorCount,) = reader.unpack("<I")
+            colors = reader.readArray(numpy.uint8, colorCount * 4).reshape(-1, 4)
+            indexType = "<u1" if colorCount <= 256 else "<u2"
+        elif kind != 1:
+            raise DeltaError("unknown layer kind {0}".format(kind))
+
+        (spanCount,) = reader.unpack("<I")
+        gaps = reader.readArray("<u4", spanCount)
+        lengths = reader.readArray("<u4", spanCount)
+        valueCount = int(numpy.sum(lengths, dtype=numpy.uint64))
+        if kind == 0:
+            indices = reader.readArray(indexType, valueCount)
+            if valueCount != 0 and int(indices.max()) >= colorCount:
+                raise DeltaError("{0} refers to a color outside of its table".format(name))
+            values = colors[indices]
+        else:
+            levels = reader.readArray(numpy.uint8, valueCount)
+            values = numpy.empty((valueCount, 4), dtype=numpy.uint8)
+            values[:, 0:3] = levels[:, numpy.newaxis]
+            values[:, 3] = 255
+
+        pixels = numpy.array(basePixels, dtype=numpy.uint8).reshape(-1, 4)
+        position = 0
+        valueOffset = 0
+        for (gap, length) in zip(gaps.tolist(), lengths.tolist()):
+            position += gap
+            if position + length > len(pixels):
+                raise DeltaError("{0} has a span past the end of the image".format(name))
+            pixels[position:position + length] = values[valueOffset:valueOffset + length]
+            position += length
+            valueOffset += length
+
+        pixels = pixels.reshape(basePixels.shape)
+        if getPixelHash(pixels) != newHash:
+            raise DeltaError("{0} doesn't match after patching".format(name))
+        newLayers[name] = pixels
+    return newLayers
+
+def loadLayers(folder, names):
+    layers = dict()
+    for name in names:
+        with Image.open(os.path.join(folder, name + ".png")) as image:
+            layers[name] = numpy.array(image.convert("RGBA"))
+    return layers
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("usage: delta_patch.py <folder with the old images> <delta file> <output folder>")
+        sys.exit(1)
+
+    (baseFolder, deltaPath, outputFolder) = sys.argv[1:4]
+    with open(deltaPath, "rb") as f:
+        deltaBytes = f.read()
+
+    header = readDeltaHeader(deltaBytes)
+    names = ["canvas", "autopick", "mask"]
+    try:
+        newLayers = applyDelta(deltaBytes, loadLayers(baseFolder, names))
+    except DeltaError as e:
+        print("can't apply {0}: {1}".format(deltaPath, e))
+        sys.exit(1)
+
+    os.makedirs(outputFolder, exist_ok=True)
+    for (name, pixels) in newLayers.items():
+        Image.fromarray(pixels, "RGBA").save(os.path.join(outputFolder, name + ".png"))
+    print("patched version {0} to version {1}".format(header["from_version"], header["to_version"]))
@@ -0,0 +1,282 @@
+import collections
+import concurrent.futures
+import http.client
+import threading
+import time
+import urllib.parse
+
+defaultHeaders = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/113.0",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+}
+
+redirectStatuses = set([301, 302, 303, 307, 308])
+
+class FetchError(Exception):
+    def __init__(self, url, status):
+        super().__init__("HTTP {0} for {1}".format(status, url))
+        self.url = url
+        self.status = status
+
+    def isRetryable(self):
+        return self.status == 429 or self.status >= 500
+
+class HostPool:
+    """Keep-alive connections to one scheme://host:port, at most maxConnections in use at once
+
+    URLs for the host wait in pending until one of its slots is free, so they never hold a worker thread
+    while they wait. active and pending belong to the Fetcher and are guarded by its lock.
+    """
+
+    def __init__(self, scheme, netloc, maxConnections, timeout):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.maxConnections = maxConnections
+        self.active = 0
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def connect(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def acquire(self):
+        with self.lock:
+            if len(self.idle) != 0:
+                return (self.idle.pop(), True)
+        return (self.connect(), False)
+
+    def release(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+class Fetcher:
+    """Downloads URLs on a bounded thread pool, reusing connections per host
+
+    Every URL is fetched at most once; prefetch() starts downloads in the background and
+    fetch() waits for (or starts) one and returns the body. Failures are raised from fetch().
+    fetchPrefix() only asks for the start of a body, e.g. to read an image header.
+    URLs are only handed to the shared workers once their host has a free slot, so a slow host
+    can't tie up the workers that other hosts are waiting for.
+
+    With an HttpCache, cached copies are revalidated with If-None-Match/If-Modified-Since and
+    served stale when the host can't be reached or keeps failing.
+    """
+
+    def __init__(self, maxWorkers = 16, maxPerHost = 4, timeout = 5, retries = 3, backoff = 0.5, headers = defaultHeaders, cache = None):
+        self.cache = cache
+        self.maxPerHost = maxPerHost
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = headers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="fetch")
+        self.lock = threading.Lock()
+        self.hostPools = dict()
+        self.futures = dict()
+        self.bytesDownloaded = 0
+        self.closed = False
+
+    def getHostPool(self, scheme, netloc):
+        with self.lock:
+            return self.getHostPoolLocked(scheme, netloc)
+
+    def getHostPoolLocked(self, scheme, netloc):
+        key = (scheme, netloc)
+        if not key in self.hostPools:
+            self.hostPools[key] = HostPool(scheme, netloc, self.maxPerHost, self.timeout)
+        return self.hostPools[key]
+
+    def submit(self, url, byteCount = None):
+        key = url
+        if byteCount != None:
+            key = (url, byteCount)
+        with self.lock:
+            if not key in self.futures:
+                parsed = urllib.parse.urlsplit(url)
+                pool = self.getHostPoolLocked(parsed.scheme, parsed.netloc)
+                future = concurrent.futures.Future()
+                self.futures[key] = future
+                pool.pending.append((url, byteCount, future))
+                self.startPending(pool)
+            return self.futures[key]
+
+    def startPending(self, pool):
+        # with self.lock held
+        while not self.closed and pool.active < pool.maxConnections and len(pool.pending) != 0:
+            (url, byteCount, future) = pool.pending.popleft()
+            pool.active += 1
+            self.executor.submit(self.runFetch, pool, url, byteCount, future)
+
+    def takeSlot(self, pool):
+        with self.lock:
+            pool.active += 1
+
+    def releaseSlot(self, pool):
+        with self.lock:
+            pool.active -= 1
+            self.startPending(pool)
+
+    def runFetch(self, pool, url, byteCount, future):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.fetchWithRetries(url, pool, byteCount))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            self.releaseSlot(pool)
+
+    def prefetch(self, urls):
+        for url in urls:
+            self.submit(url)
+
+    def fetch(self, url):
+        return self.submit(url).result()
+
+    def fetchPrefix(self, url, byteCount):
+        """Returns the first byteCount bytes of url (fewer if the body is shorter)
+
+        Only that much is downloaded, with a Range request if the host supports them and by hanging up
+        early if it doesn't. A body that's already cached or fetched is used instead. Prefixes aren't cached.
+        """
+        with self.lock:
+            future = self.futures.get(url)
+        if future != None and future.done() and future.exception() == None:
+            return future.result()[0:byteCount]
+        return self.submit(url, byteCount).result()
+
+    def fetchWithRetries(self, url, heldPool = None, byteCount = None):
+        cached = None
+        if self.cache != None:
+            cached = self.cache.lookup(url)
+        
+        headers = dict(self.headers)
+        if byteCount != None:
+            if cached != None:
+                return cached[1][0:byteCount]
+            headers["Range"] = "bytes=0-{0}".format(byteCount - 1)
+        elif cached != None:
+            info = cached[0]
+            if info["etag"]:
+                headers["If-None-Match"] = info["etag"]
+            if info["last_modified"]:
+                headers["If-Modified-Since"] = info["last_modified"]
+        
+        attempt = 0
+        while True:
+            try:
+                (status, responseHeaders, body) = self.request(url, headers, heldPool, byteCount)
+                break
+            except FetchError as e:
+                if not e.isRetryable():
+                    raise
+                failure = e
+            except (OSError, http.client.HTTPException) as e:
+                failure = e
+            if attempt >= self.retries:
+                if cached != None:
+                    print("serving stale copy of {0} after: {1}".format(url, failure))
+                    return cached[1]
+                raise failure
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+        
+        if status == 304 and cached != None:
+            return cached[1]
+        with self.lock:
+            self.bytesDownloaded += len(body)
+        if byteCount != None:
+            return body[0:byteCount]
+        if self.cache != None:
+            self.cache.store(url, body, responseHeaders.get("ETag"), responseHeaders.get("Last-Modified"))
+        return body
+
+    def request(self, url, headers, heldPool = None, byteCount = None, redirectsLeft = 5):
+        parsed = urllib.parse.urlsplit(url)
+        if not parsed.scheme in ["http", "https"]:
+            raise ValueError("unsupported url {0}".format(url))
+        target = parsed.path or "/"
+        if parsed.query:
+            target += "?" + parsed.query
+
+        pool = self.getHostPool(parsed.scheme, parsed.netloc)
+        if pool is heldPool:
+            (status, responseHeaders, body) = self.requestOnPool(pool, target, headers, byteCount)
+        else:
+            # a redirect to another host; waiting for one of its slots would hold this worker, so it's counted without waiting
+            self.takeSlot(pool)
+            try:
+                (status, responseHeaders, body) = self.requestOnPool(pool, target, headers, byteCount)
+            finally:
+                self.releaseSlot(pool)
+
+        location = responseHeaders.get("Location")
+        if status in redirectStatuses and location:
+            if redirectsLeft == 0:
+                raise FetchError(url, status)
+            # validators are for the final document, so they travel along with the redirect
+            return self.request(urllib.parse.urljoin(url, location), headers, heldPool, byteCount, redirectsLeft - 1)
+        if status >= 400:
+            raise FetchError(url, status)
+        return (status, responseHeaders, body)
+
+    def requestOnPool(self, pool, target, headers, byteCount = None):
+        (connection, reused) = pool.acquire()
+        try:
+            connection.request("GET", target, headers=headers)
+            response = connection.getresponse()
+            body = self.readBody(response, byteCount)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            if not reused:
+                raise
+            # the server dropped an idle keep-alive connection, that doesn't count as a failed attempt
+            connection = pool.connect()
+            try:
+                connection.request("GET", target, headers=headers)
+                response = connection.getresponse()
+                body = self.readBody(response, byteCount)
+            except:
+                connection.close()
+                raise
+        except:
+            connection.close()
+            raise
+
+        if response.will_close or not response.isclosed():
+            # the rest of a body the host sent despite the Range isn't wanted, so the connection can't be reused
+            connection.close()
+        else:
+            pool.release(connection)
+        responseHeaders = dict()
+        for headerName in ["Location", "ETag", "Last-Modified"]:
+            responseHeaders[headerName] = response.getheader(headerName)
+        return (response.status, responseHeaders, body)
+
+    def readBody(self, response, byteCount):
+        if byteCount == None:
+            return response.read()
+        return response.read(byteCount)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            # whatever is still waiting for a slot won't be needed any more
+            for pool in self.hostPools.values():
+                for (url, byteCount, future) in pool.pending:
+                    future.cancel()
+                pool.pending.clear()
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for pool in self.hostPools.values():
+                pool.close()
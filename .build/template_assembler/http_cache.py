@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import threading
+
+class HttpCache:
+    """Response bodies on disk along with their validators, evicted least recently used first
+
+    Each URL gets a .body file and a .json file with the URL, ETag and Last-Modified. The .json
+    file's mtime is bumped on every use and drives eviction once the folder exceeds maxBytes.
+    """
+
+    def __init__(self, cacheFolder, maxBytes = 512 * 1024 * 1024):
+        self.cacheFolder = cacheFolder
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.totalBytes = None
+
+    def getPaths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        folder = os.path.join(self.cacheFolder, key[0:2])
+        return (os.path.join(folder, key + ".body"), os.path.join(folder, key + ".json"))
+
+    def lookup(self, url):
+        """Returns (info, body) for a cached URL or None"""
+        (bodyPath, infoPath) = self.getPaths(url)
+        try:
+            with open(infoPath, "r", encoding="utf-8") as f:
+                info = json.loads(f.read())
+            with open(bodyPath, "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if info.get("url") != url or info.get("size") != len(body):
+            return None
+        self.touch(url)
+        return (info, body)
+
+    def touch(self, url):
+        (bodyPath, infoPath) = self.getPaths(url)
+        try:
+            os.utime(infoPath)
+        except OSError:
+            pass
+
+    def store(self, url, body, etag, lastModified):
+        (bodyPath, infoPath) = self.getPaths(url)
+        os.makedirs(os.path.dirname(bodyPath), exist_ok=True)
+        info = {
+            "url": url,
+            "etag": etag,
+            "last_modified": lastModified,
+            "size": len(body),
+        }
+
+        # other threads may be reading, so only ever swap complete files into place
+        suffix = ".{0}.tmp".format(threading.get_ident())
+        with open(bodyPath + suffix, "wb") as f:
+            f.write(body)
+        with open(infoPath + suffix, "w", encoding="utf-8", newline='\n') as f:
+            f.write(json.dumps(info))
+        os.replace(bodyPath + suffix, bodyPath)
+        os.replace(infoPath + suffix, infoPath)
+
+        with self.lock:
+            if self.totalBytes == None:
+                self.totalBytes = self.measure()
+            else:
+                self.totalBytes += len(body)
+            if self.totalBytes > self.maxBytes:
+                self.totalBytes = self.evict()
+
+    def listEntries(self):
+        entries = []
+        if not os.path.isdir(self.cacheFolder):
+            return entries
+        for (folder, subfolders, files) in os.walk(self.cacheFolder):
+            for fileName in files:
+                if not fileName.endswith(".json"):
+                    continue
+                infoPath = os.path.join(folder, fileName)
+                bodyPath = infoPath[:-len(".json")] + ".body"
+                try:
+                    entries.append((os.path.getmtime(infoPath), os.path.getsize(bodyPath), bodyPath, infoPath))
+                except OSError:
+                    pass
+        return entries
+
+    def measure(self):
+        return sum(size for (lastUsed, size, bodyPath, infoPath) in self.listEntries())
+
+    def evict(self):
+        entries = sorted(self.listEntries())
+        totalBytes = sum(size for (lastUsed, size, bodyPath, infoPath) in entries)
+        for (lastUsed, size, bodyPath, infoPath) in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            for path in [infoPath, bodyPath]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            totalBytes -= size
+        return totalBytes
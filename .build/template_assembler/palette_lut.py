@@ -0,0 +1,120 @@
+from colorspacious import cspace_convert
+import numpy
+import hashlib
+import os
+import sys
+import tempfile
+
+# bump when the table layout or the distance metric changes so old files are never reused
+lutFormatVersion = 1
+
+defaultLutFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "lut")
+
+loadedLuts = dict()
+
+def getPaletteHash(paletteArray):
+    digest = hashlib.sha256()
+    digest.update("rgb-lut-v{0}".format(lutFormatVersion).encode("utf-8"))
+    digest.update(numpy.ascontiguousarray(paletteArray, dtype=numpy.uint8).tobytes())
+    return digest.hexdigest()[0:24]
+
+def getLutPaths(lutFolder, paletteHash):
+    return (
+        os.path.join(lutFolder, paletteHash + ".index.npy"),
+        os.path.join(lutFolder, paletteHash + ".delta.npy"),
+    )
+
+def createTempPath(lutFolder, paletteHash):
+    (fileDescriptor, tempPath) = tempfile.mkstemp(prefix=paletteHash + ".", suffix=".tmp", dir=lutFolder)
+    os.close(fileDescriptor)
+    return tempPath
+
+def buildLut(paletteArray, lutFolder):
+    """Writes the tables for the palette unless they're already there
+
+    Several processes may build the same tables at once (e.g. the workers of a cold --jobs build), so each
+    writes its own temporary files and moves them into place; whichever finishes last wins with the same bytes.
+    """
+    paletteHash = getPaletteHash(paletteArray)
+    (indexPath, deltaPath) = getLutPaths(lutFolder, paletteHash)
+    if os.path.isfile(indexPath) and os.path.isfile(deltaPath):
+        return
+    os.makedirs(lutFolder, exist_ok=True)
+    print("building palette lookup table {0} for {1} colors".format(paletteHash, len(paletteArray)))
+
+    # write to temporary names first so an interrupted build never leaves a truncated table behind
+    indexTemp = createTempPath(lutFolder, paletteHash)
+    deltaTemp = createTempPath(lutFolder, paletteHash)
+    try:
+        writeLut(paletteArray, indexTemp, deltaTemp)
+        os.replace(indexTemp, indexPath)
+        os.replace(deltaTemp, deltaPath)
+    finally:
+        for tempPath in [indexTemp, deltaTemp]:
+            if os.path.isfile(tempPath):
+                os.remove(tempPath)
+
+def writeLut(paletteArray, indexTemp, deltaTemp):
+    indexTable = numpy.lib.format.open_memmap(indexTemp, mode="w+", dtype=numpy.uint8, shape=(256, 256, 256))
+    deltaTable = numpy.lib.format.open_memmap(deltaTemp, mode="w+", dtype=numpy.float32, shape=(256, 256, 256))
+
+    # same metric as colorspacious.deltaE: euclidean distance in CAM02-UCS
+    paletteUniform = cspace_convert(paletteArray[:, 0:3].astype(float), "sRGB255", "CAM02-UCS")
+    greenBlue = numpy.indices((256, 256)).reshape(2, -1).T
+    colors = numpy.empty((256 * 256, 3), dtype=float)
+    colors[:, 1:3] = greenBlue
+    for red in range(0, 256):
+        colors[:, 0] = red
+        uniform = cspace_convert(colors, "sRGB255", "CAM02-UCS")
+        deltas = numpy.sqrt(numpy.sum((uniform[:, numpy.newaxis, :] - paletteUniform[numpy.newaxis, :, :]) ** 2, axis=-1))
+        nearest = numpy.argmin(deltas, axis=1)
+        indexTable[red] = nearest.reshape(256, 256)
+        deltaTable[red] = deltas[numpy.arange(len(nearest)), nearest].reshape(256, 256)
+
+    indexTable.flush()
+    deltaTable.flush()
+    del indexTable
+    del deltaTable
+
+def loadLut(paletteArray, lutFolder = defaultLutFolder):
+    """Returns (indexTable, deltaTable) for the palette, both indexed as [r, g, b]
+
+    indexTable holds the position of the nearest color in paletteArray, deltaTable the distance to it.
+    The tables live on disk keyed by a hash of the palette and are rebuilt when the palette changes.
+    """
+    paletteHash = getPaletteHash(paletteArray)
+    if paletteHash in loadedLuts:
+        return loadedLuts[paletteHash]
+
+    (indexPath, deltaPath) = getLutPaths(lutFolder, paletteHash)
+    if not os.path.isfile(indexPath) or not os.path.isfile(deltaPath):
+        buildLut(paletteArray, lutFolder)
+
+    lut = (numpy.load(indexPath, mmap_mode="r"), numpy.load(deltaPath, mmap_mode="r"))
+    loadedLuts[paletteHash] = lut
+    return lut
+
+def lookupIndices(paletteArray, colors, lutFolder = defaultLutFolder):
+    """Snaps an (..., 3+) uint8 array of colors, returning (indices into paletteArray, deltas)"""
+    (indexTable, deltaTable) = loadLut(paletteArray, lutFolder)
+    red = colors[..., 0]
+    green = colors[..., 1]
+    blue = colors[..., 2]
+    return (indexTable[red, green, blue], deltaTable[red, green, blue])
+
+
+if __name__ == "__main__":
+    import assemble_template
+
+    lutFolder = defaultLutFolder
+    if len(sys.argv) >= 2:
+        lutFolder = sys.argv[1]
+
+    for (paletteNumber, colors) in enumerate(assemble_template.palettes):
+        paletteArray = assemble_template.getPaletteArray(colors)
+        paletteHash = getPaletteHash(paletteArray)
+        (indexPath, deltaPath) = getLutPaths(lutFolder, paletteHash)
+        if os.path.isfile(indexPath) and os.path.isfile(deltaPath):
+            print("palette {0} already has lookup table {1}".format(paletteNumber, paletteHash))
+            continue
+        buildLut(paletteArray, lutFolder)
@@ -0,0 +1,242 @@
+from PIL import Image
+import numpy
+import argparse
+import os
+import struct
+import time
+import zlib
+
+# priority_index.bin lists the pixels of mask.png which can be auto-picked, grouped by priority, so a client
+# doesn't have to bucket the whole mask itself. It only changes when the template version does.
+#
+# header (little endian, uncompressed):
+#   magic "TPIX", format version u16, template version u32, width u32, height u32, color count u16, bucket count u16
+# followed by one zlib stream holding:
+#   colors as RGBA bytes (color count * 4)
+#   for each bucket, highest priority first: priority u8, pixel count u32, run count u32
+#   for each run, in bucket order: gap as a varint
+#   for each run in the same order: length as a varint
+#   for every pixel, in row order (not bucket order): color u8, an index into the colors
+# Pixels are numbered row by row. A run is consecutive pixels of one bucket; the first run of a bucket has
+# its first pixel's number as the gap, every other run the distance from the end of the previous run.
+# Varints are 7 bits at a time, lowest first, with the top bit set on every byte but the last.
+#
+# Art has long runs of pixels with the same priority, and colors compress far better in row order than
+# scattered over the buckets, which is most of the size.
+
+indexMagic = b"TPIX"
+indexFormatVersion = 2
+headerFormat = "<4sHIIIHH"
+
+class PriorityIndexError(ValueError):
+    pass
+
+def encodeVarints(values):
+    values = numpy.asarray(values, dtype=numpy.uint64)
+    byteCounts = numpy.ones(len(values), dtype=numpy.int64)
+    for shift in [7, 14, 21, 28]:
+        byteCounts += values >= (1 << shift)
+    valueStarts = numpy.cumsum(byteCounts) - byteCounts
+    owners = numpy.repeat(numpy.arange(len(values)), byteCounts)
+    positions = numpy.arange(int(numpy.sum(byteCounts))) - valueStarts[owners]
+    encoded = ((values[owners] >> (positions * 7).astype(numpy.uint64)) & 0x7f).astype(numpy.uint8)
+    encoded[positions < byteCounts[owners] - 1] |= 0x80
+    return encoded.tobytes()
+
+def decodeVarints(body, offset, count):
+    """Returns (count values as int64, offset after them)"""
+    if count == 0:
+        return (numpy.zeros(0, dtype=numpy.int64), offset)
+    encoded = numpy.frombuffer(body, dtype=numpy.uint8, offset=offset)
+    lastBytes = numpy.flatnonzero(encoded < 0x80)
+    if len(lastBytes) < count:
+        raise PriorityIndexError("priority index is truncated")
+    encoded = encoded[0:lastBytes[count - 1] + 1]
+    byteCounts = numpy.diff(numpy.concatenate(([-1], lastBytes[0:count])))
+    if int(byteCounts.max()) > 5:
+        raise PriorityIndexError("priority index has a varint that's too long")
+    owners = numpy.repeat(numpy.arange(count), byteCounts)
+    positions = numpy.arange(len(encoded)) - (lastBytes[0:count] + 1 - byteCounts)[owners]
+    parts = (encoded & 0x7f).astype(numpy.int64) << (positions * 7)
+    # at most 35 bits, so the float sums are exact
+    values = numpy.bincount(owners, weights=parts, minlength=count).astype(numpy.int64)
+    return (values, offset + len(encoded))
+
+def encodePriorityIndex(templateVersion, maskLevels, colorIndices, colors):
+    """Encodes the pixels with a mask level above 0
+
+    maskLevels is the (height, width) uint8 gray level of mask.png, colorIndices the (height, width) uint8
+    index into colors of the color each pixel should be.
+    """
+    (height, width) = maskLevels.shape
+    levels = maskLevels.reshape(-1)
+    pickable = numpy.flatnonzero(levels)
+    # stable, so each bucket keeps its pixels in row order
+    pixelIndices = pickable[numpy.argsort(-levels[pickable].astype(numpy.int16), kind="stable")]
+    sortedLevels = levels[pixelIndices]
+
+    bucketStarts = numpy.flatnonzero(numpy.concatenate(([True], sortedLevels[1:] != sortedLevels[:-1])))
+    if len(pixelIndices) == 0:
+        bucketStarts = numpy.zeros(0, dtype=numpy.int64)
+    bucketSizes = numpy.diff(numpy.concatenate((bucketStarts, [len(pixelIndices)])))
+
+    runStarts = numpy.ones(len(pixelIndices), dtype=bool)
+    runStarts[1:] = pixelIndices[1:] != pixelIndices[:-1] + 1
+    runStarts[bucketStarts] = True
+    runStarts = numpy.flatnonzero(runStarts)
+    runLengths = numpy.diff(numpy.concatenate((runStarts, [len(pixelIndices)])))
+    runFirstPixels = pixelIndices[runStarts]
+    runGaps = runFirstPixels - numpy.concatenate(([0], runFirstPixels[:-1] + runLengths[:-1]))
+    bucketFirstRuns = numpy.searchsorted(runStarts, bucketStarts)
+    runGaps[bucketFirstRuns] = runFirstPixels[bucketFirstRuns]
+    bucketRunCounts = numpy.diff(numpy.concatenate((bucketFirstRuns, [len(runStarts)])))
+
+    parts = [numpy.ascontiguousarray(colors, dtype=numpy.uint8).tobytes()]
+    for (start, size, runCount) in zip(bucketStarts.tolist(), bucketSizes.tolist(), bucketRunCounts.tolist()):
+        parts.append(struct.pack("<BII", int(sortedLevels[start]), size, runCount))
+    parts.append(encodeVarints(runGaps))
+    parts.append(encodeVarints(runLengths))
+    parts.append(colorIndices.reshape(-1)[pickable].astype(numpy.uint8).tobytes())
+
+    header = struct.pack(headerFormat, indexMagic, indexFormatVersion, templateVersion, width, height, len(colors), len(bucketStarts))
+    return header + zlib.compress(b"".join(parts), 9)
+
+def readPriorityIndex(indexBytes):
+    """Returns a dict with the header fields, colors ((count, 4) RGBA), priorities, bucket_starts and
+    bucket_sizes (one per bucket), and pixel_indices and color_indices (one per pixel, in bucket order)
+    """
+    headerSize = struct.calcsize(headerFormat)
+    if len(indexBytes) < headerSize:
+        raise PriorityIndexError("priority index is truncated")
+    (magic, formatVersion, templateVersion, width, height, colorCount, bucketCount) = struct.unpack(headerFormat, indexBytes[0:headerSize])
+    if magic != indexMagic or formatVersion != indexFormatVersion:
+        raise PriorityIndexError("not a version {0} priority index".format(indexFormatVersion))
+    try:
+        body = zlib.decompress(indexBytes[headerSize:])
+    except zlib.error as e:
+        raise PriorityIndexError("priority index body is corrupt: {0}".format(e))
+
+    bucketOffset = colorCount * 4
+    bucketFormat = numpy.dtype([("priority", "<u1"), ("size", "<u4"), ("runs", "<u4")])
+    runOffset = bucketOffset + bucketFormat.itemsize * bucketCount
+    if len(body) < runOffset:
+        raise PriorityIndexError("priority index is truncated")
+    colors = numpy.frombuffer(body, dtype=numpy.uint8, count=colorCount * 4).reshape(-1, 4)
+    buckets = numpy.frombuffer(body, dtype=bucketFormat, count=bucketCount, offset=bucketOffset)
+    bucketSizes = buckets["size"].astype(numpy.int64)
+    bucketRunCounts = buckets["runs"].astype(numpy.int64)
+    pixelCount = int(numpy.sum(bucketSizes))
+    runCount = int(numpy.sum(bucketRunCounts))
+    (runGaps, lengthOffset) = decodeVarints(body, runOffset, runCount)
+    (runLengths, colorOffset) = decodeVarints(body, lengthOffset, runCount)
+    if len(body) != colorOffset + pixelCount:
+        raise PriorityIndexError("priority index has the wrong length for {0} pixels".format(pixelCount))
+    if int(numpy.sum(runLengths)) != pixelCount or (runCount != 0 and int(runLengths.min()) <= 0):
+        raise PriorityIndexError("priority index runs don't add up to its {0} pixels".format(pixelCount))
+
+    # each bucket restarts its running sum at its first run
+    bucketFirstRuns = numpy.concatenate(([0], numpy.cumsum(bucketRunCounts)[:-1])).astype(numpy.int64)[0:bucketCount]
+    runEnds = numpy.cumsum(runGaps + runLengths)
+    if bucketCount > 1:
+        runEnds -= numpy.repeat(numpy.concatenate(([0], runEnds[bucketFirstRuns[1:] - 1])), bucketRunCounts)
+    runFirstPixels = runEnds - runLengths
+    # every pixel is its run's first pixel plus its place in the run
+    runOffsets = numpy.concatenate(([0], numpy.cumsum(runLengths)[:-1])).astype(numpy.int64)
+    pixelIndices = numpy.repeat(runFirstPixels - runOffsets, runLengths) + numpy.arange(pixelCount)
+    rowOrder = numpy.argsort(pixelIndices)
+    rowPixels = pixelIndices[rowOrder]
+    if pixelCount != 0 and (int(rowPixels[0]) < 0 or int(rowPixels[-1]) >= width * height or not numpy.all(rowPixels[1:] != rowPixels[:-1])):
+        raise PriorityIndexError("priority index refers to a pixel that doesn't exist, or one pixel twice")
+
+    rowColors = numpy.frombuffer(body, dtype=numpy.uint8, count=pixelCount, offset=colorOffset)
+    if pixelCount != 0 and int(rowColors.max()) >= colorCount:
+        raise PriorityIndexError("priority index refers to a color that doesn't exist")
+    # colors are in row order, so they go back to the listed pixels through the same sort
+    colorIndices = numpy.empty(pixelCount, dtype=numpy.uint8)
+    colorIndices[rowOrder] = rowColors
+
+    bucketStarts = numpy.concatenate(([0], numpy.cumsum(bucketSizes)[:-1])).astype(numpy.int64)[0:bucketCount]
+    return {
+        "template_version": templateVersion,
+        "width": width,
+        "height": height,
+        "colors": colors,
+        "priorities": buckets["priority"].copy(),
+        "bucket_starts": bucketStarts,
+        "bucket_sizes": bucketSizes,
+        "pixel_indices": pixelIndices,
+        "color_indices": colorIndices,
+    }
+
+def loadPriorityIndex(subfolder):
+    """Reads priority_index.bin from subfolder, raising PriorityIndexError if it's not for the version in version.txt"""
+    with open(os.path.join(subfolder, "priority_index.bin"), "rb") as f:
+        priorityIndex = readPriorityIndex(f.read())
+    with open(os.path.join(subfolder, "version.txt"), "r", encoding="utf-8") as f:
+        templateVersion = int(f.read())
+    if priorityIndex["template_version"] != templateVersion:
+        raise PriorityIndexError("priority index is for version {0}, not {1}".format(priorityIndex["template_version"], templateVersion))
+    return priorityIndex
+
+def findWrongPixels(priorityIndex, snapshotPixels):
+    """Returns a bool per listed pixel, True where the (height, width, 4) RGBA snapshot has a different color
+
+    Pixels which are transparent or outside of the snapshot don't count as wrong, like in the userscript.
+    """
+    (height, width) = snapshotPixels.shape[0:2]
+    (ys, xs) = numpy.divmod(priorityIndex["pixel_indices"], priorityIndex["width"])
+    inside = (xs < width) & (ys < height)
+    current = numpy.zeros((len(xs), 4), dtype=numpy.uint8)
+    current[inside] = snapshotPixels[ys[inside], xs[inside]]
+    targets = priorityIndex["colors"][priorityIndex["color_indices"]]
+    return (current[:, 3] != 0) & numpy.any(current[:, 0:3] != targets[:, 0:3], axis=1)
+
+def loadPixels(path):
+    with Image.open(path) as image:
+        return numpy.array(image.convert("RGBA"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare reading priority_index.bin against bucketing mask.png")
+    parser.add_argument("folder", help="template folder with mask.png, version.txt and priority_index.bin, e.g. templates/mlp")
+    parser.add_argument("snapshot", nargs="?", default=None, help="PNG of the canvas, to also time finding the wrong pixels")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each; the fastest is reported")
+    args = parser.parse_args()
+
+    def getBestTime(function):
+        times = []
+        for iteration in range(0, args.repeat):
+            started = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - started)
+        return (min(times), result)
+
+    try:
+        priorityIndex = loadPriorityIndex(args.folder)
+    except (OSError, ValueError) as e:
+        print("can't read the priority index: {0}".format(e))
+        raise SystemExit(1)
+
+    def bucketMask():
+        levels = loadPixels(os.path.join(args.folder, "mask.png"))[:, :, 1].reshape(-1)
+        pickable = numpy.flatnonzero(levels)
+        return pickable[numpy.argsort(-levels[pickable].astype(numpy.int16), kind="stable")]
+    def readIndex():
+        return loadPriorityIndex(args.folder)
+
+    (maskSeconds, maskPixels) = getBestTime(bucketMask)
+    (indexSeconds, priorityIndex) = getBestTime(readIndex)
+    if not numpy.array_equal(maskPixels, priorityIndex["pixel_indices"]):
+        print("the priority index doesn't match mask.png")
+        raise SystemExit(1)
+
+    maskBytes = os.path.getsize(os.path.join(args.folder, "mask.png"))
+    indexBytes = os.path.getsize(os.path.join(args.folder, "priority_index.bin"))
+    print("version {0}, {1} pickable pixels in {2} buckets".format(priorityIndex["template_version"], len(priorityIndex["pixel_indices"]), len(priorityIndex["priorities"])))
+    print("mask.png: {0} bytes, decoded and bucketed in {1:.4f}s".format(maskBytes, maskSeconds))
+    print("priority_index.bin: {0} bytes, read in {1:.4f}s".format(indexBytes, indexSeconds))
+
+    if args.snapshot != None:
+        snapshotPixels = loadPixels(args.snapshot)
+        (wrongSeconds, wrong) = getBestTime(lambda: findWrongPixels(priorityIndex, snapshotPixels))
+        print("{0} of the pickable pixels are wrong, found in {1:.4f}s".format(int(numpy.count_nonzero(wrong)), wrongSeconds))
@@ -0,0 +1,77 @@
+# Rects are (x1, y1, x2, y2) with x2/y2 exclusive, the same as everywhere else in the assembler.
+# A rect with no area is kept but never found, since nothing can intersect it.
+
+defaultCellSize = 64
+
+def rectsIntersect(first, second):
+    return max(first[0], second[0]) < min(first[2], second[2]) and max(first[1], second[1]) < min(first[3], second[3])
+
+class GridIndex:
+    """Rects bucketed into square cells, for finding everything that touches a rect or a pixel
+
+    Keys are returned in the order they were inserted, which for template entries is draw order.
+    """
+
+    def __init__(self, cellSize = defaultCellSize):
+        self.cellSize = cellSize
+        self.cells = dict()
+        self.rects = dict()
+        self.order = dict()
+        self.nextOrder = 0
+
+    def getCells(self, rect):
+        if rect[0] >= rect[2] or rect[1] >= rect[3]:
+            return
+        for cellY in range(rect[1] // self.cellSize, (rect[3] - 1) // self.cellSize + 1):
+            for cellX in range(rect[0] // self.cellSize, (rect[2] - 1) // self.cellSize + 1):
+                yield (cellX, cellY)
+
+    def insert(self, key, rect):
+        if key in self.rects:
+            self.remove(key)
+        rect = tuple(rect)
+        self.rects[key] = rect
+        self.order[key] = self.nextOrder
+        self.nextOrder += 1
+        for cell in self.getCells(rect):
+            if not cell in self.cells:
+                self.cells[cell] = []
+            self.cells[cell].append(key)
+
+    def remove(self, key):
+        rect = self.rects.pop(key)
+        del self.order[key]
+        for cell in self.getCells(rect):
+            self.cells[cell].remove(key)
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+
+    def query(self, rect):
+        """Returns the keys of every rect which intersects rect"""
+        found = set()
+        for cell in self.getCells(rect):
+            for key in self.cells.get(cell, []):
+                if not key in found and rectsIntersect(self.rects[key], rect):
+                    found.add(key)
+        return sorted(found, key=self.order.get)
+
+    def queryPoint(self, x, y):
+        """Returns the keys of every rect which covers pixel (x, y)"""
+        return self.query((x, y, x + 1, y + 1))
+
+    def getOverlappingPairs(self):
+        """Returns every (first key, second key) whose rects intersect, with first inserted before second"""
+        pairs = set()
+        for keys in self.cells.values():
+            for (position, key) in enumerate(keys):
+                for otherKey in keys[position + 1:]:
+                    pair = (key, otherKey)
+                    if self.order[key] > self.order[otherKey]:
+                        pair = (otherKey, key)
+                    if not pair in pairs and rectsIntersect(self.rects[key], self.rects[otherKey]):
+                        pairs.add(pair)
+        return sorted(pairs, key=lambda pair: (self.order[pair[0]], self.order[pair[1]]))
+
+    def getRects(self):
+        """Returns every (key, rect) in insertion order"""
+        return list(self.rects.items())
@@ -0,0 +1,106 @@
+import csv
+import io
+import urllib.parse
+
+# Rows of the alliance/world sheets are: name, Endu link, blacklisted (anything but empty), alliance member ("true"),
+# and optionally animation import ("exclude" or "split", empty for the template's default). Extra columns are ignored.
+
+animationImportModes = ["exclude", "split"]
+
+defaultPorts = {"http": 80, "https": 443}
+
+def normalizeEnduUrl(url):
+    """Returns url in the form used to fetch and compare Endu links, so the same document listed twice is fetched once
+
+    Only changes that point at the same document are made: surrounding whitespace and the fragment are
+    dropped, and the scheme and host are lowercased without a default port.
+    """
+    url = url.strip()
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    if not parts.scheme in defaultPorts or parts.hostname == None:
+        return url
+    netloc = parts.hostname.lower()
+    if ":" in netloc:
+        netloc = "[" + netloc + "]"
+    if port != None and port != defaultPorts[parts.scheme]:
+        netloc += ":{0}".format(port)
+    if parts.username != None:
+        userInfo = parts.username
+        if parts.password != None:
+            userInfo += ":" + parts.password
+        netloc = userInfo + "@" + netloc
+    return urllib.parse.urlunsplit((parts.scheme.lower(), netloc, parts.path or "/", parts.query, ""))
+
+def readCsvRows(csvBody):
+    """Yields the rows of a CSV body one by one, with quoted fields (commas, quotes, line breaks) handled"""
+    with io.TextIOWrapper(io.BytesIO(csvBody), encoding="utf-8-sig", newline="") as csvText:
+        for row in csv.reader(csvText):
+            yield [field.strip() for field in row]
+
+def createImportSummary(csvLink):
+    return {"csv": csvLink, "imported": 0, "duplicate": 0, "skipped": dict()}
+
+def importCsvTemplates(csvBody, selfSourceRoot, honorAlliance, seenUrls, summary, animationImport = "exclude"):
+    """Yields a template entry for each row that should be imported, in sheet order
+
+    seenUrls holds the normalized Endu links already listed by an entry higher up in the draw order. Rows
+    with one of those are duplicates and left out, so the copy with the highest precedence is the one drawn.
+    Imported links are added to it. summary (from createImportSummary) counts what happened to every row.
+    Rows without a valid animation import column get animationImport.
+    """
+    for row in readCsvRows(csvBody):
+        if len(row) < 4:
+            print("malformed row")
+            summary["skipped"]["malformed"] = summary["skipped"].get("malformed", 0) + 1
+            continue
+
+        (name, enduLink, blacklisted, allianceMember) = row[0:4]
+        reason = None
+        if blacklisted != "":
+            print("skipping blacklisted template {0}".format(name))
+            reason = "blacklisted"
+        elif allianceMember.lower() != "true" and honorAlliance:
+            print("skipping non-alliance template {0}".format(name))
+            reason = "not_alliance"
+        elif selfSourceRoot in enduLink:
+            print("skipping self {0}".format(name))
+            reason = "self"
+        elif enduLink == "":
+            print("skipping template {0} without an Endu link".format(name))
+            reason = "no_link"
+        if reason != None:
+            summary["skipped"][reason] = summary["skipped"].get(reason, 0) + 1
+            continue
+
+        enduUrl = normalizeEnduUrl(enduLink)
+        if enduUrl in seenUrls:
+            print("skipping duplicate template {0}: {1}".format(name, enduUrl))
+            summary["duplicate"] += 1
+            continue
+        seenUrls.add(enduUrl)
+
+        rowAnimationImport = animationImport
+        if len(row) > 4 and row[4] != "":
+            if row[4].lower() in animationImportModes:
+                rowAnimationImport = row[4].lower()
+            else:
+                print("ignoring unknown animation import {0} for template {1}".format(row[4], name))
+
+        print("import template {0}".format(name))
+        summary["imported"] += 1
+        yield {
+            "name": name,
+            "endu": enduUrl,
+            "priority": 1,
+            "autopick": True,
+            "animation_import": rowAnimationImport
+        }
+
+def printImportSummary(summary):
+    skipped = ", ".join("{0} {1}".format(count, reason) for (reason, count) in sorted(summary["skipped"].items()))
+    print("{0}: {1} imported, {2} duplicate, {3} skipped{4}".format(summary["csv"], summary["imported"], summary["duplicate"],
+        sum(summary["skipped"].values()), " ({0})".format(skipped) if skipped != "" else ""))
@@ -0,0 +1,79 @@
+import numpy
+import unittest
+
+import assemble_template
+import delta_patch
+
+# Encodes deltas between generated layer sets and checks the reference decoder reproduces them exactly:
+#   cd .build/template_assembler && python3 -m unittest test_delta_patch
+
+layerSize = (64, 48)
+
+def generateLayers(rng):
+    """Returns canvas/autopick/mask RGBA arrays like the assembler writes: palette colors or transparent, and a gray mask"""
+    colors = numpy.concatenate((assemble_template.getPaletteArray(assemble_template.palette), [[0, 0, 0, 0]])).astype(numpy.uint8)
+    canvas = colors[rng.integers(0, len(colors), (layerSize[1], layerSize[0]))]
+    autopick = canvas.copy()
+    autopick[rng.random((layerSize[1], layerSize[0])) < 0.3] = 0
+    mask = numpy.zeros((layerSize[1], layerSize[0], 4), dtype=numpy.uint8)
+    mask[:, :, 0:3] = (rng.integers(0, 11, (layerSize[1], layerSize[0])) * 25)[:, :, numpy.newaxis]
+    mask[:, :, 3] = 255
+    return {"canvas": canvas, "autopick": autopick, "mask": mask}
+
+def changeBlock(rng, pixels, source):
+    """Copies a random block of source over pixels"""
+    (top, left) = (int(rng.integers(0, layerSize[1] - 8)), int(rng.integers(0, layerSize[0] - 8)))
+    pixels[top:top + 8, left:left + 8] = source[top:top + 8, left:left + 8]
+
+class DeltaPatchTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = numpy.random.default_rng(3)
+        self.version1 = generateLayers(self.rng)
+        other = generateLayers(self.rng)
+        self.version2 = dict((name, pixels.copy()) for (name, pixels) in self.version1.items())
+        for name in self.version2:
+            for block in range(0, 5):
+                changeBlock(self.rng, self.version2[name], other[name])
+
+    def assertLayersEqual(self, layers, expected):
+        self.assertEqual(sorted(layers.keys()), sorted(expected.keys()))
+        for name in expected:
+            self.assertEqual(layers[name].dtype, numpy.uint8)
+            self.assertTrue(numpy.array_equal(layers[name], expected[name]), name)
+
+    def test_round_trip(self):
+        deltaBytes = delta_patch.encodeDelta(1, 2, self.version1, self.version2)
+        header = delta_patch.readDeltaHeader(deltaBytes)
+        self.assertEqual((header["from_version"], header["to_version"]), (1, 2))
+        self.assertEqual((header["width"], header["height"]), layerSize)
+        self.assertLayersEqual(delta_patch.applyDelta(deltaBytes, self.version1), self.version2)
+
+    def test_round_trip_with_only_the_mask_changed(self):
+        version3 = dict((name, pixels.copy()) for (name, pixels) in self.version2.items())
+        version3["mask"][0:4, :, 0:3] = 250
+        deltaBytes = delta_patch.encodeDelta(2, 3, self.version2, version3)
+        self.assertLayersEqual(delta_patch.applyDelta(deltaBytes, self.version2), version3)
+
+    def test_round_trip_without_changes_and_with_wide_color_tables(self):
+        self.assertLayersEqual(delta_patch.applyDelta(delta_patch.encodeDelta(2, 2, self.version2, self.version2), self.version2), self.version2)
+        # more than 256 colors need u16 indices, which the assembler's own images never do
+        version3 = dict(self.version2)
+        version3["canvas"] = self.rng.integers(0, 256, self.version2["canvas"].shape, dtype=numpy.uint8)
+        deltaBytes = delta_patch.encodeDelta(2, 3, self.version2, version3)
+        self.assertLayersEqual(delta_patch.applyDelta(deltaBytes, self.version2), version3)
+
+    def test_wrong_base_is_rejected(self):
+        deltaBytes = delta_patch.encodeDelta(1, 2, self.version1, self.version2)
+        with self.assertRaises(delta_patch.DeltaError):
+            delta_patch.applyDelta(deltaBytes, self.version2)
+        wrongMask = dict(self.version1)
+        wrongMask["mask"] = self.version1["mask"].copy()
+        wrongMask["mask"][0, 0, 0:3] ^= 1
+        with self.assertRaises(delta_patch.DeltaError):
+            delta_patch.applyDelta(deltaBytes, wrongMask)
+        with self.assertRaises(delta_patch.DeltaError):
+            delta_patch.applyDelta(deltaBytes, dict((name, self.version1[name]) for name in ["canvas", "autopick"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
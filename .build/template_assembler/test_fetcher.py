@@ -0,0 +1,172 @@
+import http.server
+import threading
+import time
+import unittest
+
+import fetcher
+
+# Runs the fetcher against local http.server stand-ins, so nothing touches the network:
+#   cd .build/template_assembler && python3 -m unittest test_fetcher
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.record(self)
+        (status, headers, body) = self.server.respond(self.path)
+        byteRange = self.headers.get("Range")
+        if status == 200 and byteRange != None and self.server.ranges:
+            (first, last) = byteRange[len("bytes="):].split("-")
+            body = body[int(first):int(last) + 1]
+            status = 206
+        self.send_response(status)
+        for (headerName, value) in headers.items():
+            self.send_header(headerName, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """Serves path -> body (the path itself unless it's in bodies), taking delay seconds per request
+
+    failures[path] requests get a 503 first. Range requests are only answered with a 206 if ranges is set.
+    """
+    daemon_threads = True
+
+    def __init__(self, delay = 0, failures = None, redirects = None, bodies = None, ranges = False):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.delay = delay
+        self.failures = dict(failures or {})
+        self.redirects = dict(redirects or {})
+        self.bodies = dict(bodies or {})
+        self.ranges = ranges
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.running = 0
+        self.maxRunning = 0
+        self.clientPorts = set()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def getUrl(self, path):
+        return "http://127.0.0.1:{0}{1}".format(self.server_address[1], path)
+
+    def record(self, handler):
+        with self.lock:
+            self.requests += 1
+            self.clientPorts.add(handler.client_address[1])
+
+    def respond(self, path):
+        with self.lock:
+            self.running += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+        try:
+            time.sleep(self.delay)
+            with self.lock:
+                if self.failures.get(path, 0) > 0:
+                    self.failures[path] -= 1
+                    return (503, {}, b"")
+            if path in self.redirects:
+                return (302, {"Location": self.redirects[path]}, b"")
+            return (200, {"ETag": '"{0}"'.format(path)}, self.bodies.get(path, path.encode("utf-8")))
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def startServer(self, **settings):
+        server = StandInServer(**settings)
+        self.servers.append(server)
+        return server
+
+    def test_slow_host_does_not_stall_other_hosts(self):
+        slowServer = self.startServer(delay=0.5)
+        fastServer = self.startServer()
+        remoteFetcher = fetcher.Fetcher(maxWorkers=4, maxPerHost=2, retries=0)
+        try:
+            # far more slow URLs than workers
+            slowUrls = [slowServer.getUrl("/slow{0}.png".format(number)) for number in range(0, 12)]
+            remoteFetcher.prefetch(slowUrls)
+            started = time.perf_counter()
+            self.assertEqual(remoteFetcher.fetch(fastServer.getUrl("/fast.png")), b"/fast.png")
+            self.assertLess(time.perf_counter() - started, 0.4)
+
+            self.assertEqual([remoteFetcher.fetch(url) for url in slowUrls], [url[url.rindex("/"):].encode("utf-8") for url in slowUrls])
+            self.assertEqual(slowServer.maxRunning, 2)
+        finally:
+            remoteFetcher.close()
+
+    def test_connections_are_kept_alive(self):
+        server = self.startServer()
+        remoteFetcher = fetcher.Fetcher(maxWorkers=4, maxPerHost=1, retries=0)
+        try:
+            for number in range(0, 5):
+                remoteFetcher.fetch(server.getUrl("/image{0}.png".format(number)))
+            self.assertEqual(server.requests, 5)
+            self.assertEqual(len(server.clientPorts), 1)
+        finally:
+            remoteFetcher.close()
+
+    def test_failures_are_retried(self):
+        server = self.startServer(failures={"/flaky.json": 2, "/down.json": 10})
+        remoteFetcher = fetcher.Fetcher(retries=2, backoff=0.01)
+        try:
+            self.assertEqual(remoteFetcher.fetch(server.getUrl("/flaky.json")), b"/flaky.json")
+            with self.assertRaises(fetcher.FetchError) as raised:
+                remoteFetcher.fetch(server.getUrl("/down.json"))
+            self.assertEqual(raised.exception.status, 503)
+            self.assertEqual(server.requests, 6)
+        finally:
+            remoteFetcher.close()
+
+    def test_redirects_to_other_hosts(self):
+        targetServer = self.startServer()
+        server = self.startServer(redirects={"/moved.png": targetServer.getUrl("/image.png")})
+        remoteFetcher = fetcher.Fetcher(maxPerHost=1, retries=0)
+        try:
+            self.assertEqual(remoteFetcher.fetch(server.getUrl("/moved.png")), b"/image.png")
+            # the slot borrowed for the other host was given back
+            self.assertEqual(remoteFetcher.fetch(targetServer.getUrl("/other.png")), b"/other.png")
+        finally:
+            remoteFetcher.close()
+
+    def test_prefix_with_range_requests(self):
+        server = self.startServer(bodies={"/large.png": bytes(range(256)) * 4096}, ranges=True)
+        remoteFetcher = fetcher.Fetcher(maxPerHost=1, retries=0)
+        try:
+            self.assertEqual(remoteFetcher.fetchPrefix(server.getUrl("/large.png"), 24), bytes(range(24)))
+            self.assertEqual(remoteFetcher.fetchPrefix(server.getUrl("/small.png"), 1024), b"/small.png")
+            # a full body isn't mistaken for the prefix
+            self.assertEqual(len(remoteFetcher.fetch(server.getUrl("/large.png"))), 256 * 4096)
+            self.assertEqual(len(server.clientPorts), 1)
+        finally:
+            remoteFetcher.close()
+
+    def test_prefix_without_range_requests(self):
+        server = self.startServer(bodies={"/large.png": bytes(range(256)) * 4096})
+        remoteFetcher = fetcher.Fetcher(maxPerHost=1, retries=0)
+        try:
+            self.assertEqual(remoteFetcher.fetchPrefix(server.getUrl("/large.png"), 24), bytes(range(24)))
+            # the connection with the rest of the body on it was dropped rather than reused
+            self.assertEqual(remoteFetcher.fetch(server.getUrl("/next.png")), b"/next.png")
+            self.assertEqual(len(server.clientPorts), 2)
+        finally:
+            remoteFetcher.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
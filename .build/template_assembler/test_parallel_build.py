@@ -0,0 +1,109 @@
+from PIL import Image
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import benchmark
+
+# Builds a generated template folder with --jobs on a cold cache and serially, from a copy of the
+# assembler in a scratch repo root so the cache next to it starts out empty:
+#   cd .build/template_assembler && python3 -m unittest test_parallel_build
+
+assemblerFolder = os.path.dirname(os.path.abspath(__file__))
+
+workloadSettings = {
+    "entries": 12,
+    "min_size": 16,
+    "max_size": 96,
+    "opacity": 0.7,
+    "off_palette": 0.05,
+    "semi_transparent": 0.02,
+    "export_groups": 2,
+    "animated": 1,
+    "frames": 3,
+    "seed": 7,
+}
+
+class ParallelBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.workFolder = tempfile.mkdtemp(prefix="template_parallel_test_")
+        self.assemblerCopy = os.path.join(self.workFolder, ".build", "template_assembler")
+        os.makedirs(self.assemblerCopy)
+        for sourcePath in glob.glob(os.path.join(assemblerFolder, "*.py")):
+            shutil.copy(sourcePath, self.assemblerCopy)
+
+    def tearDown(self):
+        shutil.rmtree(self.workFolder, ignore_errors=True)
+
+    def build(self, templateFolder, *options):
+        command = [sys.executable, ".build/template_assembler/assemble_template.py", templateFolder, "--at", str(benchmark.workloadUtc)]
+        completed = subprocess.run(command + list(options), cwd=self.workFolder, capture_output=True, text=True)
+        self.assertEqual(completed.returncode, 0, completed.stdout + completed.stderr)
+        return completed.stdout
+
+    def readOutputs(self, templateFolder):
+        outputs = dict()
+        for fileName in sorted(os.listdir(templateFolder)):
+            path = os.path.join(templateFolder, fileName)
+            if os.path.isfile(path) and fileName != "template.json":
+                with open(path, "rb") as f:
+                    outputs[fileName] = f.read()
+        return outputs
+
+    def test_cold_cache_parallel_build_matches_serial_build(self):
+        parallelFolder = os.path.join(self.workFolder, "parallel")
+        serialFolder = os.path.join(self.workFolder, "serial")
+        benchmark.generateTemplateFolder(parallelFolder, workloadSettings)
+        shutil.copytree(parallelFolder, serialFolder)
+
+        parallelLog = self.build(parallelFolder, "--jobs", "4")
+        # the lookup table is built once, before the workers start, rather than by each of them
+        self.assertEqual(parallelLog.count("building palette lookup table"), 1)
+        self.assertNotIn("Failed to load", parallelLog)
+        self.build(serialFolder)
+
+        parallelOutputs = self.readOutputs(parallelFolder)
+        serialOutputs = self.readOutputs(serialFolder)
+        self.assertIn("canvas.png", serialOutputs)
+        self.assertEqual(sorted(parallelOutputs.keys()), sorted(serialOutputs.keys()))
+        for fileName in serialOutputs:
+            self.assertEqual(parallelOutputs[fileName], serialOutputs[fileName], fileName)
+
+    def test_cold_cache_parallel_build_with_shared_images_matches_serial_build(self):
+        # the workers preprocess entries with the same image at the same time and save them under the same keys
+        parallelFolder = os.path.join(self.workFolder, "parallel")
+        serialFolder = os.path.join(self.workFolder, "serial")
+        os.makedirs(os.path.join(parallelFolder, "source"))
+        image = Image.new("RGBA", (24, 24), (255, 255, 255, 255))
+        image.paste((0, 0, 0, 255), (4, 4, 20, 20))
+        image.save(os.path.join(parallelFolder, "source", "a.png"))
+        templates = [{
+            "name": "e{0}".format(entryNumber),
+            "images": ["source/a.png"],
+            "x": (entryNumber % 6) * 30,
+            "y": (entryNumber // 6) * 30,
+            "priority": 1 + entryNumber % 2,
+            "autopick": True,
+        } for entryNumber in range(0, 24)]
+        templateFile = {"endu_info": {"contact": "test", "source_root": "https://example.invalid/", "name": "test"}, "templates": templates}
+        with open(os.path.join(parallelFolder, "template.json"), "w", encoding="utf-8", newline='\n') as f:
+            f.write(json.dumps(templateFile, indent=4))
+        shutil.copytree(parallelFolder, serialFolder)
+
+        parallelLog = self.build(parallelFolder, "--incremental", "--jobs", "4")
+        self.assertNotIn("Failed to load", parallelLog)
+        self.build(serialFolder)
+
+        parallelOutputs = self.readOutputs(parallelFolder)
+        serialOutputs = self.readOutputs(serialFolder)
+        for fileName in ["canvas.png", "autopick.png", "mask.png"]:
+            self.assertEqual(parallelOutputs[fileName], serialOutputs[fileName], fileName)
+
+
+if __name__ == "__main__":
+    unittest.main()
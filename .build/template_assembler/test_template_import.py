@@ -0,0 +1,146 @@
+from PIL import Image
+import io
+import json
+import numpy
+import unittest
+
+import assemble_template
+import fetcher
+import template_import
+from test_fetcher import StandInServer
+
+# Imports CSV sheets from bytes, and through getTemplates from a local http.server stand-in, so nothing touches the network:
+#   cd .build/template_assembler && python3 -m unittest test_template_import
+
+selfSourceRoot = "https://example.invalid/"
+
+def importRows(csvBody, honorAlliance = True, seenUrls = None):
+    summary = template_import.createImportSummary("sheet.csv")
+    if seenUrls == None:
+        seenUrls = set()
+    return (list(template_import.importCsvTemplates(csvBody, selfSourceRoot, honorAlliance, seenUrls, summary)), summary)
+
+class ReadCsvRowsTest(unittest.TestCase):
+    def test_quoted_fields_keep_their_commas_and_quotes(self):
+        rows = list(template_import.readCsvRows(b'"Ponies, Inc.",https://a.example/t.json,,true\n"say ""hi""",https://b.example/t.json,,true\n'))
+        self.assertEqual(rows, [
+            ["Ponies, Inc.", "https://a.example/t.json", "", "true"],
+            ['say "hi"', "https://b.example/t.json", "", "true"],
+        ])
+
+    def test_quoted_field_spans_lines(self):
+        rows = list(template_import.readCsvRows(b'"two\r\nlines",https://a.example/t.json,,true\r\n'))
+        self.assertEqual(rows, [["two\r\nlines", "https://a.example/t.json", "", "true"]])
+
+    def test_bom_is_dropped_and_cells_are_stripped(self):
+        rows = list(template_import.readCsvRows("\ufeffname , https://a.example/t.json ,  , TRUE \n".encode("utf-8")))
+        self.assertEqual(rows, [["name", "https://a.example/t.json", "", "TRUE"]])
+
+class ImportCsvTemplatesTest(unittest.TestCase):
+    def test_header_row_is_not_imported(self):
+        csvBody = "\ufeffName,Endu link,Blacklisted,Alliance\nPonies,https://a.example/t.json,,true\n".encode("utf-8")
+        for honorAlliance in [True, False]:
+            (templates, summary) = importRows(csvBody, honorAlliance)
+            self.assertEqual([templateEntry["name"] for templateEntry in templates], ["Ponies"])
+            self.assertEqual(summary["imported"], 1)
+            self.assertEqual(sum(summary["skipped"].values()), 1)
+
+    def test_rows_are_stripped_before_they_are_checked(self):
+        (templates, summary) = importRows(b"Ponies , https://a.example/t.json ,  , True \n")
+        self.assertEqual(templates[0]["name"], "Ponies")
+        self.assertEqual(templates[0]["endu"], "https://a.example/t.json")
+
+    def test_same_link_written_two_ways_is_imported_once(self):
+        csvBody = b"First,https://A.Example:443/t.json#top,,true\nSecond,HTTPS://a.example/t.json,,true\n"
+        (templates, summary) = importRows(csvBody)
+        self.assertEqual([templateEntry["name"] for templateEntry in templates], ["First"])
+        self.assertEqual(templates[0]["endu"], "https://a.example/t.json")
+        self.assertEqual(summary["imported"], 1)
+        self.assertEqual(summary["duplicate"], 1)
+
+    def test_links_already_seen_are_skipped(self):
+        seenUrls = set([template_import.normalizeEnduUrl("https://a.example/t.json")])
+        (templates, summary) = importRows(b"Ponies,https://a.example/t.json#x,,true\nOthers,https://b.example/t.json,,true\n", seenUrls=seenUrls)
+        self.assertEqual([templateEntry["name"] for templateEntry in templates], ["Others"])
+        self.assertEqual(summary["duplicate"], 1)
+        self.assertIn("https://b.example/t.json", seenUrls)
+
+class GetTemplatesTest(unittest.TestCase):
+    def setUp(self):
+        enduDocument = json.dumps({"templates": [{"name": "art", "sources": ["https://example.invalid/art.png"], "x": 10, "y": 20}]})
+        otherDocument = json.dumps({"templates": [{"name": "other art", "sources": ["https://example.invalid/other.png"], "x": 30, "y": 40}]})
+        self.server = StandInServer(bodies={
+            "/ally.json": enduDocument.encode("utf-8"),
+            "/other.json": otherDocument.encode("utf-8"),
+        })
+        self.moduleFetcher = assemble_template.remoteFetcher
+        assemble_template.remoteFetcher = fetcher.Fetcher(maxPerHost=1, retries=0)
+
+    def tearDown(self):
+        assemble_template.remoteFetcher.close()
+        assemble_template.remoteFetcher = self.moduleFetcher
+        self.server.stop()
+
+    def test_csv_link_listed_in_template_json_is_skipped(self):
+        allyUrl = self.server.getUrl("/ally.json")
+        csvBody = "Ally,{0},,true\nOther,{1},,true\n".format(allyUrl.replace("http://", "HTTP://") + "#top", self.server.getUrl("/other.json"))
+        self.server.bodies["/world.csv"] = csvBody.encode("utf-8")
+        templateFile = {
+            "endu_info": {"source_root": selfSourceRoot},
+            "world_csv_import": self.server.getUrl("/world.csv"),
+            "templates": [{"name": "ours", "endu": allyUrl, "priority": 5}],
+        }
+        templates = assemble_template.getTemplates(templateFile)
+        # draw order, so the imported entry is drawn first and the template.json entry on top of it
+        self.assertEqual([templateEntry["name"] for templateEntry in templates], ["Other -> other art", "ours -> art"])
+        self.assertEqual(templates[1]["priority"], 5)
+
+class AnimationSplitTest(unittest.TestCase):
+    sheetUrl = "https://ally.example/sheet.png"
+    enduUrl = "https://ally.example/template.json"
+
+    def setUp(self):
+        # two 2x2 frames side by side, white except for the top right pixel which is black in the second frame
+        sheet = Image.new("RGBA", (4, 2), (255, 255, 255, 255))
+        sheet.putpixel((3, 0), (0, 0, 0, 255))
+        sheetFile = io.BytesIO()
+        sheet.save(sheetFile, "PNG")
+        self.sourceBodies = {self.sheetUrl: sheetFile.getvalue()}
+        self.enduDocuments = {self.enduUrl: {"templates": [{
+            "name": "sprite", "sources": [self.sheetUrl], "x": 10, "y": 20,
+            "frameWidth": 2, "frameHeight": 2, "frameCount": 2, "frameRate": 1,
+        }]}}
+
+    def checkSplitEntries(self, templates):
+        self.assertEqual([templateEntry["name"] for templateEntry in templates], ["Ally -> sprite (still)", "Ally -> sprite (moving)"])
+        (still, moving) = templates
+        self.assertTrue(still["autopick"])
+        self.assertEqual(still["export_group"], "ours")
+        self.assertNotIn("__exclude", still)
+        self.assertTrue(moving["__exclude"])
+        self.assertFalse(moving["autopick"])
+        self.assertNotIn("export_group", moving)
+
+        stillPlane = assemble_template.prepareTemplateEntry(still, ".", None, self.sourceBodies)["image"]
+        whiteIndex = assemble_template.getPaletteIndices(assemble_template.packColors(numpy.array([[255, 255, 255, 255]], dtype=numpy.uint8)))[0]
+        self.assertEqual(stillPlane.shape, (2, 2))
+        self.assertEqual(stillPlane[0, 1], assemble_template.transparentIndex)
+        self.assertEqual(int(numpy.count_nonzero(stillPlane == whiteIndex)), 3)
+
+        movingPlane = assemble_template.prepareTemplateEntry(moving, ".", None, self.sourceBodies)["image"]
+        self.assertEqual(numpy.argwhere(movingPlane != assemble_template.transparentIndex).tolist(), [[0, 1]])
+
+    def test_split_keeps_still_pixels_and_erases_moving_ones(self):
+        templateFileEntry = {"name": "Ally", "endu": self.enduUrl, "autopick": True, "export_group": "ours", "animation_import": "split"}
+        self.checkSplitEntries(assemble_template.resolveTemplateFileEntry(templateFileEntry, self.enduDocuments))
+
+    def test_csv_fifth_column_selects_split(self):
+        (imported, summary) = importRows("Ally,{0},,true,Split\n".format(self.enduUrl).encode("utf-8"))
+        self.assertEqual(imported[0]["animation_import"], "split")
+        imported[0]["export_group"] = "ours"
+        # the template's own default is "exclude", the row overrides it
+        self.checkSplitEntries(assemble_template.resolveTemplateFileEntry(imported[0], self.enduDocuments, "exclude"))
+
+
+if __name__ == "__main__":
+    unittest.main()